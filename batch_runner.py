@@ -0,0 +1,150 @@
+'''
+	Run the processing stages of several scenes in a single job, instead of editing the scene_id of each script and running it
+	once per scene. Each stage is one of the scripts below, run in a subprocess with the scene_id as its first argument:
+	* ingest: read_fullscan_hydraharp_t3.py
+	* preprocess: preprocess_raw_hist_img.py
+	* irf: preprocess_per_scene_irf.py
+	* depth: process_hist_img.py
+	The stages of a scene run in that order, and a scene stops at its first failed stage. Different scenes run in parallel,
+	but a scene only starts if its estimated peak memory fits in the memory left by the scenes that are running, so two
+	large scenes are not co-scheduled. Scenes that update scan_params.json do so under a lock (see update_json_locked).
+	The output of each stage is saved in log_dirpath.
+'''
+#### Standard Library Imports
+import os
+import sys
+import time
+import fnmatch
+import subprocess
+
+#### Local imports
+from scan_data_utils import get_n_hist_bins, get_nt
+from research_utils.io_ops import load_json
+
+SCENE_STAGES = ['ingest', 'preprocess', 'irf', 'depth']
+SCENE_STAGE_SCRIPTS = {
+	'ingest': 'read_fullscan_hydraharp_t3.py'
+	, 'preprocess': 'preprocess_raw_hist_img.py'
+	, 'irf': 'preprocess_per_scene_irf.py'
+	, 'depth': 'process_hist_img.py'
+}
+# Rough peak memory of each stage per histogram bin of the scene. The ingest writes into a memory-mapped uint32 image,
+# preprocess holds a few copies of the cropped image, and irf/depth hold float64 copies of it for denoising and decoding
+STAGE_BYTES_PER_HIST_BIN = {'ingest': 4, 'preprocess': 12, 'irf': 40, 'depth': 40}
+
+def select_scene_ids(scene_ids, scene_id_patterns):
+	'''
+		scene_ids that match any of the fnmatch patterns (e.g., '20190209_deer_high_mu/*'), in the order of scene_ids
+	'''
+	return [scene_id for scene_id in scene_ids if any([fnmatch.fnmatch(scene_id, pattern) for pattern in scene_id_patterns])]
+
+def select_stages(stages):
+	'''
+		Validate the stages and sort them in the order they have to run
+	'''
+	for stage in stages: assert(stage in SCENE_STAGES), "Invalid stage {}. Options: {}".format(stage, SCENE_STAGES)
+	return [stage for stage in SCENE_STAGES if (stage in stages)]
+
+def estimate_scene_job_mem(scan_params, scene_id, stages):
+	'''
+		Rough peak memory in bytes of running stages for scene_id, i.e., the estimate of its largest stage.
+		The ingest scales with the raw histogram image, the other stages with the preprocessed (cropped) one.
+		Scenes that have not been ingested yet use the dims of the "default" scene params
+	'''
+	scene_params = scan_params['scene_params'].get(scene_id, scan_params['scene_params']['default'])
+	n_pixels = scene_params['n_rows_fullres']*scene_params['n_cols_fullres']
+	max_tbin = (1. / scan_params['laser_rep_freq'])*1e12 # in picosecs
+	hist_img_tau = scan_params['hist_preprocessing_params']['hist_end_time'] - scan_params['hist_preprocessing_params']['hist_start_time']
+	raw_nt = get_n_hist_bins(max_tbin, scan_params['min_tbin_size'])
+	preprocessed_nt = get_nt(hist_img_tau, scan_params['min_tbin_size'])
+	stage_nt = {stage: (raw_nt if (stage == 'ingest') else preprocessed_nt) for stage in stages}
+	return int(max([STAGE_BYTES_PER_HIST_BIN[stage]*n_pixels*stage_nt[stage] for stage in stages]))
+
+def pick_next_scene_job(pending_jobs, running_mem, max_mem, n_running):
+	'''
+		Index in pending_jobs of the next scene job to start, or None if none fits.
+		pending_jobs is a list of (scene_id, mem) sorted by decreasing mem, so the largest job that fits in the memory left
+		is started first. A job that does not fit in max_mem by itself is only started when nothing else is running
+	'''
+	if(len(pending_jobs) == 0): return None
+	if(n_running == 0): return 0
+	for (k, (_, mem)) in enumerate(pending_jobs):
+		if((running_mem + mem) <= max_mem): return k
+	return None
+
+def get_stage_log_fpath(log_dirpath, scene_id, stage):
+	return os.path.join(log_dirpath, '{}_{}.log'.format(scene_id.replace('/', '--'), stage))
+
+def start_scene_stage(scene_id, stage, stage_scripts, log_dirpath, repo_dirpath):
+	'''
+		Start the script of stage for scene_id in a subprocess. Its output goes to the stage log file.
+		Plots are rendered with a non-interactive backend so the scripts do not block on figure windows
+	'''
+	log_file = open(get_stage_log_fpath(log_dirpath, scene_id, stage), 'w')
+	env = dict(os.environ, MPLBACKEND='Agg')
+	process = subprocess.Popen([sys.executable, stage_scripts[stage], scene_id], cwd=repo_dirpath, stdout=log_file, stderr=subprocess.STDOUT, env=env)
+	return (process, log_file)
+
+def run_scene_jobs(scene_ids, stages, scan_params, max_mem, max_parallel=1, log_dirpath='./batch-logs', repo_dirpath=None, stage_scripts=SCENE_STAGE_SCRIPTS, poll_period=1.0):
+	'''
+		Run the stages of each scene in scene_ids.
+		Inputs:
+			* scan_params: the contents of scan_params.json. Used for the memory estimate of each scene
+			* max_mem: memory budget in bytes. Scenes only run in parallel while the sum of their estimates fits in it
+			* max_parallel: maximum number of scenes running at the same time
+			* repo_dirpath: working directory of the stage scripts. Defaults to the directory of this file
+			* stage_scripts: dict mapping each stage to its script
+		Outputs:
+			* dict mapping each scene_id to None if all its stages succeeded, otherwise to the stage that failed
+	'''
+	stages = select_stages(stages)
+	if(repo_dirpath is None): repo_dirpath = os.path.dirname(os.path.abspath(__file__))
+	os.makedirs(log_dirpath, exist_ok=True)
+	pending_jobs = sorted([(scene_id, estimate_scene_job_mem(scan_params, scene_id, stages)) for scene_id in scene_ids], key=lambda job: -job[1])
+	running_jobs = {} # scene_id -> [process, log_file, stage index, mem]
+	failed_stages = {}
+	while((len(pending_jobs) > 0) or (len(running_jobs) > 0)):
+		while(len(running_jobs) < max_parallel):
+			running_mem = sum([job[3] for job in running_jobs.values()])
+			k = pick_next_scene_job(pending_jobs, running_mem, max_mem, len(running_jobs))
+			if(k is None): break
+			(scene_id, mem) = pending_jobs.pop(k)
+			print("Starting {} (estimated memory {:.2f} GB)".format(scene_id, mem / 1e9))
+			running_jobs[scene_id] = list(start_scene_stage(scene_id, stages[0], stage_scripts, log_dirpath, repo_dirpath)) + [0, mem]
+		time.sleep(poll_period)
+		for scene_id in list(running_jobs.keys()):
+			(process, log_file, stage_idx, mem) = running_jobs[scene_id]
+			returncode = process.poll()
+			if(returncode is None): continue
+			log_file.close()
+			if(returncode != 0):
+				print("FAILED {} at stage {}. See {}".format(scene_id, stages[stage_idx], get_stage_log_fpath(log_dirpath, scene_id, stages[stage_idx])))
+				failed_stages[scene_id] = stages[stage_idx]
+				del running_jobs[scene_id]
+			elif((stage_idx + 1) < len(stages)):
+				running_jobs[scene_id] = list(start_scene_stage(scene_id, stages[stage_idx+1], stage_scripts, log_dirpath, repo_dirpath)) + [stage_idx+1, mem]
+			else:
+				print("Finished {}".format(scene_id))
+				del running_jobs[scene_id]
+	return {scene_id: failed_stages.get(scene_id) for scene_id in scene_ids}
+
+
+if __name__=='__main__':
+
+	## Load parameters shared by all
+	scan_data_params = load_json('scan_params.json')
+	io_dirpaths = load_json('io_dirpaths.json')
+
+	## Set the scenes and stages that will be processed
+	scene_id_patterns = ['*'] # fnmatch patterns of the scene_ids to run. e.g., ['20190209_deer_high_mu/*', '20181105_face/*']
+	stages = ['ingest', 'preprocess', 'irf', 'depth']
+	max_parallel_scenes = 2 # each ingest already uses all cores, so parallel scenes mainly overlap the single-process stages
+	max_mem_gb = 16 # scenes only run in parallel while the sum of their memory estimates fits
+	log_dirpath = os.path.join(io_dirpaths['hist_data_base_dirpath'], 'batch-logs')
+
+	scene_ids = select_scene_ids(scan_data_params['scene_ids'], scene_id_patterns)
+	assert(len(scene_ids) > 0), "No scene_ids match {}".format(scene_id_patterns)
+	print("Running stages {} for {} scenes".format(select_stages(stages), len(scene_ids)))
+	failed_stages = run_scene_jobs(scene_ids, stages, scan_data_params, max_mem=max_mem_gb*1e9, max_parallel=max_parallel_scenes, log_dirpath=log_dirpath)
+	for (scene_id, failed_stage) in failed_stages.items():
+		print("{}: {}".format(scene_id, 'OK' if (failed_stage is None) else 'FAILED at {}'.format(failed_stage)))
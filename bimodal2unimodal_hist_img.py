@@ -24,6 +24,7 @@ from research_utils.io_ops import load_json
 def bimodal2unimodal_crop_inplace(bimodal_hist, unimodal_hist, first_pulse_start_idx, pulse_len, second_pulse_offset):
     '''
         In-place bimodal2unimodal crop operation. Crops second peak from bimodal, and then stitches the two remaining arrays together.
+        unimodal_hist has to be a float array, since it is filled with NaN if the crop fails
     '''
     assert(bimodal_hist.ndim==1), "Only works for 1 dim hist"
     assert(unimodal_hist.ndim==1), "Only works for 1 dim hist"
@@ -54,7 +55,7 @@ def bimodal2unimodal_crop(bimodal_hist, first_pulse_start_idx, pulse_len, second
     nt = bimodal_hist.shape[-1]
     unimodal_nt = nt - pulse_len
     assert(unimodal_nt > 0), "pulse_len cant be larger than nt"
-    unimodal_hist = np.zeros((unimodal_nt,), dtype=bimodal_hist.dtype)
+    unimodal_hist = np.zeros((unimodal_nt,), dtype=np.float64)
     bimodal2unimodal_crop_inplace(bimodal_hist, unimodal_hist, first_pulse_start_idx, pulse_len, second_pulse_offset)
     return unimodal_hist
 
@@ -75,7 +76,7 @@ if __name__=='__main__':
 
     ## Histogram image params
     downsamp_factor = 1 # Spatial downsample factor
-    hist_tbin_factor = 1.0 # increase tbin size to make histogramming faster
+    hist_tbin_factor = 1 # integer. increase tbin size to make histogramming faster
     n_rows_fullres = scan_data_params['scene_params'][scene_id]['n_rows_fullres']
     n_cols_fullres = scan_data_params['scene_params'][scene_id]['n_cols_fullres']
     (nr, nc) = (n_rows_fullres // downsamp_factor, n_cols_fullres // downsamp_factor) # dims for face_scanning scene  
@@ -105,8 +106,9 @@ if __name__=='__main__':
     ## Generate uni-modal hist image    
     pulse_len = time2bin(scan_data_params['irf_params']['pulse_len'], irf_tres)
     second_pulse_offset = time2bin(scan_data_params['irf_params']['second_pulse_offset'], irf_tres)
-    unimodal_hist_img = np.zeros((nr,nc,unimodal_nt)).astype(hist_img.dtype)
-    denoised_hist_img = gaussian_filter(hist_img, sigma=0.75, mode='wrap', truncate=1)
+    # Float, even for integer (narrowed) hist images, so pixels that fail the crop can be marked with NaN
+    unimodal_hist_img = np.zeros((nr,nc,unimodal_nt), dtype=np.float64)
+    denoised_hist_img = gaussian_filter(hist_img.astype(np.float64), sigma=0.75, mode='wrap', truncate=1)
     accurate_shifts = coding_obj.max_peak_decoding(denoised_hist_img, rec_algo_id='matchfilt').squeeze()
     for i in range(nr):
         for j in range(nc):
@@ -0,0 +1,68 @@
+'''
+    This script scans all the raw timestamp files (t3mode_*.out files) of a scan and reports corrupt or partial files.
+    Each file is checked with a single vectorized pass (see calc_t3_record_stats), and the files are checked in parallel.
+    Run it after downloading a scan and before building its histogram image with read_fullscan_hydraharp_t3.py
+'''
+#### Standard Library Imports
+import glob
+import os
+
+#### Library imports
+import numpy as np
+
+#### Local imports
+from read_hydraharp_outfile_t3 import calc_t3_record_stats, get_pool_executor, T3_CHUNK_N_RECS
+from research_utils.io_ops import load_json, write_json
+
+def calc_t3_dir_stats(dirpath, workers=8, use_processes=True, chunk_n_recs=T3_CHUNK_N_RECS):
+    '''
+        Compute calc_t3_record_stats for every t3mode_*.out file in dirpath on a pool of workers.
+        Returns the list of stats sorted by filename
+    '''
+    fpaths = sorted(glob.glob(os.path.join(dirpath, 't3mode_*.out')))
+    with get_pool_executor(workers, use_processes) as executor:
+        return list(executor.map(calc_t3_record_stats, fpaths, [chunk_n_recs]*len(fpaths)))
+
+def get_t3_stats_problems(stats):
+    '''
+        List of human readable problems found in the stats of a single file. Empty if the file looks ok
+    '''
+    problems = []
+    if(stats['n_records'] == 0): problems.append('empty file')
+    if(stats['is_truncated']): problems.append('truncated file ({} trailing bytes)'.format(stats['n_trailing_bytes']))
+    if(stats['n_records'] > 0 and stats['n_photons'] == 0): problems.append('no photon records')
+    if(stats['n_markers'] > 0): problems.append('{} marker records. something wrong with cables?'.format(stats['n_markers']))
+    if(stats['n_unknown_special_records'] > 0): problems.append('{} unknown special records'.format(stats['n_unknown_special_records']))
+    if(not stats['is_sync_sorted']): problems.append('sync numbers are not sorted')
+    return problems
+
+if __name__=='__main__':
+    ## Load parameters shared by all
+    scan_data_params = load_json('scan_params.json')
+    io_dirpaths = load_json('io_dirpaths.json')
+    timestamp_data_base_dirpath = io_dirpaths['timestamp_data_base_dirpath']
+    workers = os.cpu_count()
+
+    ## Set scene that will be checked
+    scene_id = '20190207_face_scanning_low_mu/free'
+    # scene_id = '20190209_deer_high_mu/free'
+    # scene_id = '20181105_face/opt_flux'
+    assert(scene_id in scan_data_params['scene_ids']), "{} not in scene_ids".format(scene_id)
+    dirpath = os.path.join(timestamp_data_base_dirpath, scene_id)
+
+    ## Compute the stats of all files and report the ones with problems
+    stats_list = calc_t3_dir_stats(dirpath, workers=workers)
+    n_problem_files = 0
+    for stats in stats_list:
+        problems = get_t3_stats_problems(stats)
+        if(len(problems) > 0):
+            n_problem_files += 1
+            print("{}: {}".format(stats['fname'], ', '.join(problems)))
+    n_photons = np.array([stats['n_photons'] for stats in stats_list])
+    print("Checked {} files in {}".format(len(stats_list), dirpath))
+    print("    - n files with problems = {}".format(n_problem_files))
+    if(n_photons.size > 0): print("    - n photons per file: min = {}, median = {}, max = {}".format(n_photons.min(), int(np.median(n_photons)), n_photons.max()))
+    ## Save the full report next to the histogram image of the scene
+    hist_dirpath = os.path.join(io_dirpaths['hist_data_base_dirpath'], scene_id)
+    os.makedirs(hist_dirpath, exist_ok=True)
+    write_json(os.path.join(hist_dirpath, 't3-record-stats.json'), {'scene_id': scene_id, 'files': stats_list})
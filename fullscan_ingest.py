@@ -0,0 +1,522 @@
+'''
+    Builds the raw histogram image of a full scan from its raw timestamp files (t3mode_*.out files).
+    Each pixel is histogrammed with the fused decode-to-histogram kernel (outfile_t3_to_histogram), or from the
+    timestamp cache if one is given, in which case runs of pixels with consecutive files are histogrammed in one batched pass
+    over the cache and then written to their (i,j). Pixels are processed on a pool of worker processes that write their histograms
+    straight into memory-mapped .npy output files, so histograms are never pickled back to the parent process,
+    peak memory does not depend on the size of the scan, and the pixels completed before a crash are kept on disk.
+    With hist_crop_bins, each histogram is cropped and circularly shifted (the preprocessing of preprocess_raw_hist_img.py)
+    before it is written, so the preprocessed histogram image is built directly without the full raw image.
+    With prefetch_depth > 0, each worker reads the next prefetch_depth files of its batch of pixels on background I/O threads
+    while it histograms the current one, which hides most of the read latency of slow disks and network filesystems.
+    With spatial_bin_factor = k, the photons of each k x k block of scan points are summed into one histogram as they are
+    decoded, so low-res histogram images are built in a single pass without discarding photons.
+    For low flux scans the raw histogram image can instead be built as a sparse histogram image (see sparse_hist_img.py).
+    Then workers only send back the non-zero bins of each pixel, and the dense image is never allocated.
+'''
+#### Standard Library Imports
+import os
+import re
+import time
+import itertools
+import multiprocessing
+
+#### Library imports
+import numpy as np
+
+#### Local imports
+from read_hydraharp_outfile_t3 import outfile_t3_to_histogram, iter_prefetched_t3_records, T3_CHUNK_N_RECS
+from timestamp_cache import load_timestamp_cache, cached_timestamps2histogram, cached_timestamps2histograms, cached_laser_cycle_stats, get_cached_file_nbytes, get_file_stats
+from scan_data_utils import get_n_hist_bins, crop_shift_histogram, rebin_histogram, convert_hist_img_file_dtype, get_hist_img_fname, HIST_IMG_UINT_DTYPES
+from research_utils.io_ops import load_json, write_json
+from sparse_hist_img import load_hist_img, load_sparse_hist_img, get_sparse_hist_img_parts_dirpath, open_sparse_hist_img_parts, append_sparse_hist_img_pixel, flush_sparse_hist_img_parts, close_sparse_hist_img_parts, assemble_sparse_hist_img
+
+# Per-process state of the ingest workers. Set by init_ingest_worker
+_ingest_worker_state = {}
+
+RAW_HIST_IMG_OUTPUTS = ['raw_hist_img', 'n_laser_cycles_img', 'n_empty_laser_cycles_img']
+# Histograms are ingested as uint32 counts. Once the ingest is complete, narrow_hist_img_file can narrow them further
+RAW_HIST_IMG_OUTPUT_DTYPES = {'raw_hist_img': np.uint32, 'n_laser_cycles_img': np.float64, 'n_empty_laser_cycles_img': np.float64}
+# 'dense': raw_hist_img is a (nr, nc, nt) .npy file. 'sparse': raw_hist_img is a sparse .npz histogram image
+RAW_HIST_IMG_FORMATS = ['dense', 'sparse']
+
+# Values of the per-pixel ingest state bitmap
+PIXEL_TODO = 0
+PIXEL_DONE = 1
+PIXEL_FAILED = 2
+INGEST_STATE_FLUSH_EVERY = 64 # pixels completed between flushes of the ingest state to disk
+# Error of the pixels whose counts do not fit in a narrowed output of a resumed ingest. They are re-run once the outputs are widened
+HIST_DTYPE_OVERFLOW_ERROR = 'histogram counts overflow the output dtype'
+
+def open_output_memmaps(output_fpaths, output_shapes, output_dtypes, resume=False):
+	'''
+		Create a zero-initialized .npy file for each output, and return them as memory-mapped arrays.
+		If resume is True and all the outputs already exist with the right shape and dtype, they are opened in place instead.
+		Histogram images that were narrowed after a finished ingest (see narrow_hist_img_file) are opened with their narrowed dtype,
+		so a few pixels can be patched without rewriting the image. See widen_narrowed_hist_outputs
+		Returns (outputs, is_resumed)
+	'''
+	if(resume and all([os.path.exists(fpath) for fpath in output_fpaths.values()])):
+		outputs = {name: np.load(fpath, mmap_mode='r+') for (name, fpath) in output_fpaths.items()}
+		is_dtype_ok = lambda name: (outputs[name].dtype == output_dtypes[name]) or ((outputs[name].dtype in HIST_IMG_UINT_DTYPES) and (np.dtype(output_dtypes[name]) in HIST_IMG_UINT_DTYPES))
+		if(all([(outputs[name].shape == tuple(output_shapes[name])) and is_dtype_ok(name) for name in outputs.keys()])):
+			return (outputs, True)
+		del outputs
+	outputs = {}
+	for (name, fpath) in output_fpaths.items():
+		outputs[name] = np.lib.format.open_memmap(fpath, mode='w+', dtype=output_dtypes[name], shape=output_shapes[name])
+	return (outputs, False)
+
+def is_narrowed_hist_output(output):
+	return np.dtype(output.dtype).itemsize < np.dtype(RAW_HIST_IMG_OUTPUT_DTYPES['raw_hist_img']).itemsize
+
+def widen_narrowed_hist_outputs(outputs, output_fpaths, hist_output_names):
+	'''
+		Rewrite the narrowed histogram outputs in hist_output_names with the ingest dtype (RAW_HIST_IMG_OUTPUT_DTYPES), and
+		memory map them again in outputs. Only needed when a patched pixel has counts that do not fit in the narrowed dtype
+	'''
+	for name in hist_output_names:
+		if(not is_narrowed_hist_output(outputs[name])): continue
+		outputs[name].flush()
+		del outputs[name]
+		convert_hist_img_file_dtype(output_fpaths[name], RAW_HIST_IMG_OUTPUT_DTYPES['raw_hist_img'])
+		outputs[name] = np.load(output_fpaths[name], mmap_mode='r+')
+	return outputs
+
+def open_ingest_state(state_fpath, shape, resume=False):
+	'''
+		Per-pixel ingest state bitmap (PIXEL_TODO, PIXEL_DONE or PIXEL_FAILED), memory-mapped from state_fpath.
+		If resume is True and the state file exists with the right shape it is opened in place, otherwise all pixels start as PIXEL_TODO.
+		If state_fpath is None the state is only kept in memory.
+	'''
+	if(state_fpath is None): return np.full(shape, PIXEL_TODO, dtype=np.uint8)
+	if(resume and os.path.exists(state_fpath)):
+		ingest_state = np.load(state_fpath, mmap_mode='r+')
+		if(ingest_state.shape == tuple(shape)): return ingest_state
+		del ingest_state
+	return np.lib.format.open_memmap(state_fpath, mode='w+', dtype=np.uint8, shape=shape)
+
+def get_ingest_file_stats_fpath(state_fpath):
+	'''
+		JSON file next to the ingest state with the size and mtime of each .out file when it was last ingested
+	'''
+	return state_fpath.replace('.npy', '_file-stats.json')
+
+def get_ingest_file_stats(fpaths):
+	'''
+		Same as get_file_stats, but missing files get a size and mtime of -1 instead of raising (their pixels fail to ingest)
+	'''
+	(fsizes, mtimes) = ([], [])
+	for fpath in fpaths:
+		(fsize, mtime) = get_file_stats([fpath]) if os.path.exists(fpath) else ([-1], [-1])
+		fsizes.extend(fsize)
+		mtimes.extend(mtime)
+	return (fsizes, mtimes)
+
+def get_changed_files(file_stats_fpath, fpaths, file_stats=None):
+	'''
+		Boolean array that is True for each file in fpaths whose size or mtime differs from the ones recorded in file_stats_fpath
+		at the last ingest (or that was not recorded). All False if there is no record.
+		file_stats: (fsizes, mtimes) of fpaths if they are already known (e.g., from the scan manifest). Otherwise the files are stat'ed
+	'''
+	if(not os.path.exists(file_stats_fpath)): return np.zeros((len(fpaths),), dtype=bool)
+	recorded_file_stats = load_json(file_stats_fpath)
+	recorded_file_stats = {fname: (fsize, mtime) for (fname, fsize, mtime) in zip(recorded_file_stats['fnames'], recorded_file_stats['fsizes'], recorded_file_stats['mtimes'])}
+	(fsizes, mtimes) = get_ingest_file_stats(fpaths) if (file_stats is None) else file_stats
+	return np.array([recorded_file_stats.get(os.path.basename(fpath)) != (fsize, mtime) for (fpath, fsize, mtime) in zip(fpaths, fsizes, mtimes)], dtype=bool)
+
+def mark_changed_pixels_todo(ingest_state, binned_file_indeces, fpaths, file_stats_fpath, file_stats=None):
+	'''
+		Compare the size and mtime of each file in fpaths with the ones recorded in file_stats_fpath at the last ingest, and set
+		the pixels with a changed (or new) file back to PIXEL_TODO, so that only they are re-ingested.
+		If there is no record (e.g., outputs built before file stats were recorded) all files are assumed unchanged.
+		file_stats: see get_changed_files
+		Returns the number of pixels marked
+	'''
+	is_changed_file = get_changed_files(file_stats_fpath, fpaths, file_stats=file_stats)
+	is_changed_pixel = np.logical_and(is_changed_file[binned_file_indeces].any(axis=-1), ingest_state != PIXEL_TODO)
+	ingest_state[is_changed_pixel] = PIXEL_TODO
+	return int(np.count_nonzero(is_changed_pixel))
+
+def write_ingest_file_stats(file_stats_fpath, fpaths, file_stats=None):
+	(fsizes, mtimes) = get_ingest_file_stats(fpaths) if (file_stats is None) else file_stats
+	write_json(file_stats_fpath, {'fnames': [os.path.basename(fpath) for fpath in fpaths], 'fsizes': list(fsizes), 'mtimes': list(mtimes)})
+
+def is_ingest_complete(state_fpath):
+	'''
+		True if the ingest state file does not exist (outputs were not built with a state file) or all its pixels are done
+	'''
+	if(not os.path.exists(state_fpath)): return True
+	return bool(np.all(np.load(state_fpath, mmap_mode='r') == PIXEL_DONE))
+
+def get_binned_file_indeces(file_indeces_img, spatial_bin_factor=1):
+	'''
+		Group the files of each spatial_bin_factor x spatial_bin_factor block of scan points.
+		Returns a (nr // spatial_bin_factor, nc // spatial_bin_factor, spatial_bin_factor**2) image with the file indeces of each block.
+		Same as the downsamp_factor dims of the processing scripts, i.e., scan points in incomplete blocks at the edges are dropped.
+	'''
+	k = spatial_bin_factor
+	(nr, nc) = (file_indeces_img.shape[0] // k, file_indeces_img.shape[1] // k)
+	blocks = file_indeces_img[0:nr*k, 0:nc*k].reshape((nr, k, nc, k)).transpose((0, 2, 1, 3))
+	return blocks.reshape((nr, nc, k*k))
+
+def get_pyramid_output_name(pyramid_tbin_factor):
+	return 'raw_hist_img_tbin-x{}'.format(pyramid_tbin_factor)
+
+def find_hist_img_pyramid_level(hist_dirpath, nr, nc, tlen, tbin_size, fname_prefix='raw-'):
+	'''
+		Find the coarsest histogram image in hist_dirpath (e.g., a level of the pyramid built by read_fullscan_hydraharp_t3.py)
+		whose bin size is at most tbin_size. Images are matched by their get_hist_img_fname name, as .npy or .npz files.
+		Returns (hist_img_fpath, hist_img_tbin_size), or (None, None) if there is no image with fine enough bins
+	'''
+	# Names only differ in their tres, e.g., raw-hist-img_r-{nr}-c-{nc}_tres-{tres}ps_tlen-{tlen}ps.npy
+	(fname_start, fname_end) = (fname_prefix + get_hist_img_fname(nr, nc, 0, tlen)).split('tres-0ps')
+	fname_pattern = re.escape(fname_start) + r'tres-(\d+)ps' + re.escape(fname_end[0:-len('.npy')]) + r'\.np[yz]'
+	(hist_img_fpath, hist_img_tbin_size) = (None, None)
+	for fname in sorted(os.listdir(hist_dirpath)):
+		fname_match = re.fullmatch(fname_pattern, fname)
+		if(fname_match is None): continue
+		tres = int(fname_match.group(1))
+		if((tres <= tbin_size) and ((hist_img_tbin_size is None) or (tres > hist_img_tbin_size))):
+			(hist_img_fpath, hist_img_tbin_size) = (os.path.join(hist_dirpath, fname), tres)
+	return (hist_img_fpath, hist_img_tbin_size)
+
+def load_hist_img_pyramid_level(hist_dirpath, nr, nc, tlen, tbin_size, fname_prefix='raw-', start_bin=0, end_bin=None, dtype=None):
+	'''
+		Load the coarsest histogram image in hist_dirpath with bins of at most tbin_size (see find_hist_img_pyramid_level),
+		so coarse analysis does not read the finest level. Returns (hist_img, hist_img_tbin_size)
+	'''
+	(hist_img_fpath, hist_img_tbin_size) = find_hist_img_pyramid_level(hist_dirpath, nr, nc, tlen, tbin_size, fname_prefix=fname_prefix)
+	assert(hist_img_fpath is not None), "No histogram image in {} with bins of at most {}ps".format(hist_dirpath, tbin_size)
+	return (load_hist_img(hist_img_fpath, start_bin=start_bin, end_bin=end_bin, dtype=dtype), hist_img_tbin_size)
+
+def init_ingest_worker(fpaths, hist_params, output_fpaths, timestamp_cache_dirpath=None, hist_crop_bins=None, prefetch_depth=0, io_workers=2, pyramid_tbin_factors=()):
+	'''
+		Initializer of each ingest worker process.
+		* fpaths: list of .out file paths. Pixels refer to their file by its index in this list
+		* hist_params: dict with the keyword arguments of outfile_t3_to_histogram (max_tbin, min_tbin_size, hist_tbin_factor, max_photons)
+		* output_fpaths: dict mapping each output name to its .npy file. Workers memory map them and write pixels in place
+		* timestamp_cache_dirpath: if given, histograms are built from the timestamp cache of fpaths instead of the .out files
+		* hist_crop_bins: if given, the (start_bin, end_bin, shift_bin) crop window and circular shift applied to each histogram
+		* prefetch_depth, io_workers: number of files read ahead by ingest_pixel_batch, and number of I/O threads reading them
+		* pyramid_tbin_factors: sorted tbin factors (relative to hist_params['hist_tbin_factor']) of the coarser histogram images
+		written to the get_pyramid_output_name outputs
+		If output_fpaths has no 'raw_hist_img', the non-zero bins of each histogram are returned instead of written (sparse output)
+	'''
+	_ingest_worker_state['fpaths'] = fpaths
+	_ingest_worker_state['hist_params'] = hist_params
+	_ingest_worker_state['hist_crop_bins'] = hist_crop_bins
+	_ingest_worker_state['prefetch_depth'] = prefetch_depth
+	_ingest_worker_state['io_workers'] = io_workers
+	_ingest_worker_state['pyramid_tbin_factors'] = pyramid_tbin_factors
+	_ingest_worker_state['outputs'] = {name: np.load(fpath, mmap_mode='r+') for (name, fpath) in output_fpaths.items()}
+	if(timestamp_cache_dirpath is None): _ingest_worker_state['timestamp_cache'] = None
+	else: _ingest_worker_state['timestamp_cache'] = load_timestamp_cache(timestamp_cache_dirpath)
+
+def init_pixel_stats():
+	return {'latency': 0., 'decode_time': 0., 'cpu_time': 0., 'io_wait': 0., 'n_photons': 0, 'n_bytes': 0, 'worker_pid': os.getpid()}
+
+def ingest_pixel(pixel_task, file_records=None):
+	'''
+		Histogram the files of pixel (i,j) and write the outputs into the memory-mapped output images.
+		pixel_task is (i, j, file_idxs). The histograms and laser cycle counts of all the files in file_idxs are summed.
+		file_records: optional list with the records of each file in file_idxs that were already read (see ingest_pixel_batch).
+		Files with None records were too large to prefetch and are streamed from disk
+		Returns (pixel_task, error, sparse_bins, pixel_stats). error is None if the pixel was ingested, otherwise it describes the exception raised.
+		sparse_bins is None for dense outputs, otherwise it is the (indices, counts) of the non-zero bins of the histogram.
+		pixel_stats is the dict of telemetry stats of the pixel (see ingest_telemetry.py)
+	'''
+	(i, j, file_idxs) = pixel_task
+	hist_params = _ingest_worker_state['hist_params']
+	timestamp_cache = _ingest_worker_state['timestamp_cache']
+	(counts, n_laser_cycles, n_empty_laser_cycles) = (0, 0, 0)
+	pixel_stats = init_pixel_stats()
+	(start_time, start_cpu_time) = (time.time(), time.process_time())
+	try:
+		for (k, file_idx) in enumerate(file_idxs):
+			records = file_records[k] if (file_records is not None) else None
+			if(isinstance(records, Exception)): raise records
+			if(records is not None):
+				pixel_stats['n_bytes'] += records.nbytes
+				file_outputs = outfile_t3_to_histogram(records, **hist_params)
+			elif(timestamp_cache is None):
+				pixel_stats['n_bytes'] += os.path.getsize(_ingest_worker_state['fpaths'][file_idx])
+				file_outputs = outfile_t3_to_histogram(_ingest_worker_state['fpaths'][file_idx], **hist_params)
+			else:
+				pixel_stats['n_bytes'] += get_cached_file_nbytes(timestamp_cache, file_idx)
+				file_outputs = cached_timestamps2histogram(timestamp_cache, file_idx, **hist_params)
+			counts = counts + file_outputs[0]
+			n_laser_cycles += file_outputs[1]
+			n_empty_laser_cycles += file_outputs[2]
+	except Exception as e:
+		(pixel_stats['latency'], pixel_stats['cpu_time']) = (time.time() - start_time, time.process_time() - start_cpu_time)
+		pixel_stats['decode_time'] = pixel_stats['latency']
+		return (pixel_task, repr(e), None, pixel_stats)
+	# Wall time decoding and histogramming the files. Reads of files that were not prefetched are part of it
+	pixel_stats['decode_time'] = time.time() - start_time
+	pixel_stats['n_photons'] = int(np.sum(counts))
+	(error, sparse_bins) = write_pixel_outputs(pixel_task, counts, n_laser_cycles, n_empty_laser_cycles)
+	(pixel_stats['latency'], pixel_stats['cpu_time']) = (time.time() - start_time, time.process_time() - start_cpu_time)
+	return (pixel_task, error, sparse_bins, pixel_stats)
+
+def write_pixel_outputs(pixel_task, counts, n_laser_cycles, n_empty_laser_cycles):
+	'''
+		Crop the histogram of pixel (i,j), and write it, its pyramid levels and its laser cycle counts into the memory-mapped outputs.
+		Returns (error, sparse_bins) as in ingest_pixel. error is HIST_DTYPE_OVERFLOW_ERROR (and nothing is written) if the
+		counts do not fit in a narrowed output
+	'''
+	(i, j, _) = pixel_task
+	if(_ingest_worker_state['hist_crop_bins'] is not None): counts = crop_shift_histogram(counts, _ingest_worker_state['hist_crop_bins'])
+	outputs = _ingest_worker_state['outputs']
+	hist_outputs = []
+	if('raw_hist_img' in outputs):
+		hist_outputs.append(('raw_hist_img', counts))
+		# Each pyramid level sums adjacent bins of the previous one
+		(level_counts, level_tbin_factor) = (counts, 1)
+		for pyramid_tbin_factor in _ingest_worker_state['pyramid_tbin_factors']:
+			(level_counts, level_tbin_factor) = (rebin_histogram(level_counts, pyramid_tbin_factor // level_tbin_factor), pyramid_tbin_factor)
+			hist_outputs.append((get_pyramid_output_name(pyramid_tbin_factor), level_counts))
+	# Narrowed outputs of a resumed ingest are patched in place, unless the counts of the pixel do not fit in them
+	for (name, level_counts) in hist_outputs:
+		if(is_narrowed_hist_output(outputs[name]) and (level_counts.size > 0) and (level_counts.max() > np.iinfo(outputs[name].dtype).max)):
+			return (HIST_DTYPE_OVERFLOW_ERROR, None)
+	outputs['n_laser_cycles_img'][i,j] = n_laser_cycles
+	outputs['n_empty_laser_cycles_img'][i,j] = n_empty_laser_cycles
+	for (name, level_counts) in hist_outputs: outputs[name][i,j,:] = level_counts
+	sparse_bins = None
+	if('raw_hist_img' not in outputs):
+		indices = np.flatnonzero(counts)
+		sparse_bins = (indices, counts[indices])
+	return (None, sparse_bins)
+
+def ingest_pixel_batch(pixel_tasks):
+	'''
+		ingest_pixel for a batch of pixels. The files of the batch are read in order on background I/O threads, at most
+		prefetch_depth files ahead of the one being histogrammed. Returns the list of ingest_pixel outputs.
+		Only files of up to T3_CHUNK_N_RECS records are prefetched, and with a max_photons budget only files of up to max_photons
+		records (which are read in full anyway). Larger files are streamed in chunks, which stops reading at the photon budget
+	'''
+	fpaths = _ingest_worker_state['fpaths']
+	max_photons = _ingest_worker_state['hist_params']['max_photons']
+	max_file_n_recs = T3_CHUNK_N_RECS if (max_photons is None) else min(T3_CHUNK_N_RECS, max_photons)
+	batch_fpaths = [fpaths[file_idx] for (_, _, file_idxs) in pixel_tasks for file_idx in file_idxs]
+	prefetched_records = iter_prefetched_t3_records(batch_fpaths, prefetch_depth=_ingest_worker_state['prefetch_depth'], io_workers=_ingest_worker_state['io_workers'], max_file_n_recs=max_file_n_recs)
+	results = []
+	for pixel_task in pixel_tasks:
+		io_wait_start_time = time.time()
+		file_records = [next(prefetched_records)[1] for _ in pixel_task[2]]
+		io_wait = time.time() - io_wait_start_time
+		results.append(ingest_pixel(pixel_task, file_records))
+		# Time blocked on the I/O threads counts as part of the pixel latency
+		results[-1][3]['io_wait'] = io_wait
+		results[-1][3]['latency'] += io_wait
+	prefetched_records.close()
+	return results
+
+def ingest_cached_pixel_batch(pixel_tasks):
+	'''
+		ingest_pixel for a batch of single-file pixels whose files are consecutive in the timestamp cache (see get_cached_pixel_batches).
+		The histograms and laser cycle counts of all the files are computed in one batched pass over the cache (see
+		cached_timestamps2histograms), and then written to the (i,j) of each pixel, since the cache is in scan order, not image order.
+		Files with more photons than the max_photons budget are histogrammed on their own. The time of the batched pass is split
+		evenly between the pixels in their telemetry stats. Returns the list of ingest_pixel outputs
+	'''
+	timestamp_cache = _ingest_worker_state['timestamp_cache']
+	hist_params = _ingest_worker_state['hist_params']
+	(start_time, start_cpu_time) = (time.time(), time.process_time())
+	(start_file_idx, end_file_idx) = (pixel_tasks[0][2][0], pixel_tasks[-1][2][0] + 1)
+	try:
+		hists = cached_timestamps2histograms(timestamp_cache, start_file_idx, end_file_idx, max_tbin=hist_params['max_tbin'], min_tbin_size=hist_params['min_tbin_size'], hist_tbin_factor=hist_params['hist_tbin_factor'])
+		(n_laser_cycles, n_empty_laser_cycles) = cached_laser_cycle_stats(timestamp_cache, start_file_idx, end_file_idx)
+		if(hist_params['max_photons'] is not None):
+			n_file_photons = np.diff(timestamp_cache['offsets'][start_file_idx:end_file_idx+1])
+			for k in np.flatnonzero(n_file_photons > hist_params['max_photons']):
+				(hists[k], n_laser_cycles[k], n_empty_laser_cycles[k]) = cached_timestamps2histogram(timestamp_cache, start_file_idx + k, **hist_params)
+		error = None
+	except Exception as e:
+		error = repr(e)
+	(decode_time, decode_cpu_time) = ((time.time() - start_time) / len(pixel_tasks), (time.process_time() - start_cpu_time) / len(pixel_tasks))
+	results = []
+	for (k, pixel_task) in enumerate(pixel_tasks):
+		pixel_stats = init_pixel_stats()
+		(pixel_stats['decode_time'], pixel_stats['n_bytes']) = (decode_time, get_cached_file_nbytes(timestamp_cache, pixel_task[2][0]))
+		(write_start_time, write_start_cpu_time) = (time.time(), time.process_time())
+		if(error is None):
+			pixel_stats['n_photons'] = int(hists[k].sum())
+			(pixel_error, sparse_bins) = write_pixel_outputs(pixel_task, hists[k], int(n_laser_cycles[k]), int(n_empty_laser_cycles[k]))
+		else: (pixel_error, sparse_bins) = (error, None)
+		pixel_stats['latency'] = decode_time + time.time() - write_start_time
+		pixel_stats['cpu_time'] = decode_cpu_time + time.process_time() - write_start_cpu_time
+		results.append((pixel_task, pixel_error, sparse_bins, pixel_stats))
+	return results
+
+def get_cached_pixel_batches(pixel_tasks, chunksize=16):
+	'''
+		Group single-file pixel tasks into batches of up to chunksize pixels whose files are consecutive in the scan, and so in the
+		timestamp cache. Pixels that are consecutive in the image usually are not (see vector2img), so the tasks are sorted by file index
+	'''
+	batches = []
+	for pixel_task in sorted(pixel_tasks, key=lambda pixel_task: pixel_task[2][0]):
+		if((len(batches) > 0) and (len(batches[-1]) < chunksize) and (pixel_task[2][0] == (batches[-1][-1][2][0] + 1))): batches[-1].append(pixel_task)
+		else: batches.append([pixel_task])
+	return batches
+
+def start_ingest_workers(pixel_tasks, workers, initargs, ingest_mode='pixel', chunksize=16):
+	'''
+		Start ingesting pixel_tasks with init_ingest_worker(*initargs) workers. If workers is 1 pixels are ingested in the calling process.
+		ingest_mode is one of:
+		* 'pixel': each pixel is ingested by ingest_pixel
+		* 'prefetch': pixels are sent to ingest_pixel_batch in batches of chunksize pixels
+		* 'cached': single-file pixels are sent to ingest_cached_pixel_batch in batches of consecutive files (see get_cached_pixel_batches)
+		Returns (pool, results), where pool is None for a single worker and results iterates over the ingest_pixel outputs as they complete
+	'''
+	if(ingest_mode == 'prefetch'): (ingest_func, ingest_tasks, ingest_chunksize) = (ingest_pixel_batch, [pixel_tasks[k:k+chunksize] for k in range(0, len(pixel_tasks), chunksize)], 1)
+	elif(ingest_mode == 'cached'): (ingest_func, ingest_tasks, ingest_chunksize) = (ingest_cached_pixel_batch, get_cached_pixel_batches(pixel_tasks, chunksize), 1)
+	else: (ingest_func, ingest_tasks, ingest_chunksize) = (ingest_pixel, pixel_tasks, chunksize)
+	if(workers <= 1):
+		init_ingest_worker(*initargs)
+		(pool, results) = (None, map(ingest_func, ingest_tasks))
+	else:
+		pool = multiprocessing.Pool(workers, initializer=init_ingest_worker, initargs=initargs)
+		results = pool.imap_unordered(ingest_func, ingest_tasks, chunksize=ingest_chunksize)
+	if(ingest_mode != 'pixel'): results = itertools.chain.from_iterable(results)
+	return (pool, results)
+
+def build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, max_tbin, min_tbin_size, hist_tbin_factor=1, max_photons=None, workers=1, timestamp_cache_dirpath=None, state_fpath=None, resume=False, retry_failed=False, check_changed_files=True, output_format='dense', hist_crop_bins=None, spatial_bin_factor=1, prefetch_depth=0, io_workers=2, pyramid_fpaths=None, file_stats=None, chunksize=16, telemetry=None):
+	'''
+		Build the raw histogram image of a scan on a pool of worker processes.
+		Inputs:
+			* fpaths: list of .out file paths of the scan
+			* file_indeces_img: (nr, nc) image with the index in fpaths of the file of each scan point
+			* output_fpaths: dict with the .npy output file of each of RAW_HIST_IMG_OUTPUTS
+			* max_tbin, min_tbin_size, hist_tbin_factor, max_photons: histogram parameters. See outfile_t3_to_histogram
+			* workers: number of worker processes. If 1 pixels are processed in the calling process
+			* timestamp_cache_dirpath: build the histograms from this timestamp cache instead of the .out files
+			* state_fpath: .npy file with the per-pixel completion bitmap that is kept next to the outputs
+			* resume: continue a previous (interrupted) ingest from its state file and partial outputs, only ingesting unfinished pixels
+			* retry_failed: when resuming, also re-run the pixels that failed
+			* check_changed_files: when resuming, also re-run the pixels whose .out files changed (size or mtime) since they were ingested.
+			Their pixels are patched in place, so re-ingesting a few re-captured files of a finished scan only decodes those files
+			* file_stats: (fsizes, mtimes) of fpaths (e.g., get_manifest_file_stats of the scan manifest), so the files do not need to be
+			stat'ed again to detect changes and record the stats of this ingest. If None the files are stat'ed
+			* output_format: one of RAW_HIST_IMG_FORMATS. For 'sparse' the raw_hist_img output file has to be a .npz file
+			* hist_crop_bins: (start_bin, end_bin, shift_bin) to crop and circularly shift each histogram before it is written. See get_hist_crop_bins
+			* prefetch_depth: if > 0, pixels are ingested in batches of chunksize pixels, and each worker reads up to prefetch_depth files
+			of its batch ahead on io_workers background threads. Each worker holds at most prefetch_depth + 1 files in memory, of at most
+			T3_CHUNK_N_RECS records (and max_photons records) each. Larger files are streamed
+			* spatial_bin_factor: sum each spatial_bin_factor x spatial_bin_factor block of scan points into one pixel. See get_binned_file_indeces
+			* pyramid_fpaths: optional dict mapping tbin factors k (relative to hist_tbin_factor) to .npy files. Each one gets the dense
+			raw histogram image with k times larger bins, built from the same decode by summing adjacent bins. Each k has to be a multiple of the previous one
+			* telemetry: optional IngestTelemetry that collects the throughput and latency stats of the ingested pixels
+		Outputs:
+			* (raw_hist_img, n_laser_cycles_img, n_empty_laser_cycles_img) memory-mapped from output_fpaths.
+			For sparse outputs raw_hist_img is the sparse histogram image, or None if some pixels failed
+	'''
+	for (pixel_task, outputs) in iter_build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, max_tbin, min_tbin_size, hist_tbin_factor=hist_tbin_factor, max_photons=max_photons, workers=workers, timestamp_cache_dirpath=timestamp_cache_dirpath, state_fpath=state_fpath, resume=resume, retry_failed=retry_failed, check_changed_files=check_changed_files, output_format=output_format, hist_crop_bins=hist_crop_bins, spatial_bin_factor=spatial_bin_factor, prefetch_depth=prefetch_depth, io_workers=io_workers, pyramid_fpaths=pyramid_fpaths, file_stats=file_stats, chunksize=chunksize, telemetry=telemetry):
+		pass
+	outputs = {name: np.load(fpath, mmap_mode='r+') for (name, fpath) in output_fpaths.items() if (name != 'raw_hist_img')}
+	if(output_format == 'dense'): outputs['raw_hist_img'] = np.load(output_fpaths['raw_hist_img'], mmap_mode='r+')
+	elif(os.path.exists(output_fpaths['raw_hist_img'])): outputs['raw_hist_img'] = load_sparse_hist_img(output_fpaths['raw_hist_img'])
+	else: outputs['raw_hist_img'] = None
+	return (outputs['raw_hist_img'], outputs['n_laser_cycles_img'], outputs['n_empty_laser_cycles_img'])
+
+def iter_build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, max_tbin, min_tbin_size, hist_tbin_factor=1, max_photons=None, workers=1, timestamp_cache_dirpath=None, state_fpath=None, resume=False, retry_failed=False, check_changed_files=True, output_format='dense', hist_crop_bins=None, spatial_bin_factor=1, prefetch_depth=0, io_workers=2, pyramid_fpaths=None, file_stats=None, chunksize=16, telemetry=None):
+	'''
+		Generator version of build_raw_hist_img. Yields ((i,j,file_idxs), outputs) every time a pixel is completed,
+		where outputs is the dict of memory-mapped output images that are being filled.
+		Pixels are ingested in row-major order starting from the first unfinished one. The ingest state of each pixel is
+		updated as it completes, so an interrupted ingest can be resumed from state_fpath.
+		For sparse outputs, outputs does not hold raw_hist_img. The sparse histogram image is only written to
+		output_fpaths['raw_hist_img'] once all pixels are done.
+		If telemetry (an IngestTelemetry) is given, the stats of every completed pixel are added to it.
+	'''
+	assert(set(output_fpaths.keys()) == set(RAW_HIST_IMG_OUTPUTS)), "output_fpaths needs a file for each of {}".format(RAW_HIST_IMG_OUTPUTS)
+	assert(output_format in RAW_HIST_IMG_FORMATS), "output_format should be one of {}".format(RAW_HIST_IMG_FORMATS)
+	is_sparse = (output_format == 'sparse')
+	assert((not is_sparse) or output_fpaths['raw_hist_img'].endswith('.npz')), "sparse raw_hist_img should be saved as a .npz file"
+	binned_file_indeces = get_binned_file_indeces(file_indeces_img, spatial_bin_factor)
+	(nr, nc) = binned_file_indeces.shape[0:2]
+	n_hist_bins = get_n_hist_bins(max_tbin, min_tbin_size, hist_tbin_factor)
+	if(hist_crop_bins is not None): n_hist_bins = len(range(n_hist_bins)[hist_crop_bins[0]:hist_crop_bins[1]])
+	hist_params = {'max_tbin': max_tbin, 'min_tbin_size': min_tbin_size, 'hist_tbin_factor': hist_tbin_factor, 'max_photons': max_photons}
+	output_shapes = {'raw_hist_img': (nr, nc, n_hist_bins), 'n_laser_cycles_img': (nr, nc), 'n_empty_laser_cycles_img': (nr, nc)}
+	# Only resume if there is a state file to know which pixels are done
+	resume = resume and (state_fpath is not None) and os.path.exists(state_fpath)
+	output_dtypes = dict(RAW_HIST_IMG_OUTPUT_DTYPES)
+	pyramid_fpaths = {int(factor): fpath for (factor, fpath) in pyramid_fpaths.items()} if (pyramid_fpaths is not None) else {}
+	pyramid_tbin_factors = sorted(pyramid_fpaths.keys())
+	if(len(pyramid_tbin_factors) > 0):
+		assert((not is_sparse) and (hist_crop_bins is None)), "histogram pyramids are only built for dense raw histogram images without cropping"
+		for (prev_tbin_factor, pyramid_tbin_factor) in zip([1] + pyramid_tbin_factors[0:-1], pyramid_tbin_factors):
+			assert((pyramid_tbin_factor > prev_tbin_factor) and ((pyramid_tbin_factor % prev_tbin_factor) == 0)), "each pyramid tbin factor should be a multiple of the previous one"
+		output_fpaths = dict(output_fpaths)
+		for pyramid_tbin_factor in pyramid_tbin_factors:
+			name = get_pyramid_output_name(pyramid_tbin_factor)
+			output_fpaths[name] = pyramid_fpaths[pyramid_tbin_factor]
+			output_shapes[name] = (nr, nc, -(-n_hist_bins // pyramid_tbin_factor))
+			output_dtypes[name] = RAW_HIST_IMG_OUTPUT_DTYPES['raw_hist_img']
+	if(is_sparse):
+		# The dense raw_hist_img is replaced by the parts of the sparse one, which are only assembled when the ingest is complete
+		sparse_hist_img_fpath = output_fpaths['raw_hist_img']
+		sparse_parts_dirpath = get_sparse_hist_img_parts_dirpath(sparse_hist_img_fpath)
+		(sparse_parts, resume) = open_sparse_hist_img_parts(sparse_parts_dirpath, output_shapes.pop('raw_hist_img'), resume=resume)
+		if((not resume) and os.path.exists(sparse_hist_img_fpath)): os.remove(sparse_hist_img_fpath)
+		output_fpaths = {name: fpath for (name, fpath) in output_fpaths.items() if (name != 'raw_hist_img')}
+	(outputs, is_resumed) = open_output_memmaps(output_fpaths, output_shapes, output_dtypes, resume=resume)
+	ingest_state = open_ingest_state(state_fpath, (nr, nc), resume=is_resumed)
+	if(retry_failed): ingest_state[ingest_state == PIXEL_FAILED] = PIXEL_TODO
+	if(state_fpath is not None):
+		file_stats_fpath = get_ingest_file_stats_fpath(state_fpath)
+		if(is_resumed and check_changed_files):
+			n_changed_pixels = mark_changed_pixels_todo(ingest_state, binned_file_indeces, fpaths, file_stats_fpath, file_stats=file_stats)
+			if(n_changed_pixels > 0): print("Re-ingesting {} pixels whose files changed".format(n_changed_pixels))
+		# Recorded before decoding, so files that change during the ingest are detected next time
+		write_ingest_file_stats(file_stats_fpath, fpaths, file_stats=file_stats)
+	(todo_rows, todo_cols) = np.nonzero(ingest_state == PIXEL_TODO)
+	pixel_tasks = [(int(i), int(j), tuple(int(file_idx) for file_idx in binned_file_indeces[i,j])) for (i, j) in zip(todo_rows, todo_cols)]
+	if(is_resumed): print("Resuming ingest: {} of {} pixels left".format(len(pixel_tasks), nr*nc))
+	if(telemetry is not None): telemetry.start(len(pixel_tasks), workers=max(workers, 1))
+	initargs = (fpaths, hist_params, output_fpaths, timestamp_cache_dirpath, hist_crop_bins, prefetch_depth, io_workers, pyramid_tbin_factors)
+	# The timestamp cache is already memory-mapped, so there is nothing to prefetch. Instead, pixels of one file are histogrammed in batches
+	if(timestamp_cache_dirpath is not None): ingest_mode = 'cached' if (spatial_bin_factor == 1) else 'pixel'
+	else: ingest_mode = 'prefetch' if (prefetch_depth > 0) else 'pixel'
+	hist_output_names = [name for name in outputs.keys() if (name == 'raw_hist_img') or (name in [get_pyramid_output_name(k) for k in pyramid_tbin_factors])]
+	(pool, n_completed) = (None, 0)
+	try:
+		while(len(pixel_tasks) > 0):
+			(pool, results) = start_ingest_workers(pixel_tasks, workers, initargs, ingest_mode=ingest_mode, chunksize=chunksize)
+			overflowed_pixel_tasks = []
+			for (pixel_task, error, sparse_bins, pixel_stats) in results:
+				(i, j, file_idxs) = pixel_task
+				if(error == HIST_DTYPE_OVERFLOW_ERROR):
+					overflowed_pixel_tasks.append(pixel_task)
+					continue
+				if(telemetry is not None): telemetry.add_pixel(pixel_task, pixel_stats, failed=(error is not None))
+				if(error is None):
+					if(is_sparse): append_sparse_hist_img_pixel(sparse_parts, i, j, *sparse_bins)
+					ingest_state[i,j] = PIXEL_DONE
+				else:
+					ingest_state[i,j] = PIXEL_FAILED
+					print("Failed to ingest pixel ({},{}) from {}: {}".format(i, j, [fpaths[file_idx] for file_idx in file_idxs], error))
+				n_completed += 1
+				if((n_completed % INGEST_STATE_FLUSH_EVERY) == 0):
+					for output in outputs.values(): output.flush()
+					if(is_sparse): flush_sparse_hist_img_parts(sparse_parts)
+					if(isinstance(ingest_state, np.memmap)): ingest_state.flush()
+				yield (pixel_task, outputs)
+			if(pool is not None): pool.terminate()
+			pool = None
+			# Only widen the narrowed outputs if a patched pixel does not fit in them, then re-run those pixels
+			if(len(overflowed_pixel_tasks) > 0):
+				print("Widening the histogram outputs for {} pixels whose counts do not fit in their dtype".format(len(overflowed_pixel_tasks)))
+				widen_narrowed_hist_outputs(outputs, output_fpaths, hist_output_names)
+			pixel_tasks = overflowed_pixel_tasks
+	finally:
+		if(pool is not None): pool.terminate()
+		for output in outputs.values(): output.flush()
+		if(is_sparse): close_sparse_hist_img_parts(sparse_parts)
+		if(isinstance(ingest_state, np.memmap)): ingest_state.flush()
+	# Only reached if the ingest was not interrupted
+	if(is_sparse and np.all(ingest_state == PIXEL_DONE)):
+		del sparse_parts
+		assemble_sparse_hist_img(sparse_parts_dirpath, sparse_hist_img_fpath)
@@ -0,0 +1,119 @@
+'''
+	Throughput and progress telemetry of the full-scan ingest (see fullscan_ingest.py).
+	Every ingested pixel reports its stats (see ingest_pixel): wall time (latency), the part of it spent decoding and
+	histogramming its files (decode_time) and waiting for prefetched files (io_wait), CPU time, photons binned, and bytes read.
+	IngestTelemetry accumulates them and reports:
+	* photons/s and MB/s of the whole ingest
+	* percentiles of the per-pixel latency, decode time, and I/O wait, and the slowest pixels
+	* worker utilization (CPU time / (elapsed time * workers))
+	* cpu_fraction and io_wait_fraction of the busy (wall) time
+	Low utilization with a high io_wait_fraction (or a decode time much larger than its CPU time) means the ingest is bound
+	by the disk. High utilization means it is CPU bound. A slowest pixel that takes a large part of the elapsed time points to a giant file.
+'''
+#### Standard Library Imports
+import time
+
+#### Library imports
+import numpy as np
+
+#### Local imports
+from research_utils.io_ops import write_json
+
+PIXEL_LATENCY_PERCENTILES = [50, 90, 95, 99]
+N_SLOWEST_PIXELS = 5
+
+def format_duration(seconds):
+	(minutes, seconds) = divmod(int(round(seconds)), 60)
+	(hours, minutes) = divmod(minutes, 60)
+	return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+class IngestTelemetry(object):
+	def __init__(self, progress_period=10.0):
+		'''
+			progress_period: minimum number of seconds between two progress lines printed by print_progress
+		'''
+		self.progress_period = progress_period
+		self.start(0)
+
+	def start(self, n_pixels, workers=1):
+		'''
+			Reset the telemetry for an ingest of n_pixels pixels on workers processes. Called by iter_build_raw_hist_img before the first pixel
+		'''
+		self.n_pixels = n_pixels
+		self.workers = workers
+		self.n_failed = 0
+		self.pixel_stats = []
+		self.pixel_coords = []
+		self.start_time = time.time()
+		self.last_update_time = self.start_time
+		self.last_progress_time = None
+
+	def add_pixel(self, pixel_task, pixel_stats, failed=False):
+		self.pixel_coords.append(pixel_task[0:2])
+		self.pixel_stats.append(pixel_stats)
+		self.n_failed += int(failed)
+		self.last_update_time = time.time()
+
+	def get_metrics(self):
+		'''
+			Dict with the throughput, latency, and utilization metrics of the pixels ingested so far
+		'''
+		n_done = len(self.pixel_stats)
+		elapsed = max(self.last_update_time - self.start_time, 1e-9)
+		stat_arrays = {key: np.array([stats[key] for stats in self.pixel_stats], dtype=np.float64) for key in ['latency', 'decode_time', 'cpu_time', 'io_wait', 'n_photons', 'n_bytes']}
+		busy_time = stat_arrays['latency'].sum()
+		(worker_busy_times, worker_cpu_times) = ({}, {})
+		for stats in self.pixel_stats:
+			worker_busy_times[str(stats['worker_pid'])] = worker_busy_times.get(str(stats['worker_pid']), 0.) + stats['latency']
+			worker_cpu_times[str(stats['worker_pid'])] = worker_cpu_times.get(str(stats['worker_pid']), 0.) + stats['cpu_time']
+		metrics = {
+			'n_pixels': self.n_pixels
+			, 'n_done': n_done
+			, 'n_failed': self.n_failed
+			, 'elapsed': elapsed
+			, 'eta': (self.n_pixels - n_done)*elapsed / n_done if (n_done > 0) else None
+			, 'n_photons': int(stat_arrays['n_photons'].sum())
+			, 'n_bytes': int(stat_arrays['n_bytes'].sum())
+			, 'photons_per_sec': stat_arrays['n_photons'].sum() / elapsed
+			, 'mb_per_sec': stat_arrays['n_bytes'].sum() / elapsed / 1e6
+			# From CPU time, so workers blocked on I/O do not count as busy
+			, 'worker_utilization': stat_arrays['cpu_time'].sum() / (elapsed*self.workers)
+			, 'worker_busy_times': worker_busy_times
+			, 'worker_cpu_times': worker_cpu_times
+			, 'cpu_fraction': stat_arrays['cpu_time'].sum() / busy_time if (busy_time > 0) else None
+			, 'io_wait_fraction': stat_arrays['io_wait'].sum() / busy_time if (busy_time > 0) else None
+		}
+		for (metric, key) in [('pixel_latency', 'latency'), ('pixel_decode_time', 'decode_time'), ('pixel_io_wait', 'io_wait')]:
+			metrics[metric] = {'mean': None, 'max': None}
+			metrics[metric].update({'p{}'.format(p): None for p in PIXEL_LATENCY_PERCENTILES})
+			if(n_done == 0): continue
+			metrics[metric]['mean'] = float(stat_arrays[key].mean())
+			metrics[metric]['max'] = float(stat_arrays[key].max())
+			for (p, val) in zip(PIXEL_LATENCY_PERCENTILES, np.percentile(stat_arrays[key], PIXEL_LATENCY_PERCENTILES)):
+				metrics[metric]['p{}'.format(p)] = float(val)
+		slowest_idxs = np.argsort(-stat_arrays['latency'], kind='stable')[0:N_SLOWEST_PIXELS]
+		metrics['slowest_pixels'] = [{'pixel': list(self.pixel_coords[k]), 'latency': float(stat_arrays['latency'][k]), 'decode_time': float(stat_arrays['decode_time'][k]), 'io_wait': float(stat_arrays['io_wait'][k]), 'n_bytes': int(stat_arrays['n_bytes'][k]), 'n_photons': int(stat_arrays['n_photons'][k])} for k in slowest_idxs]
+		return metrics
+
+	def format_progress(self):
+		metrics = self.get_metrics()
+		progress_str = 'Ingest: {}/{} pixels ({:.1f}%)'.format(metrics['n_done'], metrics['n_pixels'], 100.*metrics['n_done'] / max(metrics['n_pixels'], 1))
+		if(metrics['n_failed'] > 0): progress_str += ', {} failed'.format(metrics['n_failed'])
+		progress_str += ' | {:.3g} photons/s | {:.1f} MB/s'.format(metrics['photons_per_sec'], metrics['mb_per_sec'])
+		if(metrics['n_done'] > 0):
+			progress_str += ' | pixel latency p50 {:.1f} ms, p95 {:.1f} ms'.format(1e3*metrics['pixel_latency']['p50'], 1e3*metrics['pixel_latency']['p95'])
+			progress_str += ' | decode p50 {:.1f} ms, io wait p50 {:.1f} ms'.format(1e3*metrics['pixel_decode_time']['p50'], 1e3*metrics['pixel_io_wait']['p50'])
+			progress_str += ' | workers {:.0f}% CPU | ETA {}'.format(100.*metrics['worker_utilization'], format_duration(metrics['eta']))
+		return progress_str
+
+	def print_progress(self, force=False):
+		'''
+			Print a progress line if progress_period seconds passed since the last one (or if force is True)
+		'''
+		curr_time = time.time()
+		if((not force) and (self.last_progress_time is not None) and ((curr_time - self.last_progress_time) < self.progress_period)): return
+		self.last_progress_time = curr_time
+		print(self.format_progress())
+
+	def save(self, metrics_fpath):
+		write_json(metrics_fpath, self.get_metrics())
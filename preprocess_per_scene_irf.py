@@ -51,6 +51,8 @@ if __name__=='__main__':
     scene_id = '20181105_face/low_flux'
     scene_id = '20181105_face/opt_flux'
 
+    # The scene can also be passed as the first argument (e.g., by batch_runner.py)
+    if(len(sys.argv) > 1): scene_id = sys.argv[1]
     assert(scene_id in scan_data_params['scene_ids']), "{} not in scene_ids".format(scene_id)
     hist_dirpath = os.path.join(hist_img_base_dirpath, scene_id)
 
@@ -72,11 +74,11 @@ if __name__=='__main__':
     (nr,nc,nt) = hist_img.shape
     (tbins, tbin_edges) = get_hist_bins(hist_img_tau, irf_tres)
 
-    ## Apply denoising
+    ## Apply denoising. hist_img holds integer counts, so filter in float
     if('ext_5%' in scene_id):
-        d_hist_img = gaussian_filter(hist_img, sigma=0.1, mode='wrap', truncate=3)
+        d_hist_img = gaussian_filter(hist_img.astype(np.float64), sigma=0.1, mode='wrap', truncate=3)
     else:
-        d_hist_img = gaussian_filter(hist_img, sigma=1, mode='wrap', truncate=3)
+        d_hist_img = gaussian_filter(hist_img.astype(np.float64), sigma=1, mode='wrap', truncate=3)
     min_signal_threshold=1.0
 
     if('20190207_face_scanning_low_mu' in scene_id):
@@ -9,6 +9,7 @@
 '''
 #### Standard Library Imports
 import os
+import sys
 
 #### Library imports
 import numpy as np
@@ -18,6 +19,7 @@ breakpoint = debugger.set_trace
 
 #### Local imports
 from scan_data_utils import *
+from sparse_hist_img import load_hist_img
 from research_utils.plot_utils import *
 from research_utils.io_ops import load_json
 
@@ -45,6 +47,8 @@ if __name__=='__main__':
     # scene_id = '20181105_face/low_flux'
     scene_id = '20181105_face/opt_flux'
     # scene_id = '20181105_tajmahal'
+    # The scene can also be passed as the first argument (e.g., by batch_runner.py)
+    if(len(sys.argv) > 1): scene_id = sys.argv[1]
     assert(scene_id in scan_data_params['scene_ids']), "{} not in scene_ids".format(scene_id)
     
     ## Get dirpaths
@@ -53,7 +57,8 @@ if __name__=='__main__':
     os.makedirs(hist_dirpath, exist_ok=True)
 
     ## Get parameters for raw hist image
-    (nr, nc) = (scan_data_params["scene_params"][scene_id]["n_rows_fullres"], scan_data_params["scene_params"][scene_id]["n_cols_fullres"])
+    downsamp_factor = 1 # Spatial downsample factor. Set to the lres_factor used in read_fullscan_hydraharp_t3.py to preprocess low-res images
+    (nr, nc) = (scan_data_params["scene_params"][scene_id]["n_rows_fullres"] // downsamp_factor, scan_data_params["scene_params"][scene_id]["n_cols_fullres"] // downsamp_factor)
 
     ## Set histogram parameters
     laser_rep_freq = scan_data_params['laser_rep_freq'] # most data acquisitions were done with a 10MHz laser rep freq
@@ -62,18 +67,17 @@ if __name__=='__main__':
     max_n_tstamps = int(1e8) # discard timestamps if needed
     max_tbin = laser_rep_period # Period in ps
     min_tbin_size = scan_data_params['min_tbin_size'] # Bin size in ps
-    hist_tbin_factor = 1.0 # increase tbin size to make histogramming faster
+    hist_tbin_factor = 1 # integer. increase tbin size to make histogramming faster
     hist_tbin_size = min_tbin_size*hist_tbin_factor # increase size of time bin to make histogramming faster
-    n_hist_bins = get_nt(max_tbin, hist_tbin_size) 
+    n_hist_bins = get_n_hist_bins(max_tbin, min_tbin_size, hist_tbin_factor)
 
     ## Load Raw Hist Image if it exists, otherwise, create it
     raw_hist_img_fname = 'raw-' + get_hist_img_fname(nr, nc, hist_tbin_size, max_tbin)
     raw_hist_img_fpath = os.path.join(raw_hist_dirpath, raw_hist_img_fname)
     raw_hist_img_params_str = raw_hist_img_fpath.split('raw-hist-img_')[-1].split('.npy')[0]
     raw_hist_img_dims = raw_hist_img_params_str.split('_tres-')[0]
-
-    ## Load histogram image
-    raw_hist_img = np.load(raw_hist_img_fpath)
+    # Use the sparse raw histogram image if that is what read_fullscan_hydraharp_t3.py produced
+    if(not os.path.exists(raw_hist_img_fpath)): raw_hist_img_fpath = raw_hist_img_fpath.replace('.npy', '.npz')
 
     ##### BEGIN PRE-PROCESSING
 
@@ -81,17 +85,17 @@ if __name__=='__main__':
     hist_start_time = scan_data_params['hist_preprocessing_params']['hist_start_time'] # in ps. used to crop hist
     hist_end_time = scan_data_params['hist_preprocessing_params']['hist_end_time'] # in ps. used to crop hist
     hist_shift_time = scan_data_params['hist_preprocessing_params']['hist_shift_time'] # circshift histograms forward so they are not close to boundary
-    hist_start_bin = time2bin(hist_start_time, hist_tbin_size)
-    hist_end_bin = time2bin(hist_end_time, hist_tbin_size)
-    hist_shift_bin = time2bin(hist_shift_time, hist_tbin_size)
+    (hist_start_bin, hist_end_bin, hist_shift_bin) = get_hist_crop_bins(scan_data_params['hist_preprocessing_params'], hist_tbin_size)
     hist_img_tau = hist_end_time - hist_start_time
 
     ## Pre-process and save hist image
-    # Crop beginning and end to remove system inter-reflections
-    hist_img = raw_hist_img[..., hist_start_bin:hist_end_bin]
+    # Crop beginning and end to remove system inter-reflections. Only the cropped bins are loaded
+    hist_img = load_hist_img(raw_hist_img_fpath, start_bin=hist_start_bin, end_bin=hist_end_bin)
     # Circ shift to move peaks away from 0th bin
-    hist_img = np.roll(hist_img, hist_shift_bin)
+    hist_img = np.roll(hist_img, hist_shift_bin, axis=-1)
     hist_img_fname = get_hist_img_fname(nr, nc, int(hist_tbin_size), hist_img_tau)
+    # Save counts with the narrowest unsigned integer dtype that fits them
+    hist_img = to_min_uint_dtype(hist_img)
     np.save(os.path.join(hist_dirpath, hist_img_fname), hist_img)
 
     ## Plot center histogram
@@ -1,5 +1,6 @@
 #### Standard Library Imports
 import os
+import sys
 
 #### Library imports
 import numpy as np
@@ -51,12 +52,14 @@ if __name__=='__main__':
 	scene_id = '20190209_deer_high_mu/free'
 	# scene_id = '20190207_face_scanning_low_mu/free'
 	# scene_id = '20190207_face_scanning_low_mu/ground_truth'
+	# The scene can also be passed as the first argument (e.g., by batch_runner.py)
+	if(len(sys.argv) > 1): scene_id = sys.argv[1]
 	assert(scene_id in scan_data_params['scene_ids']), "{} not in scene_ids".format(scene_id)
 	hist_dirpath = os.path.join(hist_img_base_dirpath, scene_id)
 
 	## Histogram image params
 	downsamp_factor = 1 # Spatial downsample factor
-	hist_tbin_factor = 1.0 # increase tbin size to make histogramming faster
+	hist_tbin_factor = 1 # integer. increase tbin size to make histogramming faster
 	n_rows_fullres = scan_data_params['scene_params'][scene_id]['n_rows_fullres']
 	n_cols_fullres = scan_data_params['scene_params'][scene_id]['n_cols_fullres']
 	(nr, nc) = (n_rows_fullres // downsamp_factor, n_cols_fullres // downsamp_factor) # dims for face_scanning scene  
@@ -75,7 +78,8 @@ if __name__=='__main__':
 	hist_img = np.roll(hist_img, global_shift, axis=-1)
 
 
-	denoised_hist_img = gaussian_filter(hist_img, sigma=0.75, mode='wrap', truncate=1)
+	# hist_img holds integer counts. Filter in float so the denoised histograms are not rounded
+	denoised_hist_img = gaussian_filter(hist_img.astype(np.float64), sigma=0.75, mode='wrap', truncate=1)
 	(tbins, tbin_edges) = get_hist_bins(hist_img_tau, hist_tbin_size)
 
 	## Load IRF
@@ -3,8 +3,9 @@
     If the raw histogram image already exists, this script does nothing
 '''
 #### Standard Library Imports
-import glob
 import os
+import sys
+import copy
 
 #### Library imports
 import numpy as np
@@ -16,23 +17,36 @@ breakpoint = debugger.set_trace
 from scan_data_utils import *
 from pileup_correction import *
 from read_hydraharp_outfile_t3 import *
-from read_positions_file import read_positions_file, get_coords, POSITIONS_FNAME
+from scan_manifest import load_scan_manifest, get_manifest_fpaths, get_manifest_file_stats, SCAN_MANIFEST_FNAME
+from timestamp_cache import build_timestamp_cache, is_timestamp_cache_valid
+from fullscan_ingest import iter_build_raw_hist_img, get_binned_file_indeces, is_ingest_complete, get_changed_files, get_ingest_file_stats_fpath, PIXEL_FAILED, RAW_HIST_IMG_OUTPUT_DTYPES
+from ingest_telemetry import IngestTelemetry
+from sparse_hist_img import load_sparse_hist_img, calc_sparse_hist_img_summary
 from research_utils.timer import Timer
 from research_utils.plot_utils import *
 # from toflib.coding import IdentityCoding, GrayCoding, TruncatedFourierCoding, WalshHadamardCoding, WalshHadamardBinaryCoding
 from research_utils.io_ops import load_json, write_json
 
-def update_scene_scan_params(scan_params, scene_id, n_rows_fullres, n_cols_fullres):
-    if(scene_id in scan_params["scene_params"].keys()):
-        # Swap rows and cols to transpose image
-        scan_params["scene_params"][scene_id]["n_rows_fullres"] = n_cols_fullres
-        scan_params["scene_params"][scene_id]["n_cols_fullres"] = n_rows_fullres
-    else:
+def get_hist_img_dims(file_indeces_img, spatial_bin_factor=1):
+    '''
+        (nr, nc) of the histogram images built from file_indeces_img. They are the dims of the image, which are the transposed
+        scan dims (see vector2img), and with spatial_bin_factor > 1 the dims of the binned image (see get_binned_file_indeces)
+    '''
+    return get_binned_file_indeces(file_indeces_img, spatial_bin_factor).shape[0:2]
+
+def update_scene_scan_params(scan_params, scene_id, n_rows_fullres, n_cols_fullres, scan_params_fpath="scan_params.json"):
+    '''
+        Store the image dims of scene_id in scan_params and in scan_params.json. Only this scene is updated in the file, and
+        under a lock, so scenes ingested in parallel (see batch_runner.py) do not overwrite each other
+    '''
+    def update_dims(file_scan_params):
+        if(scene_id not in file_scan_params["scene_params"].keys()):
+            file_scan_params["scene_params"][scene_id] = copy.deepcopy(file_scan_params["scene_params"]["default"])
         # Swap rows and cols to transpose image
-        scan_params["scene_params"][scene_id] = scan_params["scene_params"]["default"]
-        scan_params["scene_params"][scene_id]["n_rows_fullres"] = n_cols_fullres
-        scan_params["scene_params"][scene_id]["n_cols_fullres"] = n_rows_fullres
-    write_json("scan_params.json", scan_params)
+        file_scan_params["scene_params"][scene_id]["n_rows_fullres"] = n_cols_fullres
+        file_scan_params["scene_params"][scene_id]["n_cols_fullres"] = n_rows_fullres
+    updated_scan_params = update_json_locked(scan_params_fpath, update_dims)
+    scan_params["scene_params"][scene_id] = updated_scan_params["scene_params"][scene_id]
 
 
 if __name__=='__main__':
@@ -44,9 +58,18 @@ if __name__=='__main__':
     hist_data_base_dirpath = io_dirpaths['hist_data_base_dirpath']
     os.makedirs(hist_data_base_dirpath, exist_ok=True)
 
-    lres_mode = False # Load a low-res version of the image
-    lres_factor = 1 # Load a low-res version of the image
+    lres_mode = False # Build a low-res version of the image
+    lres_factor = 1 # Sum the photons of each lres_factor x lres_factor block of scan points into one pixel
     overwrite_hist_img = False
+    resume_ingest = True # If a previous ingest was interrupted, continue from the first unfinished pixel
+    retry_failed_pixels = False # When resuming, re-run only the pixels that failed in the previous ingest
+    incremental_ingest = False # Re-ingest only the pixels whose .out files changed (size or mtime) since the last build, and patch them in place
+    use_timestamp_cache = False # Decode the .out files once into a compact cache and build histograms from it
+    n_ingest_workers = os.cpu_count() # number of processes that histogram pixels in parallel
+    ingest_prefetch_depth = 0 # .out files each worker reads ahead on background threads while it histograms the current one (e.g., 4 on network filesystems). 0 disables it
+    preprocess_at_ingest = False # Crop and shift histograms with the hist_preprocessing_params while ingesting. Saves the output of preprocess_raw_hist_img.py instead of the raw hist image
+    ingest_progress_period = 10 # seconds between progress lines of the ingest
+    raw_hist_img_format = 'dense' # 'sparse' stores only the non-zero bins of each pixel. Much smaller for low flux scans (low_mu, ext_5%)
     timestamp_data_base_dirpath = io_dirpaths['timestamp_data_base_dirpath']
 
     ## Set scene that will be processed 
@@ -66,44 +89,33 @@ if __name__=='__main__':
     # scene_id = '20181105_face/low_flux'
     # scene_id = '20181105_face/opt_flux'
     # scene_id = '20181105_tajmahal'
+    # The scene can also be passed as the first argument (e.g., by batch_runner.py)
+    if(len(sys.argv) > 1): scene_id = sys.argv[1]
     assert(scene_id in scan_data_params['scene_ids']), "{} not in scene_ids".format(scene_id)
     dirpath = os.path.join(timestamp_data_base_dirpath, scene_id)
     hist_dirpath = os.path.join(hist_data_base_dirpath, scene_id)
     os.makedirs(hist_dirpath, exist_ok=True)
     
-    ## Read positions data  
-    pos_data = read_positions_file(os.path.join(dirpath, POSITIONS_FNAME))
-    (x_coords, y_coords) = get_coords(pos_data)
-    n_rows_fullres = y_coords.size
-    n_cols_fullres = x_coords.size
+    ## Load the sorted list of files and the scan positions. Cached in a manifest that is rebuilt when the directory changes
+    # The incremental ingest also refreshes the size and mtime of each file, which it uses to find the changed files
+    scan_manifest = load_scan_manifest(dirpath, os.path.join(hist_dirpath, SCAN_MANIFEST_FNAME), refresh_file_stats=incremental_ingest)
+    n_rows_fullres = scan_manifest['n_rows_fullres']
+    n_cols_fullres = scan_manifest['n_cols_fullres']
     update_scene_scan_params(scan_data_params, scene_id, n_rows_fullres, n_cols_fullres)
 
-    ## Get list of all files in the directory, and the scan parameters
-    fpaths_list = glob.glob(os.path.join(dirpath, 't3mode_*_*_*.out'))
-    fnames_list = [os.path.basename(fpath) for fpath in fpaths_list]
-    n_params_in_fname = count_params_in_fname(fnames_list[0])
-    assert(n_params_in_fname == 3), 'Invalid fname {}. Expected fname with 3 params'.format(fnames_list[0])
-    scan_pos_indeces = np.array([parse_scan_pos_idx(fname) for fname in fnames_list])
-    is_long_cable_flags = np.array([parse_is_long_cable_flag(fname) for fname in fnames_list])
-    delay_param_list = np.array([parse_delay_param(fname) for fname in fnames_list])
-
-    ## sort the filenames to match the pos data
-    sort_indeces = np.argsort(scan_pos_indeces)
-    scan_pos_indeces = scan_pos_indeces[sort_indeces]
-    is_long_cable_flags = is_long_cable_flags[sort_indeces]  
-    delay_param_list = delay_param_list[sort_indeces] 
-    fpaths_list = [fpaths_list[sort_idx] for sort_idx in sort_indeces]  
-    fnames_list = [fnames_list[sort_idx] for sort_idx in sort_indeces]
-
-    ## Change all vectors into images to know exactly which pixel corresponds to each ID
-    fpaths_img = vector2img(np.array(fpaths_list), n_rows_fullres, n_cols_fullres)
-    fnames_img = vector2img(np.array(fnames_list), n_rows_fullres, n_cols_fullres)
-    scan_pos_indeces_img = vector2img(scan_pos_indeces, n_rows_fullres, n_cols_fullres).astype(np.float32)
-    if(lres_mode):
-        fpaths_img = fpaths_img[0::lres_factor,0::lres_factor] 
-        fnames_img = fnames_img[0::lres_factor,0::lres_factor] 
-        scan_pos_indeces_img = scan_pos_indeces_img[0::lres_factor,0::lres_factor]
-    (nr, nc) = fnames_img.shape
+    ## Get list of all files in the directory (sorted to match the pos data), and the scan parameters
+    fpaths_list = get_manifest_fpaths(scan_manifest, dirpath)
+    fnames_list = scan_manifest['fnames']
+    scan_pos_indeces = np.array(scan_manifest['scan_pos_indeces'])
+    is_long_cable_flags = np.array(scan_manifest['is_long_cable_flags'])
+    delay_param_list = np.array(scan_manifest['delay_params'])
+
+    ## Index of the file of each pixel. This mapping is specific to the way the scan data was acquired (see vector2img)
+    assert(len(fpaths_list) == scan_manifest['n_positions']), "Number of data files does not match number of points in pos data"
+    file_indeces_img = np.array(scan_manifest['file_indeces_img'])
+
+    spatial_bin_factor = lres_factor if lres_mode else 1
+    (nr, nc) = get_hist_img_dims(file_indeces_img, spatial_bin_factor)
 
     ## Set histogram parameters
     laser_rep_freq = scan_data_params['laser_rep_freq'] # most data acquisitions were done with a 10MHz laser rep freq
@@ -112,58 +124,84 @@ if __name__=='__main__':
     max_n_tstamps = int(1e8) # discard timestamps if needed
     max_tbin = laser_rep_period # Period in ps
     min_tbin_size = scan_data_params['min_tbin_size'] # Bin size in ps
-    hist_tbin_factor = 1.0 # increase tbin size to make histogramming faster
+    hist_tbin_factor = 1 # integer. increase tbin size to make histogramming faster
     hist_tbin_size = min_tbin_size*hist_tbin_factor # increase size of time bin to make histogramming faster
-    n_hist_bins = get_nt(max_tbin, hist_tbin_size) 
+    n_hist_bins = get_n_hist_bins(max_tbin, min_tbin_size, hist_tbin_factor)
+    hist_pyramid_tbin_factors = [] # e.g., [2, 4, 8]. Also save the raw hist images with 2x, 4x and 8x larger bins, summed from the same decode. Load them with load_hist_img_pyramid_level
 
     ## allocate histogram image
     n_data_files = len(fpaths_list)
-    n_scan_points = np.min([pos_data.shape[0], n_data_files])
-    assert(n_data_files >= pos_data.shape[0]), "Number of data files needs to be >= number of positions"
     print("n data files = {}".format(n_data_files))
-    print("n positions = {}".format(pos_data.shape[0]))
-    assert(n_data_files == pos_data.shape[0]), "Number of data files does not match number of points in pos data"
+    print("n positions = {}".format(scan_manifest['n_positions']))
     n_scan_points = len(fpaths_list)
-    histograms = np.zeros((n_scan_points, n_hist_bins))
-    raw_hist_img = np.zeros((nr, nc, n_hist_bins))
-    n_laser_cycles_img = np.zeros((nr, nc))
-    n_empty_laser_cycles_img = np.zeros((nr, nc))
 
     ## Load Raw Hist Image if it exists, otherwise, create it
     raw_hist_img_fname = 'raw-' + get_hist_img_fname(nr, nc, hist_tbin_size, max_tbin)
+    hist_crop_bins = None
+    if(preprocess_at_ingest):
+        # Build the preprocessed hist image directly. The raw hist image is not needed
+        hist_crop_bins = get_hist_crop_bins(scan_data_params['hist_preprocessing_params'], hist_tbin_size)
+        hist_img_tau = scan_data_params['hist_preprocessing_params']['hist_end_time'] - scan_data_params['hist_preprocessing_params']['hist_start_time']
+        raw_hist_img_fname = get_hist_img_fname(nr, nc, int(hist_tbin_size), hist_img_tau)
+        hist_dirpath = os.path.join(io_dirpaths['preprocessed_hist_data_base_dirpath'], scene_id)
+        os.makedirs(hist_dirpath, exist_ok=True)
     raw_hist_img_fpath = os.path.join(hist_dirpath, raw_hist_img_fname)
-    raw_hist_img_params_str = raw_hist_img_fpath.split('raw-hist-img_')[-1].split('.npy')[0]
+    raw_hist_img_params_str = raw_hist_img_fname.split('hist-img_')[-1].split('.npy')[0]
     raw_hist_img_dims = raw_hist_img_params_str.split('_tres-')[0]
+    if(raw_hist_img_format == 'sparse'): raw_hist_img_fpath = raw_hist_img_fpath.replace('.npy', '.npz')
+    ingest_state_fpath = os.path.join(hist_dirpath, 'ingest-state_{}.npy'.format(raw_hist_img_params_str))
+    # Coarser levels of the temporal pyramid. Only built for the dense raw hist image
+    pyramid_fpaths = {}
+    if((not preprocess_at_ingest) and (raw_hist_img_format == 'dense')):
+        pyramid_fpaths = {k: os.path.join(hist_dirpath, 'raw-' + get_hist_img_fname(nr, nc, hist_tbin_size*k, max_tbin)) for k in hist_pyramid_tbin_factors}
 
-    if(os.path.exists(raw_hist_img_fpath) and (not overwrite_hist_img)):
-        raw_hist_img = np.load(raw_hist_img_fpath)
-    else: 
-        # timestamps_arr = []
-        # sync_vec_arr = []
-        # For each file load tstamps, make histogram, and store in hist_img
-        for i in range(nr):
-            for j in range(nc):
-                fpath = fpaths_img[i,j]
-                fname = fnames_img[i,j]
-                scan_pos_idx = scan_pos_indeces_img[i,j]
-                print("{}, {}".format(scan_pos_idx, fname))
-                sync_vec, dtime_vec = read_hydraharp_outfile_t3(fpath)
-                # timestamps_arr.append(dtime_vec)
-                # sync_vec_arr.append(dtime_vec)
-                (counts, bin_edges, bins) = timestamps2histogram(dtime_vec, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor)
-                n_laser_cycles_img[i,j] = sync_vec.max()
-                n_empty_laser_cycles_img[i,j] = calc_n_empty_laser_cycles(sync_vec)
-                # roll_amount = calc_hist_shift(fname, hist_tbin_size)
-                roll_amount = 0
-                counts = np.roll(counts, int(roll_amount))
-                raw_hist_img[i,j,:] = counts
-        np.save(raw_hist_img_fpath, raw_hist_img)
-        np.save(os.path.join(hist_dirpath, 'n-laser-cycles-img_{}.npy'.format(raw_hist_img_dims)), n_laser_cycles_img)
-        np.save(os.path.join(hist_dirpath, 'n-empty-laser-cycles-img_{}.npy'.format(raw_hist_img_dims)), n_empty_laser_cycles_img)
+    # Sparse images are only assembled at the end of an ingest, so they can not be patched in place
+    incremental_ingest = incremental_ingest and (raw_hist_img_format == 'dense')
+    is_ingest_needed = overwrite_hist_img or (not os.path.exists(raw_hist_img_fpath)) or (not all([os.path.exists(fpath) for fpath in pyramid_fpaths.values()])) or (not is_ingest_complete(ingest_state_fpath))
+    # A finished ingest is only re-run if some of its files changed since then
+    if(incremental_ingest and (not is_ingest_needed)):
+        is_ingest_needed = bool(np.any(get_changed_files(get_ingest_file_stats_fpath(ingest_state_fpath), fpaths_list, file_stats=get_manifest_file_stats(scan_manifest))))
+        if(not is_ingest_needed): print("No .out files changed since the last ingest")
+    if(is_ingest_needed):
+        timestamp_cache_dirpath = None
+        if(use_timestamp_cache):
+            timestamp_cache_dirpath = os.path.join(io_dirpaths['timestamp_cache_base_dirpath'], scene_id)
+            if(not is_timestamp_cache_valid(timestamp_cache_dirpath, fpaths_list)):
+                print("Building timestamp cache in {}".format(timestamp_cache_dirpath))
+                build_timestamp_cache(timestamp_cache_dirpath, fpaths_list, workers=n_ingest_workers)
+        # For each file load tstamps, make histogram, and store in hist_img. Pixels are histogrammed in parallel
+        # and written directly into the memory-mapped output files
+        output_fpaths = {
+            'raw_hist_img': raw_hist_img_fpath
+            , 'n_laser_cycles_img': os.path.join(hist_dirpath, 'n-laser-cycles-img_{}.npy'.format(raw_hist_img_dims))
+            , 'n_empty_laser_cycles_img': os.path.join(hist_dirpath, 'n-empty-laser-cycles-img_{}.npy'.format(raw_hist_img_dims))
+        }
+        outputs = None
+        ingest_telemetry = IngestTelemetry(progress_period=ingest_progress_period)
+        for ((i, j, file_idxs), outputs) in iter_build_raw_hist_img(fpaths_list, file_indeces_img, output_fpaths, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor, max_photons=max_n_tstamps, workers=n_ingest_workers, timestamp_cache_dirpath=timestamp_cache_dirpath, state_fpath=ingest_state_fpath, resume=((resume_ingest or incremental_ingest) and (not overwrite_hist_img)), retry_failed=retry_failed_pixels, check_changed_files=incremental_ingest, output_format=raw_hist_img_format, hist_crop_bins=hist_crop_bins, spatial_bin_factor=spatial_bin_factor, prefetch_depth=ingest_prefetch_depth, pyramid_fpaths=pyramid_fpaths, file_stats=get_manifest_file_stats(scan_manifest), telemetry=ingest_telemetry):
+            ingest_telemetry.print_progress()
+        del outputs
+        ingest_telemetry.print_progress(force=True)
+        # Throughput, latency, and worker utilization of the ingest. Use it to tell if a slow ingest is bound by the disk, the CPU, or a few giant files
+        ingest_telemetry.save(os.path.join(hist_dirpath, 'ingest-metrics_{}.json'.format(raw_hist_img_params_str)))
+        n_failed_pixels = np.count_nonzero(np.load(ingest_state_fpath) == PIXEL_FAILED)
+        if(n_failed_pixels > 0): print("WARNING: {} pixels failed. Fix their files and re-run with retry_failed_pixels = True".format(n_failed_pixels))
+        # Once all pixels are done store the counts with the narrowest unsigned integer dtype that fits them.
+        # Images that were already narrowed (and patched in place by an incremental ingest) are not rewritten
+        elif(raw_hist_img_format == 'dense'):
+            for fpath in [raw_hist_img_fpath] + list(pyramid_fpaths.values()):
+                if(np.load(fpath, mmap_mode='r').dtype == RAW_HIST_IMG_OUTPUT_DTYPES['raw_hist_img']):
+                    print("{} stored as {}".format(os.path.basename(fpath), narrow_hist_img_file(fpath)))
+    if(raw_hist_img_format == 'sparse'):
+        assert(os.path.exists(raw_hist_img_fpath)), "The sparse histogram image is only saved once all pixels are ingested"
+        (nphotons_img, maxpeak_img, argmax_img) = calc_sparse_hist_img_summary(load_sparse_hist_img(raw_hist_img_fpath))
+    else:
+        raw_hist_img = np.load(raw_hist_img_fpath, mmap_mode='r')
+        (nphotons_img, maxpeak_img, argmax_img) = (raw_hist_img.sum(axis=-1), raw_hist_img.max(axis=-1), raw_hist_img.argmax(axis=-1))
     
     ## Save intensity image
     plt.clf()
-    plt.imshow(raw_hist_img.sum(axis=-1))
+    plt.imshow(nphotons_img)
     nphotons_img_fname = raw_hist_img_fname.replace('raw-hist-img', 'raw-nphotons-img')
     plt.title(nphotons_img_fname)
     plt.pause(0.1)
@@ -171,7 +209,7 @@ if __name__=='__main__':
     plt.pause(0.1)
     # save_img(raw_hist_img.sum(axis=-1), hist_dirpath, nphotons_img_fname )
     plt.clf()
-    plt.imshow(raw_hist_img.max(axis=-1))
+    plt.imshow(maxpeak_img)
     maxpeak_img_fname = raw_hist_img_fname.replace('raw-hist-img', 'raw-maxpeak-img')
     plt.title(maxpeak_img_fname)
     plt.pause(0.1)
@@ -181,7 +219,7 @@ if __name__=='__main__':
 
     
     plt.clf()
-    plt.imshow(raw_hist_img.argmax(axis=-1))
+    plt.imshow(argmax_img)
     argmax_img_fname = raw_hist_img_fname.replace('raw-hist-img', 'raw-argmax-img')
     plt.title(argmax_img_fname)
     plt.pause(0.1)
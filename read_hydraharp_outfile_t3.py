@@ -11,6 +11,8 @@ Reads a single photon timestamp data file (t3mode_*.out file), i.e., a single po
 import os
 import struct
 import sys
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 sys.path.append('./tof-lib')
 
 #### Library imports
@@ -28,13 +30,102 @@ from pileup_correction import *
 
 DEBUG = False
 
+T3WRAPAROUND = 1024
+BYTES_PER_RECORD = 4
+T3_RECORD_DTYPE = np.dtype('<u4')
+T3_OVERFLOW_CHANNEL = 63
+T3_CHUNK_N_RECS = 2**22 # 16MB of raw records per chunk
+T3_MIN_CHUNK_N_RECS = 2**16 # smallest chunk used when reading with a photon budget
+
 def got_photon(time_tag, channel, dtime):
 	print('CHN',channel,'time_tag',time_tag,'dtime',dtime)
 
 def got_overflow(count):
 	print('OFL *',count)
 
-def read_hydraharp_outfile_t3(outfilename):
+def split_t3_records(records):
+	"""Vectorized bit masking of raw T3 records.
+	Input:
+		* records: uint32 array of raw T3 records
+	Outputs:
+		* (nsync, dtime, channel, special) arrays, each with the same size as records
+	"""
+	nsync   =  records & 0b00000000000000000000001111111111
+	dtime   = (records & 0b00000001111111111111110000000000)>>10
+	channel = (records & 0b01111110000000000000000000000000)>>25
+	special = (records >> 31).astype(bool)
+	return (nsync, dtime, channel, special)
+
+def decode_t3_records(records, overflow_correction=0, warn_markers=True):
+	"""Vectorized decoding of a block of raw T3 records.
+	The overflow correction of every photon is rebuilt with a cumulative sum over the overflow records (channel 63).
+	Inputs:
+		* records: uint32 array of raw T3 records
+		* overflow_correction: sync offset accumulated by all the records that came before this block
+		* warn_markers: print a warning if the block has marker records
+	Outputs:
+		* sync_vec: int64 array with the true sync number of each photon record
+		* dtime_vec: dtime of each photon record
+		* channel_vec: channel of each photon record
+		* overflow_correction: sync offset accumulated after this block. Pass it to the next block when streaming.
+	"""
+	(nsync, dtime, channel, special) = split_t3_records(records)
+	is_overflow = np.logical_and(special, channel == T3_OVERFLOW_CHANNEL)
+	# An overflow record with nsync==0 is a single overflow, otherwise nsync holds the number of overflows
+	n_overflows_vec = np.zeros(records.size, dtype=np.int64)
+	n_overflows_vec[is_overflow] = np.maximum(nsync[is_overflow], 1)
+	sync_offsets = overflow_correction + T3WRAPAROUND*np.cumsum(n_overflows_vec)
+	n_markers = np.count_nonzero(special & (channel >= 1) & (channel <= 15)) if warn_markers else 0
+	if(n_markers > 0):
+		print('{} markers received. something wrong with cables?'.format(n_markers))
+	is_photon = np.logical_not(special)
+	sync_vec = sync_offsets[is_photon] + nsync[is_photon]
+	if(records.size > 0): overflow_correction = int(sync_offsets[-1])
+	return (sync_vec, dtime[is_photon], channel[is_photon], overflow_correction)
+
+def count_t3_overflows(records):
+	"""Total number of overflows (in units of T3WRAPAROUND syncs) in a block of raw T3 records"""
+	(nsync, _, channel, special) = split_t3_records(records)
+	is_overflow = np.logical_and(special, channel == T3_OVERFLOW_CHANNEL)
+	return int(np.maximum(nsync[is_overflow], 1).sum())
+
+def get_t3_record_ranges(num_recs, n_ranges):
+	"""Split num_recs records into n_ranges contiguous record-aligned (start_rec, end_rec) ranges"""
+	range_bounds = np.linspace(0, num_recs, n_ranges+1).astype(np.int64)
+	return [(int(range_bounds[i]), int(range_bounds[i+1])) for i in range(n_ranges) if (range_bounds[i+1] > range_bounds[i])]
+
+def count_t3_range_overflows(outfilename, start_rec, end_rec):
+	records = np.memmap(outfilename, dtype=T3_RECORD_DTYPE, mode='r', offset=start_rec*BYTES_PER_RECORD, shape=(end_rec-start_rec,))
+	return count_t3_overflows(np.asarray(records))
+
+def decode_t3_range(outfilename, start_rec, end_rec, overflow_correction):
+	records = np.memmap(outfilename, dtype=T3_RECORD_DTYPE, mode='r', offset=start_rec*BYTES_PER_RECORD, shape=(end_rec-start_rec,))
+	(sync_vec, dtime_vec, _, _) = decode_t3_records(np.asarray(records), overflow_correction)
+	return (sync_vec.astype(np.int32), dtime_vec.astype(np.int32))
+
+def get_pool_executor(workers, use_processes=False):
+	if(use_processes): return ProcessPoolExecutor(max_workers=workers)
+	else: return ThreadPoolExecutor(max_workers=workers)
+
+def read_hydraharp_outfile_t3_parallel(outfilename, workers, use_processes=False):
+	"""Decode a .out file on a pool of workers. The file is split into one record-aligned range per worker.
+	A first pass counts the overflows of each range, and an exclusive prefix sum over those totals gives the
+	absolute sync offset of each range. A second pass decodes the ranges independently with their offsets.
+	The output is identical to the serial decoder.
+	"""
+	num_recs = os.path.getsize(outfilename) // BYTES_PER_RECORD
+	record_ranges = get_t3_record_ranges(num_recs, workers)
+	if(len(record_ranges) == 0): return (np.zeros((0,), dtype=np.int32), np.zeros((0,), dtype=np.int32))
+	(start_recs, end_recs) = zip(*record_ranges)
+	with get_pool_executor(workers, use_processes) as executor:
+		range_n_overflows = list(executor.map(count_t3_range_overflows, [outfilename]*len(record_ranges), start_recs, end_recs))
+		range_overflow_corrections = T3WRAPAROUND*(np.cumsum([0] + range_n_overflows[:-1]))
+		decoded_ranges = list(executor.map(decode_t3_range, [outfilename]*len(record_ranges), start_recs, end_recs, [int(c) for c in range_overflow_corrections]))
+	sync_vec = np.concatenate([decoded_range[0] for decoded_range in decoded_ranges])
+	dtime_vec = np.concatenate([decoded_range[1] for decoded_range in decoded_ranges])
+	return (sync_vec, dtime_vec)
+
+def read_hydraharp_outfile_t3(outfilename, workers=1, use_processes=False, max_photons=None, max_laser_cycles=None):
 	"""Function to read .out files (headerless) saved using tttr-t3.exe binary executable.
 	Input:
 		.out filename with full path
@@ -57,6 +148,194 @@ def read_hydraharp_outfile_t3(outfilename):
 		
 		To avoid a truncated time response, you need to ensure that
 		laser rep time interval <= (TCSPC bin resolution) x 32767
+
+		If workers > 1 the file is decoded in parallel on a thread pool (or a process pool if use_processes is True).
+		See read_hydraharp_outfile_t3_parallel.
+
+		If max_photons and/or max_laser_cycles are set, only the first max_photons photons with sync <= max_laser_cycles
+		are returned, and the file is only read until those limits are reached (workers is ignored in that case).
+	"""
+	if((max_photons is not None) or (max_laser_cycles is not None)):
+		chunks = list(iter_hydraharp_outfile_t3(outfilename, max_photons=max_photons, max_laser_cycles=max_laser_cycles))
+		if(len(chunks) == 0): return (np.zeros((0,), dtype=np.int32), np.zeros((0,), dtype=np.int32))
+		sync_vec = np.concatenate([chunk[0] for chunk in chunks]).astype(np.int32)
+		dtime_vec = np.concatenate([chunk[1] for chunk in chunks]).astype(np.int32)
+		return (sync_vec, dtime_vec)
+	if(workers > 1): return read_hydraharp_outfile_t3_parallel(outfilename, workers=workers, use_processes=use_processes)
+	num_recs = os.path.getsize(outfilename) // BYTES_PER_RECORD
+	records = np.fromfile(outfilename, dtype=T3_RECORD_DTYPE, count=num_recs)
+	(sync_vec, dtime_vec, _, _) = decode_t3_records(records)
+	return (sync_vec.astype(np.int32), dtime_vec.astype(np.int32))
+
+def read_t3_records(outfilename, max_n_recs=None):
+	"""Read all the raw uint32 records of a .out file into memory. Trailing bytes that do not make up a full record are ignored.
+	If the file has more than max_n_recs records nothing is read and None is returned, so it can be streamed instead (see iter_t3_record_chunks)
+	"""
+	num_recs = os.path.getsize(outfilename) // BYTES_PER_RECORD
+	if((max_n_recs is not None) and (num_recs > max_n_recs)): return None
+	return np.fromfile(outfilename, dtype=T3_RECORD_DTYPE, count=num_recs)
+
+def iter_prefetched_t3_records(fpaths, prefetch_depth=4, io_workers=2, max_file_n_recs=T3_CHUNK_N_RECS):
+	"""Generator that yields (fpath, records) for each file in fpaths, in order, while background I/O threads read the
+	next files. At most prefetch_depth files are read ahead, and only files with up to max_file_n_recs records are read
+	(None is yielded for larger ones, which should be streamed in chunks). So memory is bounded by prefetch_depth + 1
+	times max_file_n_recs records, i.e., the same as prefetch_depth + 1 chunks of the chunked reader by default.
+	If reading a file fails, the exception is yielded instead of its records.
+	"""
+	executor = ThreadPoolExecutor(max_workers=io_workers)
+	read_ahead = collections.deque()
+	try:
+		for fpath in fpaths:
+			read_ahead.append((fpath, executor.submit(read_t3_records, fpath, max_file_n_recs)))
+			if(len(read_ahead) > prefetch_depth):
+				(next_fpath, future) = read_ahead.popleft()
+				yield (next_fpath, future.exception() or future.result())
+		while(len(read_ahead) > 0):
+			(next_fpath, future) = read_ahead.popleft()
+			yield (next_fpath, future.exception() or future.result())
+	finally:
+		for (_, future) in read_ahead: future.cancel()
+		executor.shutdown(wait=True)
+
+def iter_t3_record_chunks(outfilename, chunk_n_recs=T3_CHUNK_N_RECS):
+	"""Generator that memory-maps a .out file and yields its raw uint32 records in chunks of chunk_n_recs records.
+	Trailing bytes that do not make up a full record are ignored.
+	outfilename can also be the records of a file that was already read into memory (see read_t3_records)
+	"""
+	if(isinstance(outfilename, np.ndarray)):
+		for start_idx in range(0, outfilename.size, chunk_n_recs):
+			yield outfilename[start_idx:start_idx+chunk_n_recs]
+		return
+	num_recs = os.path.getsize(outfilename) // BYTES_PER_RECORD
+	if(num_recs == 0): return
+	records = np.memmap(outfilename, dtype=T3_RECORD_DTYPE, mode='r', shape=(num_recs,))
+	for start_idx in range(0, num_recs, chunk_n_recs):
+		yield np.asarray(records[start_idx:start_idx+chunk_n_recs])
+	del records
+
+def iter_hydraharp_outfile_t3(outfilename, chunk_n_recs=T3_CHUNK_N_RECS, max_photons=None, max_laser_cycles=None):
+	"""Generator that memory-maps a .out file and decodes it in chunks of chunk_n_recs records.
+	The overflow correction is carried from one chunk to the next, so concatenating the outputs gives the
+	same result as read_hydraharp_outfile_t3. Peak memory is bounded by the chunk size instead of the file size.
+	Input:
+		* outfilename: .out filename with full path
+		* chunk_n_recs: number of raw records decoded per chunk
+		* max_photons: stop after this many photons. Since every photon is a record, chunks are shrunk so that
+			reading does not go much further than the photon budget.
+		* max_laser_cycles: stop at the first photon with sync > max_laser_cycles
+	Outputs:
+		* yields (sync_vec, dtime_vec, channel_vec) for the photon records in each chunk. sync_vec is int64.
+	"""
+	if(max_photons is not None): chunk_n_recs = min(chunk_n_recs, max(max_photons, T3_MIN_CHUNK_N_RECS))
+	n_photons = 0
+	overflow_correction = 0
+	for records_chunk in iter_t3_record_chunks(outfilename, chunk_n_recs=chunk_n_recs):
+		(sync_vec, dtime_vec, channel_vec, overflow_correction) = decode_t3_records(records_chunk, overflow_correction)
+		n_keep = sync_vec.size
+		if(max_photons is not None): n_keep = min(n_keep, max_photons - n_photons)
+		# sync_vec is non-decreasing so the photons within max_laser_cycles are a prefix of the chunk
+		if(max_laser_cycles is not None): n_keep = min(n_keep, int(np.searchsorted(sync_vec, max_laser_cycles, side='right')))
+		if(n_keep < sync_vec.size):
+			yield (sync_vec[0:n_keep], dtime_vec[0:n_keep], channel_vec[0:n_keep])
+			return
+		n_photons += n_keep
+		yield (sync_vec, dtime_vec, channel_vec)
+		if((max_photons is not None) and (n_photons >= max_photons)): return
+
+def outfile_t3_to_histogram(outfilename, max_tbin, min_tbin_size, hist_tbin_factor=1, chunk_n_recs=T3_CHUNK_N_RECS, max_photons=None, max_laser_cycles=None):
+	"""Fused decode-to-histogram kernel. Streams over the chunks of a .out file and accumulates the photons of each
+	dtime code and the laser cycle statistics, without materializing the full timestamp arrays of the file.
+	Inputs:
+		* outfilename: .out filename with full path
+		* max_tbin, min_tbin_size, hist_tbin_factor: same as timestamps2histogram
+		* chunk_n_recs: number of raw records decoded per chunk
+		* max_photons, max_laser_cycles: photon budget. See iter_hydraharp_outfile_t3
+	Outputs:
+		* counts: same histogram as timestamps2histogram(read_hydraharp_outfile_t3(outfilename)[1], ...)
+		* n_laser_cycles: sync_vec.max(). 0 if the file has no photons
+		* n_empty_laser_cycles: calc_n_empty_laser_cycles(sync_vec). 0 if the file has no photons
+	"""
+	(counts_list, n_laser_cycles, n_empty_laser_cycles) = outfile_t3_to_histograms(outfilename, max_tbin, min_tbin_size, hist_tbin_factors=[hist_tbin_factor], chunk_n_recs=chunk_n_recs, max_photons=max_photons, max_laser_cycles=max_laser_cycles)
+	return (counts_list[0], n_laser_cycles, n_empty_laser_cycles)
+
+def outfile_t3_to_histograms(outfilename, max_tbin, min_tbin_size, hist_tbin_factors=(1, 2, 4, 8), chunk_n_recs=T3_CHUNK_N_RECS, max_photons=None, max_laser_cycles=None):
+	"""Same as outfile_t3_to_histogram, but builds one histogram for each of hist_tbin_factors from a single decode of the file.
+	Integer factors are rebinned from the dtime code counts with integer arithmetic only (see dtime_counts2histogram),
+	e.g., the default factors give the 8, 16, 32 and 64 ps histograms of a scan with 8 ps min_tbin_size.
+	Outputs:
+		* counts_list: histogram for each hist_tbin_factor
+		* n_laser_cycles, n_empty_laser_cycles: see outfile_t3_to_histogram
+	"""
+	dtime_counts = np.zeros((N_DTIME_CODES,), dtype=np.int64)
+	sync_stats = init_sync_stats()
+	for (sync_vec, dtime_vec, _) in iter_hydraharp_outfile_t3(outfilename, chunk_n_recs=chunk_n_recs, max_photons=max_photons, max_laser_cycles=max_laser_cycles):
+		if(sync_vec.size == 0): continue
+		dtime_counts += np.bincount(dtime_vec, minlength=N_DTIME_CODES)
+		update_sync_stats(sync_stats, sync_vec)
+	counts_list = [dtime_counts2histogram(dtime_counts, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor)[0] for hist_tbin_factor in hist_tbin_factors]
+	sync_stats = get_sync_stats(sync_stats)
+	return (counts_list, sync_stats['n_laser_cycles'], sync_stats['n_empty_laser_cycles'])
+
+def calc_t3_record_stats(outfilename, chunk_n_recs=T3_CHUNK_N_RECS):
+	"""Integrity report of a .out file computed in a single vectorized pass over its records.
+	Input:
+		* outfilename: .out filename with full path
+	Outputs:
+		* stats: dict with the record counts (photons, overflows, markers, photons per channel), the sync range,
+			laser cycle counts, and flags for truncated files (size not a multiple of BYTES_PER_RECORD) or unsorted sync numbers.
+	"""
+	file_nbytes = os.path.getsize(outfilename)
+	stats = {
+		'fname': os.path.basename(outfilename)
+		, 'file_nbytes': file_nbytes
+		, 'n_records': file_nbytes // BYTES_PER_RECORD
+		, 'n_trailing_bytes': file_nbytes % BYTES_PER_RECORD
+		, 'is_truncated': (file_nbytes % BYTES_PER_RECORD) != 0
+		, 'n_photons': 0
+		, 'n_overflow_records': 0
+		, 'n_overflows': 0
+		, 'n_markers': 0
+		, 'n_unknown_special_records': 0
+		, 'channel_counts': {}
+		, 'sync_min': None
+		, 'sync_max': None
+		, 'n_nonempty_laser_cycles': 0
+		, 'n_empty_laser_cycles': 0
+		, 'n_duplicate_photons': 0 # photons that share a laser cycle with the previous photon
+		, 'photons_per_laser_cycle_counts': [0] # element k is the number of laser cycles with k photons
+		, 'is_sync_sorted': True
+	}
+	channel_counts = np.zeros((2**6,), dtype=np.int64)
+	overflow_correction = 0
+	sync_stats = init_sync_stats()
+	for records_chunk in iter_t3_record_chunks(outfilename, chunk_n_recs=chunk_n_recs):
+		(nsync, _, channel, special) = split_t3_records(records_chunk)
+		is_overflow = np.logical_and(special, channel == T3_OVERFLOW_CHANNEL)
+		is_marker = special & (channel >= 1) & (channel <= 15)
+		stats['n_overflow_records'] += int(np.count_nonzero(is_overflow))
+		stats['n_markers'] += int(np.count_nonzero(is_marker))
+		stats['n_unknown_special_records'] += int(np.count_nonzero(special)) - int(np.count_nonzero(is_overflow)) - int(np.count_nonzero(is_marker))
+		channel_counts += np.bincount(channel[np.logical_not(special)], minlength=channel_counts.size)
+		(sync_vec, _, _, overflow_correction) = decode_t3_records(records_chunk, overflow_correction, warn_markers=False)
+		if(sync_vec.size == 0): continue
+		update_sync_stats(sync_stats, sync_vec)
+		if(stats['sync_min'] is None): stats['sync_min'] = int(sync_vec.min())
+		stats['sync_min'] = min(stats['sync_min'], int(sync_vec.min()))
+		stats['sync_max'] = max(stats['sync_max'] or 0, int(sync_vec.max()))
+	stats['n_overflows'] = overflow_correction // T3WRAPAROUND
+	stats['channel_counts'] = {int(c): int(channel_counts[c]) for c in np.flatnonzero(channel_counts)}
+	sync_stats = get_sync_stats(sync_stats)
+	for key in ['n_photons', 'n_duplicate_photons', 'is_sync_sorted']: stats[key] = sync_stats[key]
+	if(stats['n_photons'] > 0):
+		stats['n_nonempty_laser_cycles'] = sync_stats['n_nonempty_laser_cycles']
+		stats['n_empty_laser_cycles'] = stats['sync_max'] - stats['n_nonempty_laser_cycles']
+		stats['photons_per_laser_cycle_counts'] = sync_stats['photons_per_cycle_counts'].tolist()
+		stats['photons_per_laser_cycle_counts'][0] = stats['n_empty_laser_cycles']
+	return stats
+
+def read_hydraharp_outfile_t3_loop(outfilename):
+	"""Reference per-record implementation of read_hydraharp_outfile_t3. Decodes one record at a time.
+	It is much slower than the vectorized read_hydraharp_outfile_t3, but it is kept to validate it.
 	"""
 	T3WRAPAROUND = 1024
 	BYTES_PER_RECORD = 4
@@ -78,7 +357,7 @@ def read_hydraharp_outfile_t3(outfilename):
 	
 	for _ in range(num_recs):
 		bytstr = f.read(4)
-		if bytstr=='':
+		if len(bytstr) < BYTES_PER_RECORD:
 			print('file corrupt. wrong num of recs')
 			break
 		
@@ -116,6 +395,24 @@ def read_hydraharp_outfile_t3(outfilename):
 	return (sync_vec[0:ndrecs],dtime_vec[0:ndrecs])
 
 
+def read_hydraharp_outfile_t3_channels(outfilename, channels=(0,1)):
+	"""Decode a .out file in one pass and demultiplex the photon records of each channel.
+	Input:
+		* outfilename: .out filename with full path
+		* channels: channels to keep. Photon records from other channels are dropped.
+	Outputs:
+		* channels_data: dict mapping each channel to its (sync_vec, dtime_vec). Arrays are int32 and exactly sized.
+	"""
+	num_recs = os.path.getsize(outfilename) // BYTES_PER_RECORD
+	records = np.fromfile(outfilename, dtype=T3_RECORD_DTYPE, count=num_recs)
+	(sync_vec, dtime_vec, channel_vec, _) = decode_t3_records(records)
+	del records
+	channels_data = {}
+	for channel in channels:
+		is_channel = (channel_vec == channel)
+		channels_data[channel] = (sync_vec[is_channel].astype(np.int32), dtime_vec[is_channel].astype(np.int32))
+	return channels_data
+
 def read_hydraharp_outfile_t3_with_gate(outfilename):
 	"""Function to read .out files (headerless) saved using tttr-t3.exe binary executable.
 	Input:
@@ -140,6 +437,14 @@ def read_hydraharp_outfile_t3_with_gate(outfilename):
 		To avoid a truncated time response, you need to ensure that
 		laser rep time interval <= (TCSPC bin resolution) x 32767
 	"""
+	channels_data = read_hydraharp_outfile_t3_channels(outfilename, channels=(0,1))
+	(sync_vec, dtime_vec) = channels_data[0]
+	(sync_vec_gate, dtime_vec_gate) = channels_data[1]
+	return (sync_vec, dtime_vec, sync_vec_gate, dtime_vec_gate)
+
+def read_hydraharp_outfile_t3_with_gate_loop(outfilename):
+	"""Reference per-record implementation of read_hydraharp_outfile_t3_with_gate. Decodes one record at a time.
+	"""
 	T3WRAPAROUND = 1024
 	BYTES_PER_RECORD = 4
 	f = open(outfilename,"rb")
@@ -164,7 +469,7 @@ def read_hydraharp_outfile_t3_with_gate(outfilename):
 	
 	for _ in range(num_recs):
 		bytstr = f.read(4)
-		if bytstr=='':
+		if len(bytstr) < BYTES_PER_RECORD:
 			print('file corrupt. wrong num of recs')
 			break
 		
@@ -259,13 +564,10 @@ if __name__=='__main__':
 	fpath = os.path.join(dirpath, fname)
 
 	## Timestamps and their corresponding laser pulse cycle when it was captured
-	sync_vec, dtime_vec = read_hydraharp_outfile_t3(fpath)
-
-	## discard timestamps to make things faster
+	## Only the first max_n_tstamps timestamps are read, to make things faster
 	max_n_tstamps = int(1e8)
-	abs_max_n_tstamps = dtime_vec.size
-	max_n_tstamps = np.min([max_n_tstamps, dtime_vec.size])
-	(dtime_vec, sync_vec) = (dtime_vec[0:max_n_tstamps], sync_vec[0:max_n_tstamps]) 
+	n_recs_in_file = os.path.getsize(fpath) // BYTES_PER_RECORD
+	sync_vec, dtime_vec = read_hydraharp_outfile_t3(fpath, max_photons=max_n_tstamps)
 
 	## Calc Parameters for Coates Estimator
 	n_laser_cycles = sync_vec.max()
@@ -279,7 +581,7 @@ if __name__=='__main__':
 	# If there are timestamps larger than max_tbin the will be discarded when building the histogram 
 	max_tbin = laser_rep_period # Period in ps
 	min_tbin_size = scan_data_params['min_tbin_size'] # Bin size in ps
-	hist_tbin_factor = 1.0 # increase tbin size to make histogramming faster
+	hist_tbin_factor = 1 # integer. increase tbin size to make histogramming faster
 	hist_tbin_size = min_tbin_size*hist_tbin_factor # increase size of time bin to make histogramming faster
 	(counts, bin_edges, bins) = timestamps2histogram(dtime_vec, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor)
 	n_hist_bins = counts.size
@@ -308,16 +610,16 @@ if __name__=='__main__':
 	print("	- n_bins = {}".format(bins.shape))
 	print("	- n_counts = {}".format(counts.sum()))
 	print("	- n_timestamps_used = {}".format(dtime_vec.shape))
-	print("	- n_timestamps_avail = {}".format(abs_max_n_tstamps))
+	print("	- n_records_in_file = {}".format(n_recs_in_file))
 	print("	- MIN timestamp in file (ps) = {}".format(min_tbin_size*np.min(dtime_vec)))
 	print("	- MAX timestamp in file (ps) = {}".format(min_tbin_size*np.max(dtime_vec)))
 	
 	# Check if all laser pulses counter are unique
 	# If all the pulses are unique, it usually means that we were operated in synchronous mode (ext triggering with laser).
-	u, c = np.unique(sync_vec, return_counts=True)
-	dup = u[c>1]
-	if(dup.size > 0): print("	- sync_vec HAS duplicate entries, so multiple photons were detected within one laser period")
+	sync_stats = calc_sync_stats(sync_vec)
+	if(sync_stats['n_duplicate_photons'] > 0): print("	- sync_vec HAS duplicate entries, so multiple photons were detected within one laser period")
 	else: print("	- sync_vec DOES NOT HAVE duplicate entries")
+	print("	- photons per laser cycle counts = {}".format(sync_stats['photons_per_cycle_counts']))
 
 	# Plot
 	plt.clf()
@@ -1,14 +1,24 @@
 #### Standard Library Imports
 import os
+import functools
+try:
+	import fcntl
+except ImportError:
+	fcntl = None # not available on Windows. JSON updates are not locked there
 
 #### Library imports
 import numpy as np
 import matplotlib.pyplot as plt
 
 #### Local imports
+from research_utils.io_ops import load_json, write_json
 
 irf_dirpath = './system_irf'
 
+N_DTIME_CODES = 2**15 # dtime codes of the TCSPC are 15-bit integers
+HIST_IMG_UINT_DTYPES = [np.uint16, np.uint32, np.uint64] # storage dtypes of histogram images (photon counts)
+DTIME_BINCOUNT_CHUNK_SIZE = 2**20 # photons counted per np.bincount call. Bounds the intp copy that np.bincount makes of its input
+
 def verify_hist_tau(hist_img_tau, hist_tbin_size):
 	if((hist_img_tau % hist_tbin_size) != 0):
 		print("Invalid hist tau. Try adding {} to end time".format(hist_img_tau % hist_tbin_size))
@@ -33,12 +43,60 @@ def get_nt(hist_img_tau, hist_tbin_size):
 	verify_hist_tau(hist_img_tau, hist_tbin_size)
 	return time2bin(hist_img_tau, hist_tbin_size)
 
-def get_hist_bins(max_tbin, tbin_size):
+@functools.lru_cache(maxsize=64)
+def _get_cached_hist_bins(max_tbin, tbin_size):
+	'''
+		get_hist_bins cached per (max_tbin, tbin_size). The arrays are shared by all callers, so they are read-only.
+		The histogramming functions return them as is. get_hist_bins returns copies
+	'''
 	verify_hist_tau(max_tbin, tbin_size)
 	bin_edges = np.arange(0, max_tbin + tbin_size, tbin_size)
 	bins = bin_edges[0:-1] + 0.5*tbin_size
+	bins.setflags(write=False)
+	bin_edges.setflags(write=False)
 	return (bins, bin_edges)
 
+def get_hist_bins(max_tbin, tbin_size):
+	'''
+		Bin centers and edges of the histogram with tbin_size bins from 0 to max_tbin.
+	'''
+	(bins, bin_edges) = _get_cached_hist_bins(max_tbin, tbin_size)
+	return (bins.copy(), bin_edges.copy())
+
+def bincount_dtime_codes(dtime_vec, n_codes=N_DTIME_CODES, code_factor=1):
+	'''
+		Number of photons of each of the first n_codes dtime codes, i.e., np.bincount(dtime_vec, minlength=n_codes)[0:n_codes].
+		With an integer code_factor > 1 the codes are first grouped into bins of code_factor consecutive codes (dtime_vec // code_factor),
+		and n_codes is the number of bins. Counted in chunks so the intp copy that np.bincount makes of non-intp inputs stays small.
+		The counts of the first chunk are the output, so inputs of a single chunk only allocate the counts
+	'''
+	dtime_counts = None
+	for start_idx in range(0, dtime_vec.size, DTIME_BINCOUNT_CHUNK_SIZE):
+		dtime_chunk = dtime_vec[start_idx:start_idx+DTIME_BINCOUNT_CHUNK_SIZE]
+		if(code_factor > 1): dtime_chunk = dtime_chunk // code_factor
+		chunk_counts = np.bincount(dtime_chunk, minlength=n_codes)[0:n_codes]
+		if(dtime_counts is None): dtime_counts = chunk_counts
+		else: dtime_counts += chunk_counts
+	if(dtime_counts is None): dtime_counts = np.zeros((n_codes,), dtype=np.int64)
+	return dtime_counts
+
+def get_dtime_code_vec_max(tstamps_vec):
+	'''
+		Largest code of tstamps_vec if it holds integer dtime codes, i.e., integers in [0, N_DTIME_CODES). -1 if it is empty.
+		None if it does not hold dtime codes
+	'''
+	if((tstamps_vec.dtype.kind not in 'ui') or (tstamps_vec.ndim != 1)): return None
+	if(tstamps_vec.size == 0): return -1
+	if((tstamps_vec.dtype.kind == 'i') and (tstamps_vec.min() < 0)): return None
+	max_code = int(tstamps_vec.max())
+	return max_code if (max_code < N_DTIME_CODES) else None
+
+def is_dtime_code_vec(tstamps_vec):
+	'''
+		True if tstamps_vec holds integer dtime codes, i.e., integers in [0, N_DTIME_CODES)
+	'''
+	return get_dtime_code_vec_max(tstamps_vec) is not None
+
 def timestamps2histogram(tstamps_vec, max_tbin, min_tbin_size, hist_tbin_factor=1):
 	''' Build histogram from timestamps loaded by the above functions
 	Outputs:
@@ -46,16 +104,233 @@ def timestamps2histogram(tstamps_vec, max_tbin, min_tbin_size, hist_tbin_factor=
 		* max_tbin: maximum tbin value
 		* min_tbin_size: time resolution. tstamps_vec*min_tbin_size == tstamps in time units
 		* hist_tbin_factor: If we want to make histogram smaller. If set to 2 the histogram will be 2x smaller, 3 --> 3x smaller, etc.
+	The returned bin_edges and bins are cached read-only arrays shared by all calls. Use get_hist_bins for writable copies
 	'''
 	hist_tbin_size = min_tbin_size*hist_tbin_factor # increase size of time bin to make histogramming faster
-	tstamps_vec = min_tbin_size*tstamps_vec # time counter to timestamps
-	(bins, bin_edges) = get_hist_bins(max_tbin, hist_tbin_size)
+	(bins, bin_edges) = _get_cached_hist_bins(max_tbin, hist_tbin_size)
+	tstamps_vec = np.asarray(tstamps_vec)
+	max_tstamp_code = get_dtime_code_vec_max(tstamps_vec) if is_integer_rebinning(max_tbin, min_tbin_size, hist_tbin_factor) else None
+	if(max_tstamp_code is not None):
+		# Uniform bins of whole dtime codes: bin = code // hist_tbin_factor (same counts as np.histogram)
+		max_code = int(max_tbin / min_tbin_size)
+		if(max_tstamp_code < max_code):
+			# No code is on the right edge of the histogram or past it, so the codes are binned straight into the counts
+			counts = bincount_dtime_codes(tstamps_vec, n_codes=bins.size, code_factor=int(hist_tbin_factor))
+		else:
+			# Only codes up to max_tbin (inclusive) are in the histogram, so larger codes are not counted
+			dtime_counts = bincount_dtime_codes(tstamps_vec, n_codes=min(max_code + 1, N_DTIME_CODES))
+			(counts, _, _) = dtime_counts2histogram(dtime_counts, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor)
+		return (counts, bin_edges, bins)
+	tstamps_vec = np.multiply(tstamps_vec, min_tbin_size, dtype=np.float64) # time counter to timestamps. In float so narrow integer codes do not overflow
 	# Use Numpy histogram function (much faster)
 	counts, _ = np.histogram(tstamps_vec, bins=bin_edges)
 	# counts, _, _ = plt.hist(tstamps_vec,bins=bins)
 	# plt.clf()
 	return (counts, bin_edges, bins)
 
+def is_integer_rebinning(max_tbin, min_tbin_size, hist_tbin_factor):
+	'''
+		True if the histogram bins are groups of hist_tbin_factor consecutive dtime codes, i.e., hist_tbin_factor and max_tbin / min_tbin_size are integers
+	'''
+	max_code = max_tbin / min_tbin_size
+	return (hist_tbin_factor == int(hist_tbin_factor)) and (max_code == int(max_code))
+
+def get_n_hist_bins(max_tbin, min_tbin_size, hist_tbin_factor=1):
+	'''
+		Number of bins of the histograms built by dtime_counts2histogram.
+		With integer rebinning the last bin can be partial, so max_tbin does not need to be a multiple of the bin size
+		(e.g., 64ps bins for the 100000ps laser period).
+	'''
+	if(not is_integer_rebinning(max_tbin, min_tbin_size, hist_tbin_factor)): return get_nt(max_tbin, min_tbin_size*hist_tbin_factor)
+	return -(-int(max_tbin / min_tbin_size) // int(hist_tbin_factor))
+
+def dtime_counts2histogram(dtime_counts, max_tbin, min_tbin_size, hist_tbin_factor=1):
+	''' Build the same histogram as timestamps2histogram from the number of photons of each dtime code,
+	i.e., from np.bincount(dtime_vec). Since there are only 2^15 dtime codes this is much cheaper than binning each timestamp.
+	Inputs:
+		* dtime_counts: number of photons of each unitless dtime code
+		* max_tbin, min_tbin_size, hist_tbin_factor: same as timestamps2histogram
+	For integer hist_tbin_factor the bins are built with integer arithmetic only (bin = code // hist_tbin_factor),
+	and max_tbin does not need to be a multiple of the bin size. See get_n_hist_bins
+	The returned bin_edges and bins are cached read-only arrays shared by all calls
+	'''
+	(bins, bin_edges) = _get_cached_dtime_hist_bins(max_tbin, min_tbin_size, hist_tbin_factor)
+	if(is_integer_rebinning(max_tbin, min_tbin_size, hist_tbin_factor)):
+		# Integer bins: each bin is the sum of hist_tbin_factor consecutive codes, summed straight into the counts
+		(hist_tbin_factor, max_code) = (int(hist_tbin_factor), int(max_tbin / min_tbin_size))
+		counts = np.zeros((bins.size,), dtype=np.int64)
+		n_codes = min(max_code, dtime_counts.size)
+		if(n_codes > 0): np.add.reduceat(dtime_counts[0:n_codes], np.arange(0, n_codes, hist_tbin_factor), dtype=np.int64, out=counts[0:-(-n_codes // hist_tbin_factor)])
+		# np.histogram includes the right edge in the last bin
+		if(dtime_counts.size > max_code): counts[-1] += dtime_counts[max_code]
+	else:
+		codes = np.arange(dtime_counts.size)
+		counts, _ = np.histogram(min_tbin_size*codes, bins=bin_edges, weights=dtime_counts)
+		counts = counts.astype(np.int64)
+	return (counts, bin_edges, bins)
+
+@functools.lru_cache(maxsize=64)
+def _get_cached_dtime_hist_bins(max_tbin, min_tbin_size, hist_tbin_factor=1):
+	'''
+		Read-only (bins, bin_edges) of dtime_counts2histogram. With integer rebinning the last bin is partial when
+		max_tbin is not a multiple of the bin size
+	'''
+	hist_tbin_size = min_tbin_size*hist_tbin_factor
+	if((not is_integer_rebinning(max_tbin, min_tbin_size, hist_tbin_factor)) or ((int(max_tbin / min_tbin_size) % int(hist_tbin_factor)) == 0)):
+		return _get_cached_hist_bins(max_tbin, hist_tbin_size)
+	n_bins = get_n_hist_bins(max_tbin, min_tbin_size, hist_tbin_factor)
+	bin_edges = np.minimum(np.arange(0, n_bins + 1)*hist_tbin_size, max_tbin).astype(np.float64)
+	bins = 0.5*(bin_edges[0:-1] + bin_edges[1:])
+	bins.setflags(write=False)
+	bin_edges.setflags(write=False)
+	return (bins, bin_edges)
+
+def get_dtime_code_bins(max_tbin, min_tbin_size, hist_tbin_factor=1, n_codes=N_DTIME_CODES):
+	'''
+		Histogram bin of each dtime code for the bins of dtime_counts2histogram. -1 for codes outside of the histogram
+	'''
+	n_bins = get_n_hist_bins(max_tbin, min_tbin_size, hist_tbin_factor)
+	codes = np.arange(n_codes)
+	if(is_integer_rebinning(max_tbin, min_tbin_size, hist_tbin_factor)):
+		max_code = int(max_tbin / min_tbin_size)
+		code_bins = codes // int(hist_tbin_factor)
+		code_bins[codes == max_code] = n_bins - 1 # np.histogram includes the right edge in the last bin
+		code_bins[codes > max_code] = -1
+	else:
+		(_, bin_edges) = _get_cached_hist_bins(max_tbin, min_tbin_size*hist_tbin_factor)
+		code_times = min_tbin_size*codes
+		code_bins = np.searchsorted(bin_edges, code_times, side='right') - 1
+		code_bins[code_times == bin_edges[-1]] = n_bins - 1
+		code_bins[np.logical_or(code_times < bin_edges[0], code_times > bin_edges[-1])] = -1
+	return code_bins
+
+def dtime_codes2histograms(dtime_vec, pixel_offsets, max_tbin, min_tbin_size, hist_tbin_factor=1, chunk_size=DTIME_BINCOUNT_CHUNK_SIZE, out=None):
+	'''
+		Histograms of many pixels at once from their concatenated dtime codes.
+		Inputs:
+			* dtime_vec: dtime codes of all pixels, concatenated
+			* pixel_offsets: (n_pixels+1,) the codes of pixel p are dtime_vec[pixel_offsets[p]:pixel_offsets[p+1]]
+			* max_tbin, min_tbin_size, hist_tbin_factor: same bins as dtime_counts2histogram
+			* chunk_size: number of photons binned at a time. Chunks are also cut so they span at most chunk_size // n_bins pixels
+			* out: optional contiguous array with n_pixels*n_bins elements that the counts are added to, with the pixels in the order of pixel_offsets
+		The photons of each chunk are binned with a single np.bincount over pixel_id*n_bins + bin, so memory is bounded by chunk_size
+		Outputs:
+			* (n_pixels, n_bins) histograms, or out if given
+	'''
+	pixel_offsets = np.asarray(pixel_offsets, dtype=np.int64)
+	n_pixels = pixel_offsets.size - 1
+	n_bins = get_n_hist_bins(max_tbin, min_tbin_size, hist_tbin_factor)
+	code_bins = get_dtime_code_bins(max_tbin, min_tbin_size, hist_tbin_factor)
+	if(out is None): out = np.zeros((n_pixels, n_bins), dtype=np.int64)
+	hists = out.reshape((n_pixels, n_bins))
+	assert(np.may_share_memory(hists, out)), "out needs to be contiguous"
+	max_chunk_n_pixels = max(1, chunk_size // n_bins)
+	chunk_start = pixel_offsets[0]
+	while(chunk_start < pixel_offsets[-1]):
+		# Pixels with photons in [chunk_start, chunk_end)
+		first_pixel = int(np.searchsorted(pixel_offsets, chunk_start, side='right')) - 1
+		chunk_end = min(chunk_start + chunk_size, pixel_offsets[min(first_pixel + max_chunk_n_pixels, n_pixels)])
+		last_pixel = int(np.searchsorted(pixel_offsets, chunk_end - 1, side='right')) - 1
+		chunk_pixel_n_photons = np.minimum(pixel_offsets[first_pixel+1:last_pixel+2], chunk_end) - np.maximum(pixel_offsets[first_pixel:last_pixel+1], chunk_start)
+		chunk_pixel_ids = np.repeat(np.arange(last_pixel - first_pixel + 1), chunk_pixel_n_photons)
+		chunk_bins = code_bins[dtime_vec[chunk_start:chunk_end]]
+		is_in_hist = chunk_bins >= 0
+		chunk_hists = np.bincount(chunk_pixel_ids[is_in_hist]*n_bins + chunk_bins[is_in_hist], minlength=(last_pixel - first_pixel + 1)*n_bins)
+		np.add(hists[first_pixel:last_pixel+1], chunk_hists.reshape((-1, n_bins)), out=hists[first_pixel:last_pixel+1], casting='unsafe')
+		chunk_start = chunk_end
+	return out
+
+def rebin_histogram(counts, rebin_factor):
+	'''
+		Sum each group of rebin_factor adjacent bins along the last axis. If the number of bins is not a multiple of
+		rebin_factor the last bin is partial, so rebinning the output of dtime_counts2histogram by k gives the histogram
+		of a k times larger hist_tbin_factor (see get_n_hist_bins)
+	'''
+	n_bins = counts.shape[-1]
+	n_rebinned_bins = -(-n_bins // rebin_factor)
+	n_pad_bins = n_rebinned_bins*rebin_factor - n_bins
+	if(n_pad_bins > 0): counts = np.concatenate((counts, np.zeros(counts.shape[0:-1] + (n_pad_bins,), dtype=counts.dtype)), axis=-1)
+	return counts.reshape(counts.shape[0:-1] + (n_rebinned_bins, rebin_factor)).sum(axis=-1)
+
+def get_hist_crop_bins(hist_preprocessing_params, hist_tbin_size):
+	'''
+		(start_bin, end_bin, shift_bin) of the crop window and circular shift in the hist_preprocessing_params of scan_params.json
+	'''
+	hist_start_bin = time2bin(hist_preprocessing_params['hist_start_time'], hist_tbin_size)
+	hist_end_bin = time2bin(hist_preprocessing_params['hist_end_time'], hist_tbin_size)
+	hist_shift_bin = time2bin(hist_preprocessing_params['hist_shift_time'], hist_tbin_size)
+	return (hist_start_bin, hist_end_bin, hist_shift_bin)
+
+def crop_shift_histogram(counts, hist_crop_bins):
+	'''
+		Crop the time bins [start_bin, end_bin) of the histograms in counts and circularly shift them by shift_bin (along the last axis)
+		* hist_crop_bins: (start_bin, end_bin, shift_bin). See get_hist_crop_bins
+	'''
+	(hist_start_bin, hist_end_bin, hist_shift_bin) = hist_crop_bins
+	return np.roll(counts[..., hist_start_bin:hist_end_bin], hist_shift_bin, axis=-1)
+
+def get_min_uint_dtype(max_count):
+	'''
+		Narrowest unsigned integer dtype in HIST_IMG_UINT_DTYPES that can store max_count.
+		Raises ValueError if max_count is negative or does not fit in any of them
+	'''
+	if(max_count >= 0):
+		for dtype in HIST_IMG_UINT_DTYPES:
+			if(max_count <= np.iinfo(dtype).max): return np.dtype(dtype)
+	raise ValueError("max_count = {} does not fit in any of the histogram image dtypes".format(max_count))
+
+def to_min_uint_dtype(hist_img):
+	'''
+		Cast a histogram image (photon counts) to the narrowest unsigned integer dtype that can store all its counts
+	'''
+	max_count = hist_img.max() if (hist_img.size > 0) else 0
+	return hist_img.astype(get_min_uint_dtype(max_count), copy=False)
+
+def convert_hist_img_file_dtype(hist_img_fpath, dtype, block_n_rows=8):
+	'''
+		Rewrite a histogram image .npy file with the given dtype, in blocks of rows so it is never fully loaded in memory.
+	'''
+	hist_img = np.load(hist_img_fpath, mmap_mode='r')
+	if(hist_img.dtype == dtype): return
+	tmp_fpath = hist_img_fpath.replace('.npy', '.tmp.npy')
+	converted_hist_img = np.lib.format.open_memmap(tmp_fpath, mode='w+', dtype=dtype, shape=hist_img.shape)
+	for start_row in range(0, hist_img.shape[0], block_n_rows):
+		converted_hist_img[start_row:start_row+block_n_rows] = hist_img[start_row:start_row+block_n_rows]
+	converted_hist_img.flush()
+	del converted_hist_img, hist_img
+	os.replace(tmp_fpath, hist_img_fpath)
+
+def narrow_hist_img_file(hist_img_fpath, block_n_rows=8):
+	'''
+		Rewrite a histogram image .npy file with the narrowest unsigned integer dtype that can store all its counts.
+		The image is processed in blocks of rows so it is never fully loaded in memory. The dtype is recorded in the .npy header.
+		Returns the dtype of the file
+	'''
+	hist_img = np.load(hist_img_fpath, mmap_mode='r')
+	max_count = 0
+	for start_row in range(0, hist_img.shape[0], block_n_rows):
+		max_count = max(max_count, int(hist_img[start_row:start_row+block_n_rows].max()))
+	del hist_img
+	dtype = get_min_uint_dtype(max_count)
+	convert_hist_img_file_dtype(hist_img_fpath, dtype, block_n_rows=block_n_rows)
+	return dtype
+
+def update_json_locked(json_fpath, update_func):
+	'''
+		Read-modify-write json_fpath while holding an exclusive lock on json_fpath + '.lock'.
+		update_func(json_dict) modifies the dict in place. The file is re-read under the lock and written to a temporary
+		file that replaces it, so concurrent updates from several processes (e.g., scenes run by batch_runner.py) are never
+		lost and readers never see a partially written file. Returns the updated dict
+	'''
+	with open(json_fpath + '.lock', 'w') as lock_file:
+		if(fcntl is not None): fcntl.flock(lock_file, fcntl.LOCK_EX)
+		json_dict = load_json(json_fpath)
+		update_func(json_dict)
+		tmp_fpath = json_fpath + '.tmp'
+		write_json(tmp_fpath, json_dict)
+		os.replace(tmp_fpath, json_fpath)
+	return json_dict
+
 def vector2img(v, nr, nc):
 	'''
 		Transform vectorized pixels to img. This function is specifically tailored to the way that scan data was acquired
@@ -143,10 +418,86 @@ def get_depth_lims(scene_id):
 	else: (min_d, max_d) = (300, 2600)
 	return (min_d, max_d)
 
+def init_sync_stats():
+	'''
+		Streaming laser cycle statistics of a non-decreasing sync_vec. Update them with each chunk of sync_vec in order
+		(see update_sync_stats), and get the results with get_sync_stats
+	'''
+	return {
+		'n_photons': 0
+		, 'n_nonempty_laser_cycles': 0
+		, 'last_sync': -1
+		, 'open_cycle_n_photons': 0 # photons of the last laser cycle seen, which can continue in the next chunk
+		, 'cycle_n_photons_counts': np.zeros((1,), dtype=np.int64) # number of closed laser cycles with k photons (k >= 1)
+		, 'is_sync_sorted': True
+	}
+
+def update_sync_stats(sync_stats, sync_vec):
+	'''
+		Add the next chunk of sync_vec to sync_stats in a single linear pass. Since sync_vec is non-decreasing, each laser
+		cycle with photons is a run of equal sync numbers, so nothing needs to be sorted.
+		If sync_vec is not sorted sync_stats['is_sync_sorted'] is set to False and the cycle counts are not valid
+	'''
+	if(sync_vec.size == 0): return sync_stats
+	sync_diffs = np.diff(sync_vec, prepend=sync_stats['last_sync'])
+	sync_stats['is_sync_sorted'] = sync_stats['is_sync_sorted'] and bool(np.all(sync_diffs >= 0))
+	# Photons that start a new laser cycle
+	cycle_starts = np.flatnonzero(sync_diffs)
+	if(cycle_starts.size == 0):
+		sync_stats['open_cycle_n_photons'] += sync_vec.size
+	else:
+		# Close the open cycle, and count the photons of the cycles that end in this chunk
+		cycle_n_photons = np.diff(cycle_starts, append=sync_vec.size)
+		closed_cycle_n_photons = np.concatenate(([sync_stats['open_cycle_n_photons'] + cycle_starts[0]], cycle_n_photons[0:-1]))
+		closed_cycle_n_photons = closed_cycle_n_photons[closed_cycle_n_photons > 0]
+		chunk_counts = np.bincount(closed_cycle_n_photons, minlength=sync_stats['cycle_n_photons_counts'].size)
+		chunk_counts[0:sync_stats['cycle_n_photons_counts'].size] += sync_stats['cycle_n_photons_counts']
+		sync_stats['cycle_n_photons_counts'] = chunk_counts
+		sync_stats['open_cycle_n_photons'] = int(cycle_n_photons[-1])
+	sync_stats['n_nonempty_laser_cycles'] += cycle_starts.size
+	sync_stats['n_photons'] += sync_vec.size
+	sync_stats['last_sync'] = int(sync_vec[-1])
+	return sync_stats
+
+def get_sync_stats(sync_stats):
+	'''
+		Results of the sync_vec chunks added to sync_stats:
+		* n_photons
+		* n_laser_cycles: sync_vec.max(). 0 if there are no photons
+		* n_nonempty_laser_cycles: number of distinct sync numbers
+		* n_empty_laser_cycles: n_laser_cycles - n_nonempty_laser_cycles. 0 if there are no photons
+		* n_duplicate_photons: photons that share a laser cycle with the previous photon
+		* photons_per_cycle_counts: element k is the number of laser cycles with k photons. Element 0 is n_empty_laser_cycles
+		* is_sync_sorted: if False the laser cycle counts are not valid
+	'''
+	photons_per_cycle_counts = np.array(sync_stats['cycle_n_photons_counts'])
+	open_cycle_n_photons = sync_stats['open_cycle_n_photons']
+	if(open_cycle_n_photons >= photons_per_cycle_counts.size): photons_per_cycle_counts = np.concatenate((photons_per_cycle_counts, np.zeros((open_cycle_n_photons + 1 - photons_per_cycle_counts.size,), dtype=np.int64)))
+	if(open_cycle_n_photons > 0): photons_per_cycle_counts[open_cycle_n_photons] += 1
+	n_laser_cycles = max(sync_stats['last_sync'], 0)
+	n_empty_laser_cycles = (n_laser_cycles - sync_stats['n_nonempty_laser_cycles']) if (sync_stats['n_photons'] > 0) else 0
+	photons_per_cycle_counts[0] = n_empty_laser_cycles
+	return {
+		'n_photons': sync_stats['n_photons']
+		, 'n_laser_cycles': n_laser_cycles
+		, 'n_nonempty_laser_cycles': sync_stats['n_nonempty_laser_cycles']
+		, 'n_empty_laser_cycles': n_empty_laser_cycles
+		, 'n_duplicate_photons': sync_stats['n_photons'] - sync_stats['n_nonempty_laser_cycles']
+		, 'photons_per_cycle_counts': photons_per_cycle_counts
+		, 'is_sync_sorted': sync_stats['is_sync_sorted']
+	}
+
+def calc_sync_stats(sync_vec):
+	return get_sync_stats(update_sync_stats(init_sync_stats(), sync_vec))
+
 def calc_n_empty_laser_cycles(sync_vec):
-	max_laser_cycles = sync_vec.max()
-	u, c = np.unique(sync_vec, return_counts=True)
-	n_nonempty_laser_cycles = u.size
+	'''
+		Laser cycles (up to sync_vec.max()) without photons. Linear time for sorted sync_vec (the output of the readers).
+		Unsorted sync_vec falls back to np.unique
+	'''
+	sync_stats = calc_sync_stats(sync_vec)
+	if(sync_stats['is_sync_sorted']): (max_laser_cycles, n_nonempty_laser_cycles) = (sync_stats['n_laser_cycles'], sync_stats['n_nonempty_laser_cycles'])
+	else: (max_laser_cycles, n_nonempty_laser_cycles) = (sync_vec.max(), np.unique(sync_vec).size)
 	assert(max_laser_cycles >= n_nonempty_laser_cycles), "something is wrong with sync_vec"
 	return max_laser_cycles - n_nonempty_laser_cycles
 
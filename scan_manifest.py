@@ -0,0 +1,113 @@
+'''
+	Persistent per-scene manifest of the raw timestamp files (t3mode_*.out files) of a scan.
+	Building the file list of a scan requires listing its directory, parsing every filename, sorting them by scan
+	position, and parsing positions_file.txt, which can take minutes for tens of thousands of files on a network filesystem.
+	The manifest stores the result as a JSON file so that later runs only need to stat the directory and the positions file.
+	It is rebuilt automatically when the directory (files added, removed or renamed) or the positions file changes.
+	It also stores the size and mtime of each file. Files re-written in place do not change the directory, so the incremental
+	ingest refreshes them (see refresh_scan_manifest_file_stats) and uses them to find the pixels whose files changed.
+'''
+#### Standard Library Imports
+import os
+import fnmatch
+
+#### Library imports
+import numpy as np
+
+#### Local imports
+from scan_data_utils import vector2img
+from read_hydraharp_outfile_t3 import parse_scan_pos_idx, parse_is_long_cable_flag, parse_delay_param, count_params_in_fname
+from read_positions_file import read_positions_file, get_coords, POSITIONS_FNAME
+from research_utils.io_ops import load_json, write_json
+
+SCAN_MANIFEST_VERSION = 1
+SCAN_MANIFEST_FNAME = 'scan-manifest.json'
+T3_FNAME_PATTERN = 't3mode_*_*_*.out'
+
+def get_scan_dir_stats(dirpath):
+	'''
+		mtime (in ns) of the scan directory, and size and mtime of its positions file. Used to detect when a manifest is stale
+	'''
+	dir_stat = os.stat(dirpath)
+	positions_stat = os.stat(os.path.join(dirpath, POSITIONS_FNAME))
+	return {'dir_mtime_ns': int(dir_stat.st_mtime_ns), 'positions_fsize': int(positions_stat.st_size), 'positions_mtime_ns': int(positions_stat.st_mtime_ns)}
+
+def build_scan_manifest(dirpath):
+	'''
+		List and parse the .out files of the scan in dirpath in a single pass over the directory.
+		Returns the manifest dict. Per-file lists are sorted by scan position (the order of positions_file.txt).
+	'''
+	scan_dir_stats = get_scan_dir_stats(dirpath)
+	with os.scandir(dirpath) as dir_entries:
+		entries = [entry for entry in dir_entries if (fnmatch.fnmatch(entry.name, T3_FNAME_PATTERN) and entry.is_file())]
+	assert(len(entries) > 0), "No {} files in {}".format(T3_FNAME_PATTERN, dirpath)
+	assert(count_params_in_fname(entries[0].name) == 3), 'Invalid fname {}. Expected fname with 3 params'.format(entries[0].name)
+	entries.sort(key=lambda entry: parse_scan_pos_idx(entry.name))
+	file_stats = [entry.stat() for entry in entries]
+	fnames = [entry.name for entry in entries]
+	pos_data = read_positions_file(os.path.join(dirpath, POSITIONS_FNAME))
+	(x_coords, y_coords) = get_coords(pos_data)
+	(n_rows_fullres, n_cols_fullres) = (y_coords.size, x_coords.size)
+	manifest = {
+		'version': SCAN_MANIFEST_VERSION
+		, 'fnames': fnames
+		, 'scan_pos_indeces': [parse_scan_pos_idx(fname) for fname in fnames]
+		, 'is_long_cable_flags': [parse_is_long_cable_flag(fname) for fname in fnames]
+		, 'delay_params': [parse_delay_param(fname) for fname in fnames]
+		, 'fsizes': [int(s.st_size) for s in file_stats]
+		, 'mtimes': [int(s.st_mtime_ns) for s in file_stats]
+		, 'n_positions': int(pos_data.shape[0])
+		, 'x_coords': x_coords.tolist()
+		, 'y_coords': y_coords.tolist()
+		, 'n_rows_fullres': int(n_rows_fullres)
+		, 'n_cols_fullres': int(n_cols_fullres)
+	}
+	# Index in fnames of the file of each pixel. Only valid if there is one file per position
+	if(len(fnames) == n_rows_fullres*n_cols_fullres):
+		manifest['file_indeces_img'] = vector2img(np.arange(len(fnames)), n_rows_fullres, n_cols_fullres).tolist()
+	manifest.update(scan_dir_stats)
+	return manifest
+
+def is_scan_manifest_valid(manifest, dirpath):
+	'''
+		A manifest is valid if it has the current version, and the scan directory and its positions file did not change since it was built
+	'''
+	if(manifest.get('version') != SCAN_MANIFEST_VERSION): return False
+	scan_dir_stats = get_scan_dir_stats(dirpath)
+	return all([manifest.get(key) == val for (key, val) in scan_dir_stats.items()])
+
+def refresh_scan_manifest_file_stats(manifest, dirpath):
+	'''
+		Update the size and mtime of each file of the manifest with a single pass over the scan directory.
+		Files that are missing get a size and mtime of -1. Returns True if any of them changed
+	'''
+	with os.scandir(dirpath) as dir_entries:
+		file_stats = {entry.name: entry.stat() for entry in dir_entries if fnmatch.fnmatch(entry.name, T3_FNAME_PATTERN)}
+	fsizes = [int(file_stats[fname].st_size) if (fname in file_stats) else -1 for fname in manifest['fnames']]
+	mtimes = [int(file_stats[fname].st_mtime_ns) if (fname in file_stats) else -1 for fname in manifest['fnames']]
+	is_changed = (fsizes != manifest['fsizes']) or (mtimes != manifest['mtimes'])
+	(manifest['fsizes'], manifest['mtimes']) = (fsizes, mtimes)
+	return is_changed
+
+def load_scan_manifest(dirpath, manifest_fpath, refresh_file_stats=False):
+	'''
+		Load the manifest of the scan in dirpath from manifest_fpath. If it does not exist or is stale it is rebuilt and saved.
+		If refresh_file_stats is True the file sizes and mtimes of a loaded manifest are refreshed (a rebuilt one already has them)
+	'''
+	if(os.path.exists(manifest_fpath)):
+		manifest = load_json(manifest_fpath)
+		if(is_scan_manifest_valid(manifest, dirpath)):
+			if(refresh_file_stats and refresh_scan_manifest_file_stats(manifest, dirpath)): write_json(manifest_fpath, manifest)
+			return manifest
+	manifest = build_scan_manifest(dirpath)
+	write_json(manifest_fpath, manifest)
+	return manifest
+
+def get_manifest_fpaths(manifest, dirpath):
+	return [os.path.join(dirpath, fname) for fname in manifest['fnames']]
+
+def get_manifest_file_stats(manifest):
+	'''
+		(fsizes, mtimes) of the files of the manifest, in the same format as get_file_stats
+	'''
+	return (manifest['fsizes'], manifest['mtimes'])
@@ -0,0 +1,199 @@
+'''
+	Sparse (CSR) container for histogram images. Useful for low flux scans where most time bins of each pixel are 0.
+	A sparse histogram image of shape (nr, nc, nt) is a dict with:
+	* shape: (nr, nc, nt)
+	* indptr: (nr*nc + 1,) the non-zero bins of pixel p = i*nc + j are in [indptr[p], indptr[p+1])
+	* indices: time bin index of each non-zero bin. Sorted within each pixel
+	* counts: photon counts of each non-zero bin
+	It is stored as an uncompressed .npz file, and is only converted to a dense array (or a crop of it) when asked.
+	The full-scan builder produces it directly: while ingesting, the non-zero bins of each pixel are appended to a
+	parts directory (see open_sparse_hist_img_parts), which is compacted into the .npz once all pixels are done.
+'''
+#### Standard Library Imports
+import os
+import shutil
+
+#### Library imports
+import numpy as np
+
+#### Local imports
+from scan_data_utils import get_min_uint_dtype
+
+# dtypes of the parts files. indices/counts are narrowed when the parts are assembled
+SPARSE_PARTS_INDICES_DTYPE = np.dtype('<i4')
+SPARSE_PARTS_COUNTS_DTYPE = np.dtype('<u4')
+
+def get_pixel_ids(sparse_hist_img):
+	'''
+		Flat pixel id (i*nc + j) of each non-zero bin
+	'''
+	(nr, nc, _) = sparse_hist_img['shape']
+	return np.repeat(np.arange(nr*nc), np.diff(sparse_hist_img['indptr']))
+
+def dense2sparse_hist_img(hist_img, block_n_rows=8):
+	'''
+		Convert a dense (nr, nc, nt) histogram image into a sparse one. hist_img can be a memmap, it is read in blocks of rows.
+	'''
+	(nr, nc, nt) = hist_img.shape
+	(nnz_list, indices_list, counts_list) = ([], [], [])
+	for start_row in range(0, nr, block_n_rows):
+		hist_block = np.asarray(hist_img[start_row:start_row+block_n_rows]).reshape((-1, nt))
+		(pixel_ids, indices) = np.nonzero(hist_block)
+		nnz_list.append(np.bincount(pixel_ids, minlength=hist_block.shape[0]))
+		indices_list.append(indices)
+		counts_list.append(hist_block[pixel_ids, indices])
+	indptr = np.concatenate(([0], np.cumsum(np.concatenate(nnz_list)))).astype(np.int64)
+	indices = np.concatenate(indices_list)
+	counts = np.concatenate(counts_list)
+	return {
+		'shape': (nr, nc, nt)
+		, 'indptr': indptr
+		, 'indices': indices.astype(get_min_uint_dtype(nt-1))
+		, 'counts': counts.astype(get_min_uint_dtype(counts.max() if (counts.size > 0) else 0))
+	}
+
+def sparse2dense_hist_img(sparse_hist_img, rows=slice(None), cols=slice(None), start_bin=0, end_bin=None, dtype=None):
+	'''
+		Dense crop sparse_hist_img[rows, cols, start_bin:end_bin]. Only the non-zero bins of the selected pixels are read.
+		Inputs:
+			* rows, cols: slices (or index arrays) of the pixels to convert. Default to the whole image
+			* start_bin, end_bin: time bins to keep. Same as slicing the last dimension of the dense image
+			* dtype: dtype of the dense output. Defaults to the dtype of the counts
+	'''
+	(nr, nc, nt) = sparse_hist_img['shape']
+	(start_bin, end_bin, _) = slice(start_bin, end_bin).indices(nt)
+	end_bin = max(start_bin, end_bin)
+	pixel_ids = np.arange(nr*nc).reshape((nr, nc))[rows, cols]
+	out_shape = pixel_ids.shape + (end_bin - start_bin,)
+	if(dtype is None): dtype = sparse_hist_img['counts'].dtype
+	hist_img = np.zeros((pixel_ids.size, out_shape[-1]), dtype=dtype)
+	indptr = sparse_hist_img['indptr']
+	(starts, nnz) = (indptr[pixel_ids.ravel()], np.diff(indptr)[pixel_ids.ravel()])
+	# Index of every non-zero bin of the selected pixels, and the output pixel it goes to
+	out_pixel_ids = np.repeat(np.arange(pixel_ids.size), nnz)
+	entry_ids = np.arange(out_pixel_ids.size) - np.repeat(np.cumsum(nnz) - nnz, nnz) + np.repeat(starts, nnz)
+	bins = sparse_hist_img['indices'][entry_ids].astype(np.int64)
+	in_crop = np.logical_and(bins >= start_bin, bins < end_bin)
+	hist_img[out_pixel_ids[in_crop], bins[in_crop] - start_bin] = sparse_hist_img['counts'][entry_ids[in_crop]]
+	return hist_img.reshape(out_shape)
+
+def calc_sparse_hist_img_summary(sparse_hist_img):
+	'''
+		Same as (hist_img.sum(axis=-1), hist_img.max(axis=-1), hist_img.argmax(axis=-1)) without building the dense image
+	'''
+	(nr, nc, _) = sparse_hist_img['shape']
+	pixel_ids = get_pixel_ids(sparse_hist_img)
+	counts = sparse_hist_img['counts']
+	nphotons_img = np.bincount(pixel_ids, weights=counts, minlength=nr*nc).astype(np.int64)
+	maxpeak_img = np.zeros((nr*nc,), dtype=counts.dtype)
+	np.maximum.at(maxpeak_img, pixel_ids, counts)
+	# indices are sorted within each pixel, so the first bin with the max count matches np.argmax
+	is_maxpeak = counts == maxpeak_img[pixel_ids]
+	(maxpeak_pixel_ids, first_idx) = np.unique(pixel_ids[is_maxpeak], return_index=True)
+	argmax_img = np.zeros((nr*nc,), dtype=np.int64)
+	argmax_img[maxpeak_pixel_ids] = sparse_hist_img['indices'][is_maxpeak][first_idx]
+	return (nphotons_img.reshape((nr, nc)), maxpeak_img.reshape((nr, nc)), argmax_img.reshape((nr, nc)))
+
+def save_sparse_hist_img(fpath, sparse_hist_img):
+	'''
+		Save as an uncompressed .npz file. Written to a temporary file first so a partial file is never left at fpath
+	'''
+	assert(fpath.endswith('.npz')), "sparse histogram images are stored as .npz files"
+	tmp_fpath = fpath.replace('.npz', '.tmp.npz')
+	np.savez(tmp_fpath, shape=np.array(sparse_hist_img['shape'], dtype=np.int64), indptr=sparse_hist_img['indptr'], indices=sparse_hist_img['indices'], counts=sparse_hist_img['counts'])
+	os.replace(tmp_fpath, fpath)
+
+def load_sparse_hist_img(fpath):
+	with np.load(fpath) as data:
+		return {
+			'shape': tuple(int(n) for n in data['shape'])
+			, 'indptr': data['indptr']
+			, 'indices': data['indices']
+			, 'counts': data['counts']
+		}
+
+def load_hist_img(hist_img_fpath, start_bin=0, end_bin=None, dtype=None):
+	'''
+		Load hist_img[..., start_bin:end_bin] as a dense array from either a dense .npy or a sparse .npz histogram image.
+		Dense images are memory-mapped, so only the cropped bins are read.
+	'''
+	if(hist_img_fpath.endswith('.npz')):
+		return sparse2dense_hist_img(load_sparse_hist_img(hist_img_fpath), start_bin=start_bin, end_bin=end_bin, dtype=dtype)
+	hist_img = np.load(hist_img_fpath, mmap_mode='r')[..., start_bin:end_bin]
+	if(dtype is None): dtype = hist_img.dtype
+	return np.array(hist_img, dtype=dtype)
+
+def get_sparse_hist_img_parts_dirpath(fpath):
+	return fpath.replace('.npz', '.parts')
+
+def open_sparse_hist_img_parts(parts_dirpath, shape, resume=False):
+	'''
+		Open the parts directory where the full-scan builder appends the non-zero bins of each pixel as it is ingested:
+		* indices.bin / counts.bin: the non-zero bins of all ingested pixels, in completion order
+		* pixel-ranges.npy: (nr, nc, 2) memory-mapped (start, nnz) of each pixel in indices.bin/counts.bin
+		* n-bins.npy: number of time bins of the histograms
+		Pixels that are ingested again (e.g., after a crash) are appended again and their range is overwritten.
+		If resume is True and the parts exist with the right shape they are opened in place.
+		Returns (parts, is_resumed)
+	'''
+	(nr, nc, nt) = shape
+	pixel_ranges_fpath = os.path.join(parts_dirpath, 'pixel-ranges.npy')
+	n_bins_fpath = os.path.join(parts_dirpath, 'n-bins.npy')
+	is_resumed = False
+	if(resume and os.path.exists(pixel_ranges_fpath) and os.path.exists(n_bins_fpath)):
+		pixel_ranges = np.load(pixel_ranges_fpath, mmap_mode='r+')
+		is_resumed = (pixel_ranges.shape == (nr, nc, 2)) and (int(np.load(n_bins_fpath)) == nt)
+		if(not is_resumed): del pixel_ranges
+	if(not is_resumed):
+		if(os.path.exists(parts_dirpath)): shutil.rmtree(parts_dirpath)
+		os.makedirs(parts_dirpath)
+		np.save(n_bins_fpath, np.array(nt, dtype=np.int64))
+		pixel_ranges = np.lib.format.open_memmap(pixel_ranges_fpath, mode='w+', dtype=np.int64, shape=(nr, nc, 2))
+	parts = {'dirpath': parts_dirpath, 'shape': (nr, nc, nt), 'pixel_ranges': pixel_ranges}
+	parts['indices_file'] = open(os.path.join(parts_dirpath, 'indices.bin'), 'ab')
+	parts['counts_file'] = open(os.path.join(parts_dirpath, 'counts.bin'), 'ab')
+	return (parts, is_resumed)
+
+def append_sparse_hist_img_pixel(parts, i, j, indices, counts):
+	'''
+		Append the non-zero bins (indices, counts) of pixel (i,j) to the parts
+	'''
+	start = parts['counts_file'].seek(0, os.SEEK_END) // SPARSE_PARTS_COUNTS_DTYPE.itemsize
+	np.asarray(indices, dtype=SPARSE_PARTS_INDICES_DTYPE).tofile(parts['indices_file'])
+	np.asarray(counts, dtype=SPARSE_PARTS_COUNTS_DTYPE).tofile(parts['counts_file'])
+	parts['pixel_ranges'][i,j] = (start, len(counts))
+
+def flush_sparse_hist_img_parts(parts):
+	'''
+		Flush the appended bins before the pixel ranges, so a flushed range never points past the end of the parts files
+	'''
+	parts['indices_file'].flush()
+	parts['counts_file'].flush()
+	parts['pixel_ranges'].flush()
+
+def close_sparse_hist_img_parts(parts):
+	flush_sparse_hist_img_parts(parts)
+	parts['indices_file'].close()
+	parts['counts_file'].close()
+
+def assemble_sparse_hist_img(parts_dirpath, fpath):
+	'''
+		Compact the parts of a finished ingest into a sparse histogram image in row-major pixel order, save it at fpath,
+		and remove the parts directory. Returns the sparse histogram image
+	'''
+	pixel_ranges = np.load(os.path.join(parts_dirpath, 'pixel-ranges.npy'))
+	(nr, nc, _) = pixel_ranges.shape
+	(starts, nnz) = (pixel_ranges[...,0].ravel(), pixel_ranges[...,1].ravel())
+	entry_ids = np.arange(nnz.sum()) - np.repeat(np.cumsum(nnz) - nnz, nnz) + np.repeat(starts, nnz)
+	indices = np.fromfile(os.path.join(parts_dirpath, 'indices.bin'), dtype=SPARSE_PARTS_INDICES_DTYPE)[entry_ids]
+	counts = np.fromfile(os.path.join(parts_dirpath, 'counts.bin'), dtype=SPARSE_PARTS_COUNTS_DTYPE)[entry_ids]
+	nt = int(np.load(os.path.join(parts_dirpath, 'n-bins.npy')))
+	sparse_hist_img = {
+		'shape': (nr, nc, nt)
+		, 'indptr': np.concatenate(([0], np.cumsum(nnz))).astype(np.int64)
+		, 'indices': indices.astype(get_min_uint_dtype(nt-1))
+		, 'counts': counts.astype(get_min_uint_dtype(counts.max() if (counts.size > 0) else 0))
+	}
+	save_sparse_hist_img(fpath, sparse_hist_img)
+	shutil.rmtree(parts_dirpath)
+	return sparse_hist_img
@@ -0,0 +1,87 @@
+## Standard Library Imports
+import os
+import sys
+import json
+import tempfile
+import multiprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+## Library Imports
+import numpy as np
+
+## Local Imports
+from batch_runner import *
+from scan_data_utils import update_json_locked
+
+SCAN_PARAMS = {
+	'laser_rep_freq': 10e6
+	, 'min_tbin_size': 8
+	, 'hist_preprocessing_params': {'hist_start_time': 1000, 'hist_end_time': 9000, 'hist_shift_time': 500}
+	, 'scene_params': {'default': {'n_rows_fullres': 10, 'n_cols_fullres': 10}, 'small': {'n_rows_fullres': 10, 'n_cols_fullres': 10}, 'large': {'n_rows_fullres': 100, 'n_cols_fullres': 100}}
+}
+
+# Dummy stage script: appends its stage name to <scene>.txt, and fails for scenes named 'bad*'
+STAGE_SCRIPT = '''import sys
+scene_id = sys.argv[1]
+with open(scene_id + '.txt', 'a') as f: f.write('{stage}\\n')
+if(scene_id.startswith('bad') and ('{stage}' == 'preprocess')): sys.exit(1)
+'''
+
+def test_select_scene_ids_and_stages():
+	scene_ids = ['deer/free', 'deer/det', 'face/free', 'blocks']
+	assert(select_scene_ids(scene_ids, ['*']) == scene_ids), "* should match all scenes"
+	assert(select_scene_ids(scene_ids, ['*/free', 'blocks']) == ['deer/free', 'face/free', 'blocks']), "wrong scenes selected"
+	assert(select_stages(['depth', 'ingest']) == ['ingest', 'depth']), "stages should be sorted in run order"
+	print("PASSED test_select_scene_ids_and_stages")
+
+def test_estimate_and_pick_scene_jobs():
+	(small_mem, large_mem) = [estimate_scene_job_mem(SCAN_PARAMS, scene_id, SCENE_STAGES) for scene_id in ['small', 'large']]
+	assert(large_mem == 100*small_mem), "memory estimate should scale with the number of pixels"
+	assert(estimate_scene_job_mem(SCAN_PARAMS, 'new_scene', ['ingest']) == 4*100*12500), "new scenes should use the default dims"
+	pending_jobs = [('a', 10), ('b', 6), ('c', 3)]
+	assert(pick_next_scene_job(pending_jobs, running_mem=0, max_mem=5, n_running=0) == 0), "a job larger than the budget runs alone"
+	assert(pick_next_scene_job(pending_jobs, running_mem=10, max_mem=12, n_running=1) is None), "no job fits"
+	assert(pick_next_scene_job(pending_jobs, running_mem=8, max_mem=12, n_running=1) == 2), "only the smallest job fits"
+	assert(pick_next_scene_job(pending_jobs, running_mem=4, max_mem=12, n_running=1) == 1), "the largest job that fits runs first"
+	assert(pick_next_scene_job([], running_mem=0, max_mem=12, n_running=0) is None), "no pending jobs"
+	print("PASSED test_estimate_and_pick_scene_jobs")
+
+def test_run_scene_jobs():
+	with tempfile.TemporaryDirectory() as dirpath:
+		stage_scripts = {}
+		for stage in SCENE_STAGES:
+			stage_scripts[stage] = os.path.join(dirpath, '{}.py'.format(stage))
+			with open(stage_scripts[stage], 'w') as f: f.write(STAGE_SCRIPT.format(stage=stage))
+		scene_ids = ['good0', 'bad0', 'good1']
+		failed_stages = run_scene_jobs(scene_ids, ['depth', 'ingest', 'preprocess'], SCAN_PARAMS, max_mem=1e12, max_parallel=2, log_dirpath=os.path.join(dirpath, 'logs'), repo_dirpath=dirpath, stage_scripts=stage_scripts, poll_period=0.01)
+		assert(failed_stages == {'good0': None, 'bad0': 'preprocess', 'good1': None}), "wrong failed stages {}".format(failed_stages)
+		for scene_id in scene_ids:
+			with open(os.path.join(dirpath, scene_id + '.txt')) as f: ran_stages = f.read().split()
+			# A scene stops at its first failed stage
+			expected_stages = ['ingest', 'preprocess'] if scene_id.startswith('bad') else ['ingest', 'preprocess', 'depth']
+			assert(ran_stages == expected_stages), "{} ran stages {}".format(scene_id, ran_stages)
+			assert(os.path.exists(get_stage_log_fpath(os.path.join(dirpath, 'logs'), scene_id, 'ingest'))), "missing stage log"
+	print("PASSED test_run_scene_jobs")
+
+def update_scene_counter(task):
+	(json_fpath, scene_id, n_updates) = task
+	def increment(json_dict): json_dict['scene_params'][scene_id] = json_dict['scene_params'].get(scene_id, 0) + 1
+	for _ in range(n_updates): update_json_locked(json_fpath, increment)
+
+def test_update_json_locked_concurrent():
+	with tempfile.TemporaryDirectory() as dirpath:
+		json_fpath = os.path.join(dirpath, 'scan_params.json')
+		with open(json_fpath, 'w') as f: json.dump({'scene_params': {}}, f)
+		scene_ids = ['scene{}'.format(i) for i in range(4)]
+		with multiprocessing.Pool(4) as pool:
+			pool.map(update_scene_counter, [(json_fpath, scene_id, 25) for scene_id in scene_ids])
+		with open(json_fpath) as f: scene_params = json.load(f)['scene_params']
+		# Every update of every process is kept
+		assert(scene_params == {scene_id: 25 for scene_id in scene_ids}), "concurrent updates were lost: {}".format(scene_params)
+	print("PASSED test_update_json_locked_concurrent")
+
+if __name__=='__main__':
+	test_select_scene_ids_and_stages()
+	test_estimate_and_pick_scene_jobs()
+	test_run_scene_jobs()
+	test_update_json_locked_concurrent()
@@ -0,0 +1,203 @@
+## Standard Library Imports
+import os
+import sys
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+## Library Imports
+import numpy as np
+
+## Local Imports
+from fullscan_ingest import *
+from read_hydraharp_outfile_t3 import outfile_t3_to_histogram
+from timestamp_cache import build_timestamp_cache
+from sparse_hist_img import *
+from scan_data_utils import crop_shift_histogram, narrow_hist_img_file, get_hist_img_fname
+from ingest_telemetry import IngestTelemetry
+from test_read_hydraharp_outfile_t3 import make_t3_records, write_t3_outfile
+
+(MAX_TBIN, MIN_TBIN_SIZE) = (100000., 8)
+
+def make_scan(dirpath, nr, nc):
+	'''
+		Write one random .out file per pixel. Returns the list of fpaths and the file index of each pixel
+	'''
+	fpaths = [write_t3_outfile(dirpath, make_t3_records(500*(i % 3), seed=i), fname='t3mode_0_000000_{}.out'.format(i)) for i in range(nr*nc)]
+	file_indeces_img = np.arange(nr*nc).reshape((nc, nr)).T
+	return (fpaths, file_indeces_img)
+
+def get_expected_outputs(fpaths, file_indeces_img, hist_tbin_factor=1):
+	(nr, nc) = file_indeces_img.shape
+	expected = [[outfile_t3_to_histogram(fpaths[file_indeces_img[i,j]], max_tbin=MAX_TBIN, min_tbin_size=MIN_TBIN_SIZE, hist_tbin_factor=hist_tbin_factor) for j in range(nc)] for i in range(nr)]
+	raw_hist_img = np.array([[e[0] for e in row] for row in expected])
+	n_laser_cycles_img = np.array([[e[1] for e in row] for row in expected])
+	n_empty_laser_cycles_img = np.array([[e[2] for e in row] for row in expected])
+	return (raw_hist_img, n_laser_cycles_img, n_empty_laser_cycles_img)
+
+def test_build_raw_hist_img():
+	with tempfile.TemporaryDirectory() as dirpath:
+		(fpaths, file_indeces_img) = make_scan(dirpath, 3, 4)
+		expected_outputs = get_expected_outputs(fpaths, file_indeces_img, hist_tbin_factor=2)
+		cache_dirpath = os.path.join(dirpath, 'cache')
+		build_timestamp_cache(cache_dirpath, fpaths)
+		for (workers, timestamp_cache_dirpath, prefetch_depth) in [(1, None, 0), (2, None, 0), (1, cache_dirpath, 0), (2, cache_dirpath, 0), (1, None, 3), (2, None, 2)]:
+			output_fpaths = {name: os.path.join(dirpath, '{}_workers-{}.npy'.format(name, workers)) for name in RAW_HIST_IMG_OUTPUTS}
+			telemetry = IngestTelemetry()
+			outputs = build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, max_tbin=MAX_TBIN, min_tbin_size=MIN_TBIN_SIZE, hist_tbin_factor=2, workers=workers, timestamp_cache_dirpath=timestamp_cache_dirpath, prefetch_depth=prefetch_depth, chunksize=5, telemetry=telemetry)
+			metrics = telemetry.get_metrics()
+			assert((metrics['n_done'], metrics['n_failed']) == (12, 0)), "telemetry should count every pixel"
+			assert(metrics['n_photons'] == expected_outputs[0].sum()), "telemetry photons should match the histogram image"
+			if(timestamp_cache_dirpath is None): assert(metrics['n_bytes'] == sum([os.path.getsize(fpath) for fpath in fpaths])), "telemetry bytes should match the .out files"
+			for (output, expected_output) in zip(outputs, expected_outputs):
+				assert(np.array_equal(output, expected_output)), "build_raw_hist_img output does not match per-pixel histograms"
+			for (name, expected_output) in zip(RAW_HIST_IMG_OUTPUTS, expected_outputs):
+				assert(np.array_equal(np.load(output_fpaths[name]), expected_output)), "saved {} does not match per-pixel histograms".format(name)
+		## With a photon budget, prefetching only reads the files that are within it and streams the rest
+		max_photons = 700
+		expected_hist_img = np.array([[outfile_t3_to_histogram(fpaths[file_indeces_img[i,j]], max_tbin=MAX_TBIN, min_tbin_size=MIN_TBIN_SIZE, max_photons=max_photons)[0] for j in range(4)] for i in range(3)])
+		output_fpaths = {name: os.path.join(dirpath, '{}_max-photons.npy'.format(name)) for name in RAW_HIST_IMG_OUTPUTS}
+		outputs = build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, max_tbin=MAX_TBIN, min_tbin_size=MIN_TBIN_SIZE, max_photons=max_photons, workers=2, prefetch_depth=2, chunksize=5)
+		assert(np.array_equal(outputs[0], expected_hist_img)), "prefetched ingest should stop at the photon budget"
+		## Batched ingest from the cache histograms the files over the photon budget on their own
+		output_fpaths = {name: os.path.join(dirpath, '{}_cached-max-photons.npy'.format(name)) for name in RAW_HIST_IMG_OUTPUTS}
+		outputs = build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, max_tbin=MAX_TBIN, min_tbin_size=MIN_TBIN_SIZE, max_photons=max_photons, workers=1, timestamp_cache_dirpath=cache_dirpath, chunksize=5)
+		assert(np.array_equal(outputs[0], expected_hist_img)), "cached ingest should stop at the photon budget"
+	print("PASSED test_build_raw_hist_img")
+
+def test_build_raw_hist_img_resume():
+	with tempfile.TemporaryDirectory() as dirpath:
+		(fpaths, file_indeces_img) = make_scan(dirpath, 3, 4)
+		expected_outputs = get_expected_outputs(fpaths, file_indeces_img)
+		output_fpaths = {name: os.path.join(dirpath, name + '.npy') for name in RAW_HIST_IMG_OUTPUTS}
+		state_fpath = os.path.join(dirpath, 'ingest-state.npy')
+		hist_params = {'max_tbin': MAX_TBIN, 'min_tbin_size': MIN_TBIN_SIZE}
+		## Interrupt the ingest after 5 pixels, and make one of the remaining files unreadable
+		os.rename(fpaths[file_indeces_img[2,3]], fpaths[file_indeces_img[2,3]] + '.bak')
+		for (n_completed, _) in enumerate(iter_build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, state_fpath=state_fpath, **hist_params)):
+			if(n_completed == 4): break
+		assert(np.count_nonzero(np.load(state_fpath) == PIXEL_DONE) == 5), "ingest state should have 5 pixels done"
+		assert(not is_ingest_complete(state_fpath)), "interrupted ingest should not be complete"
+		## Resume. Only the remaining pixels are ingested, and the missing file is marked as failed
+		n_resumed = len(list(iter_build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, state_fpath=state_fpath, resume=True, **hist_params)))
+		assert(n_resumed == 7), "resumed ingest should only process the 7 unfinished pixels"
+		assert(np.load(state_fpath)[2,3] == PIXEL_FAILED), "pixel with missing file should be marked as failed"
+		## Restore the file and retry only the failed pixel
+		os.rename(fpaths[file_indeces_img[2,3]] + '.bak', fpaths[file_indeces_img[2,3]])
+		n_retried = len(list(iter_build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, state_fpath=state_fpath, resume=True, retry_failed=True, **hist_params)))
+		assert(n_retried == 1), "retry should only process the failed pixel"
+		assert(is_ingest_complete(state_fpath)), "ingest should be complete"
+		for (name, expected_output) in zip(RAW_HIST_IMG_OUTPUTS, expected_outputs):
+			assert(np.array_equal(np.load(output_fpaths[name]), expected_output)), "resumed {} does not match per-pixel histograms".format(name)
+	print("PASSED test_build_raw_hist_img_resume")
+
+def test_build_sparse_raw_hist_img():
+	with tempfile.TemporaryDirectory() as dirpath:
+		(fpaths, file_indeces_img) = make_scan(dirpath, 3, 4)
+		expected_outputs = get_expected_outputs(fpaths, file_indeces_img)
+		hist_params = {'max_tbin': MAX_TBIN, 'min_tbin_size': MIN_TBIN_SIZE}
+		for workers in [1, 2]:
+			output_fpaths = {name: os.path.join(dirpath, '{}_workers-{}.npy'.format(name, workers)) for name in RAW_HIST_IMG_OUTPUTS}
+			output_fpaths['raw_hist_img'] = output_fpaths['raw_hist_img'].replace('.npy', '.npz')
+			state_fpath = os.path.join(dirpath, 'ingest-state_workers-{}.npy'.format(workers))
+			## Interrupt the ingest, and resume it
+			for (n_completed, _) in enumerate(iter_build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, state_fpath=state_fpath, workers=workers, output_format='sparse', **hist_params)):
+				if(n_completed == 4): break
+			assert(not os.path.exists(output_fpaths['raw_hist_img'])), "sparse image should only be written once all pixels are done"
+			outputs = build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, state_fpath=state_fpath, resume=True, workers=workers, output_format='sparse', **hist_params)
+			assert(not os.path.exists(get_sparse_hist_img_parts_dirpath(output_fpaths['raw_hist_img']))), "parts should be removed after assembly"
+			sparse_hist_img = load_sparse_hist_img(output_fpaths['raw_hist_img'])
+			assert(np.array_equal(sparse2dense_hist_img(sparse_hist_img), expected_outputs[0])), "sparse raw_hist_img does not match per-pixel histograms"
+			assert(np.array_equal(sparse2dense_hist_img(outputs[0]), expected_outputs[0])), "returned sparse raw_hist_img does not match"
+			for (output, expected_output) in zip(outputs[1:], expected_outputs[1:]):
+				assert(np.array_equal(output, expected_output)), "laser cycle images do not match per-pixel histograms"
+	print("PASSED test_build_sparse_raw_hist_img")
+
+def test_build_raw_hist_img_spatial_binning():
+	with tempfile.TemporaryDirectory() as dirpath:
+		(fpaths, file_indeces_img) = make_scan(dirpath, 5, 4)
+		expected_outputs = get_expected_outputs(fpaths, file_indeces_img)
+		output_fpaths = {name: os.path.join(dirpath, name + '.npy') for name in RAW_HIST_IMG_OUTPUTS}
+		outputs = build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, max_tbin=MAX_TBIN, min_tbin_size=MIN_TBIN_SIZE, workers=2, spatial_bin_factor=2)
+		## Each output pixel has the sum of a 2x2 block of scan points. The last row of scan points does not fill a block
+		for (output, expected_output) in zip(outputs, expected_outputs):
+			expected_output = expected_output[0:4].reshape((2, 2, 2, 2) + expected_output.shape[2:]).sum(axis=(1, 3))
+			assert(np.array_equal(output, expected_output)), "spatially binned output does not match the sum of its scan points"
+	print("PASSED test_build_raw_hist_img_spatial_binning")
+
+def test_build_raw_hist_img_pyramid():
+	with tempfile.TemporaryDirectory() as dirpath:
+		(fpaths, file_indeces_img) = make_scan(dirpath, 3, 4)
+		output_fpaths = {name: os.path.join(dirpath, name + '.npy') for name in RAW_HIST_IMG_OUTPUTS}
+		output_fpaths['raw_hist_img'] = os.path.join(dirpath, 'raw-' + get_hist_img_fname(3, 4, 2*MIN_TBIN_SIZE, MAX_TBIN))
+		# 16ps base bins, and 32, 64 and 384ps levels. 384ps bins do not divide the laser period, so its last bin is partial
+		pyramid_fpaths = {k: os.path.join(dirpath, 'raw-' + get_hist_img_fname(3, 4, 2*k*MIN_TBIN_SIZE, MAX_TBIN)) for k in [2, 4, 24]}
+		for workers in [1, 2]:
+			build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, max_tbin=MAX_TBIN, min_tbin_size=MIN_TBIN_SIZE, hist_tbin_factor=2, workers=workers, pyramid_fpaths=pyramid_fpaths)
+			for (k, fpath) in pyramid_fpaths.items():
+				(expected_hist_img, _, _) = get_expected_outputs(fpaths, file_indeces_img, hist_tbin_factor=2*k)
+				assert(np.array_equal(np.load(fpath), expected_hist_img)), "pyramid level {} does not match a decode at hist_tbin_factor {}".format(k, 2*k)
+		## The loader picks the coarsest level that meets the requested bin size
+		for (tbin_size, expected_tbin_size) in [(16, 16), (40, 32), (64, 64), (1000, 384), (8, None)]:
+			(fpath, level_tbin_size) = find_hist_img_pyramid_level(dirpath, 3, 4, MAX_TBIN, tbin_size)
+			assert(level_tbin_size == expected_tbin_size), "requested {}ps bins, got {}ps".format(tbin_size, level_tbin_size)
+		(hist_img, level_tbin_size) = load_hist_img_pyramid_level(dirpath, 3, 4, MAX_TBIN, 100)
+		assert((level_tbin_size == 64) and np.array_equal(hist_img, np.load(pyramid_fpaths[4]))), "loaded the wrong pyramid level"
+	print("PASSED test_build_raw_hist_img_pyramid")
+
+def test_build_raw_hist_img_crop_shift():
+	hist_crop_bins = (4000, 6188, 100)
+	with tempfile.TemporaryDirectory() as dirpath:
+		(fpaths, file_indeces_img) = make_scan(dirpath, 3, 4)
+		expected_outputs = get_expected_outputs(fpaths, file_indeces_img)
+		output_fpaths = {name: os.path.join(dirpath, name + '.npy') for name in RAW_HIST_IMG_OUTPUTS}
+		outputs = build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, max_tbin=MAX_TBIN, min_tbin_size=MIN_TBIN_SIZE, workers=2, hist_crop_bins=hist_crop_bins)
+		expected_hist_img = np.roll(expected_outputs[0][..., 4000:6188], 100, axis=-1)
+		assert(np.array_equal(outputs[0], expected_hist_img)), "cropped and shifted output does not match preprocessing the raw histograms"
+		assert(np.array_equal(crop_shift_histogram(expected_outputs[0], hist_crop_bins), expected_hist_img)), "crop_shift_histogram does not match"
+	print("PASSED test_build_raw_hist_img_crop_shift")
+
+def test_build_raw_hist_img_incremental():
+	with tempfile.TemporaryDirectory() as dirpath:
+		(fpaths, file_indeces_img) = make_scan(dirpath, 3, 4)
+		output_fpaths = {name: os.path.join(dirpath, name + '.npy') for name in RAW_HIST_IMG_OUTPUTS}
+		state_fpath = os.path.join(dirpath, 'ingest-state.npy')
+		hist_params = {'max_tbin': MAX_TBIN, 'min_tbin_size': MIN_TBIN_SIZE}
+		build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, state_fpath=state_fpath, **hist_params)
+		narrow_hist_img_file(output_fpaths['raw_hist_img'])
+		## Nothing changed, so nothing is re-ingested
+		assert(len(list(iter_build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, state_fpath=state_fpath, resume=True, **hist_params))) == 0), "unchanged scan should not be re-ingested"
+		## Re-capture the file of one pixel. Only that pixel is re-ingested and patched in place
+		write_t3_outfile(dirpath, make_t3_records(3000, seed=100), fname=os.path.basename(fpaths[file_indeces_img[1,2]]))
+		os.utime(fpaths[file_indeces_img[1,2]], ns=(0, 10**9))
+		## Stale file stats (e.g., from a manifest that was not refreshed) do not detect the change
+		recorded_file_stats = load_json(get_ingest_file_stats_fpath(state_fpath))
+		stale_file_stats = (recorded_file_stats['fsizes'], recorded_file_stats['mtimes'])
+		assert(len(list(iter_build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, state_fpath=state_fpath, resume=True, file_stats=stale_file_stats, **hist_params))) == 0), "the given file stats should be used instead of stat'ing the files"
+		patched_pixels = [pixel_task[0:2] for (pixel_task, _) in iter_build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, state_fpath=state_fpath, resume=True, file_stats=get_ingest_file_stats(fpaths), **hist_params)]
+		assert(patched_pixels == [(1,2)]), "only the pixel with a changed file should be re-ingested"
+		expected_outputs = get_expected_outputs(fpaths, file_indeces_img)
+		for (name, expected_output) in zip(RAW_HIST_IMG_OUTPUTS, expected_outputs):
+			assert(np.array_equal(np.load(output_fpaths[name]), expected_output)), "patched {} does not match per-pixel histograms".format(name)
+		assert(np.load(output_fpaths['raw_hist_img'], mmap_mode='r').dtype == np.uint16), "counts that fit should be patched into the narrowed image in place"
+		## A re-captured file whose counts do not fit in the narrowed dtype widens the image
+		nsync = np.sort(np.random.default_rng(0).integers(0, 1024, size=70000)).astype(np.uint32)
+		write_t3_outfile(dirpath, ((5 << 10) | nsync).astype(np.uint32), fname=os.path.basename(fpaths[file_indeces_img[0,1]]))
+		os.utime(fpaths[file_indeces_img[0,1]], ns=(0, 10**9))
+		patched_pixels = [pixel_task[0:2] for (pixel_task, _) in iter_build_raw_hist_img(fpaths, file_indeces_img, output_fpaths, state_fpath=state_fpath, resume=True, workers=2, **hist_params)]
+		assert(patched_pixels == [(0,1)]), "the overflowed pixel should be re-ingested once"
+		assert(np.load(output_fpaths['raw_hist_img'], mmap_mode='r').dtype == RAW_HIST_IMG_OUTPUT_DTYPES['raw_hist_img']), "the image should be widened"
+		expected_outputs = get_expected_outputs(fpaths, file_indeces_img)
+		assert(expected_outputs[0].max() >= 70000), "test data should overflow uint16"
+		for (name, expected_output) in zip(RAW_HIST_IMG_OUTPUTS, expected_outputs):
+			assert(np.array_equal(np.load(output_fpaths[name]), expected_output)), "widened {} does not match per-pixel histograms".format(name)
+		assert(not np.any(get_changed_files(get_ingest_file_stats_fpath(state_fpath), fpaths))), "no files should be changed after the ingest"
+	print("PASSED test_build_raw_hist_img_incremental")
+
+if __name__=='__main__':
+	test_build_raw_hist_img()
+	test_build_raw_hist_img_resume()
+	test_build_sparse_raw_hist_img()
+	test_build_raw_hist_img_spatial_binning()
+	test_build_raw_hist_img_pyramid()
+	test_build_raw_hist_img_crop_shift()
+	test_build_raw_hist_img_incremental()
@@ -0,0 +1,62 @@
+## Standard Library Imports
+import os
+import sys
+import json
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+## Library Imports
+import numpy as np
+
+## Local Imports
+from ingest_telemetry import *
+
+def make_pixel_stats(latency, n_photons, n_bytes, worker_pid, cpu_time=None, io_wait=0.):
+	if(cpu_time is None): cpu_time = latency
+	return {'latency': latency, 'decode_time': latency - io_wait, 'cpu_time': cpu_time, 'io_wait': io_wait, 'n_photons': n_photons, 'n_bytes': n_bytes, 'worker_pid': worker_pid}
+
+def test_ingest_telemetry_metrics():
+	telemetry = IngestTelemetry(progress_period=0.)
+	telemetry.start(10, workers=2)
+	assert(telemetry.get_metrics()['pixel_latency']['p50'] is None), "no latency percentiles before the first pixel"
+	latencies = [0.01*(k+1) for k in range(5)]
+	for (k, latency) in enumerate(latencies):
+		telemetry.add_pixel((0, k, (k,)), make_pixel_stats(latency, n_photons=100, n_bytes=1000, worker_pid=k % 2, cpu_time=latency/2, io_wait=latency/4), failed=(k == 0))
+	# Fix the elapsed time so the rates are deterministic
+	telemetry.last_update_time = telemetry.start_time + 1.
+	metrics = telemetry.get_metrics()
+	assert((metrics['n_done'], metrics['n_failed'], metrics['n_pixels']) == (5, 1, 10)), "wrong pixel counts"
+	assert((metrics['n_photons'], metrics['n_bytes']) == (500, 5000)), "wrong photon or byte totals"
+	assert(np.isclose(metrics['photons_per_sec'], 500) and np.isclose(metrics['mb_per_sec'], 5000 / 1e6)), "wrong throughput"
+	assert(np.isclose(metrics['eta'], 1.)), "5 of 10 pixels in 1 second should leave 1 second"
+	assert(np.isclose(metrics['worker_utilization'], sum(latencies) / 4)), "worker utilization should be CPU time / (elapsed * workers)"
+	assert(np.isclose(metrics['cpu_fraction'], 0.5) and np.isclose(metrics['io_wait_fraction'], 0.25)), "wrong cpu or io wait fraction"
+	assert(np.isclose(metrics['pixel_latency']['p50'], np.median(latencies)) and np.isclose(metrics['pixel_latency']['max'], 0.05)), "wrong latency percentiles"
+	assert(np.isclose(sum(metrics['worker_busy_times'].values()), sum(latencies))), "busy times should add up to the total latency"
+	assert(np.isclose(sum(metrics['worker_cpu_times'].values()), sum(latencies) / 2)), "CPU times should add up to the total CPU time"
+	## Decode time and I/O wait are reported apart from the latency
+	assert(np.isclose(metrics['pixel_io_wait']['p50'], np.median(latencies) / 4)), "wrong io wait percentiles"
+	assert(np.isclose(metrics['pixel_decode_time']['p50'], 0.75*np.median(latencies))), "wrong decode time percentiles"
+	assert(metrics['pixel_latency']['p95'] is not None), "latency should have a p95"
+	assert(metrics['slowest_pixels'][0]['pixel'] == [0, 4]), "wrong slowest pixel"
+	assert('5/10 pixels' in telemetry.format_progress()), "progress line should show the pixel count"
+	with tempfile.TemporaryDirectory() as dirpath:
+		telemetry.save(os.path.join(dirpath, 'metrics.json'))
+		with open(os.path.join(dirpath, 'metrics.json')) as f: assert(json.load(f)['n_done'] == 5), "saved metrics do not match"
+	print("PASSED test_ingest_telemetry_metrics")
+
+def test_ingest_telemetry_progress_rate_limit():
+	telemetry = IngestTelemetry(progress_period=3600.)
+	telemetry.start(2)
+	telemetry.print_progress()
+	first_progress_time = telemetry.last_progress_time
+	telemetry.add_pixel((0, 0, (0,)), make_pixel_stats(0.01, n_photons=1, n_bytes=4, worker_pid=0))
+	telemetry.print_progress()
+	assert(telemetry.last_progress_time == first_progress_time), "progress should not be printed again within progress_period"
+	telemetry.print_progress(force=True)
+	assert(telemetry.last_progress_time > first_progress_time), "forced progress should always be printed"
+	print("PASSED test_ingest_telemetry_progress_rate_limit")
+
+if __name__=='__main__':
+	test_ingest_telemetry_metrics()
+	test_ingest_telemetry_progress_rate_limit()
@@ -0,0 +1,44 @@
+## Standard Library Imports
+import os
+import sys
+import json
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+## Library Imports
+import numpy as np
+
+## Local Imports
+from read_fullscan_hydraharp_t3 import get_hist_img_dims, update_scene_scan_params
+from scan_manifest import load_scan_manifest, get_manifest_fpaths, SCAN_MANIFEST_FNAME
+from scan_data_utils import get_hist_img_fname
+from fullscan_ingest import build_raw_hist_img, RAW_HIST_IMG_OUTPUTS
+from test_scan_manifest import make_scan_dir
+
+
+def test_hist_img_dims():
+	(n_rows_fullres, n_cols_fullres) = (3, 4)
+	with tempfile.TemporaryDirectory() as base_dirpath:
+		dirpath = os.path.join(base_dirpath, 'scan')
+		os.makedirs(dirpath)
+		make_scan_dir(dirpath, n_rows_fullres, n_cols_fullres)
+		manifest = load_scan_manifest(dirpath, os.path.join(base_dirpath, SCAN_MANIFEST_FNAME))
+		file_indeces_img = np.array(manifest['file_indeces_img'])
+		## The image is the transposed scan, so it is named with the swapped scan dims
+		(nr, nc) = get_hist_img_dims(file_indeces_img)
+		assert((nr, nc) == (n_cols_fullres, n_rows_fullres)), "histogram image dims should be the transposed scan dims"
+		assert(get_hist_img_dims(file_indeces_img, spatial_bin_factor=2) == (2, 1)), "binned dims should be the dims of the binned image"
+		output_fpaths = {name: os.path.join(base_dirpath, '{}.npy'.format(name)) for name in RAW_HIST_IMG_OUTPUTS}
+		outputs = build_raw_hist_img(get_manifest_fpaths(manifest, dirpath), file_indeces_img, output_fpaths, max_tbin=100000., min_tbin_size=8)
+		assert(outputs[0].shape[0:2] == (nr, nc)), "built histogram image does not match its dims"
+		## The dims stored in the scan params are the ones preprocess_raw_hist_img.py names the raw hist image with
+		scan_params_fpath = os.path.join(base_dirpath, 'scan_params.json')
+		with open(scan_params_fpath, 'w') as f: json.dump({'scene_params': {'default': {}}}, f)
+		scan_params = {'scene_params': {}}
+		update_scene_scan_params(scan_params, 'scene', n_rows_fullres, n_cols_fullres, scan_params_fpath=scan_params_fpath)
+		scene_params = scan_params['scene_params']['scene']
+		assert(get_hist_img_fname(scene_params['n_rows_fullres'], scene_params['n_cols_fullres'], 8, 100000.) == get_hist_img_fname(nr, nc, 8, 100000.)), "scan params dims do not match the saved histogram image"
+	print("PASSED test_hist_img_dims")
+
+if __name__=='__main__':
+	test_hist_img_dims()
@@ -0,0 +1,201 @@
+## Standard Library Imports
+import os
+import sys
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+## Library Imports
+import numpy as np
+
+## Local Imports
+from read_hydraharp_outfile_t3 import *
+
+
+def make_t3_records(n_recs, overflow_prob=0.05, marker_prob=0.0, channels=(0,), seed=0):
+	'''
+		Generate random raw T3 records with photons, single and multiple overflow records, and optionally markers
+	'''
+	rng = np.random.default_rng(seed)
+	nsync = rng.integers(0, 1024, size=n_recs).astype(np.uint32)
+	dtime = rng.integers(0, 2**15, size=n_recs).astype(np.uint32)
+	channel = rng.choice(np.array(channels, dtype=np.uint32), size=n_recs)
+	special = np.zeros((n_recs,), dtype=np.uint32)
+	# Overflow records. Half of them are single overflows (nsync==0)
+	is_overflow = rng.random(n_recs) < overflow_prob
+	special[is_overflow] = 1
+	channel[is_overflow] = T3_OVERFLOW_CHANNEL
+	nsync[is_overflow & (rng.random(n_recs) < 0.5)] = 0
+	is_marker = np.logical_and(rng.random(n_recs) < marker_prob, np.logical_not(is_overflow))
+	special[is_marker] = 1
+	channel[is_marker] = rng.integers(1, 16, size=np.count_nonzero(is_marker))
+	# Photons are recorded in time order, so nsync is non-decreasing between overflow records
+	is_photon = np.logical_not(special.astype(bool))
+	overflow_period_idx = np.cumsum(is_overflow)[is_photon]
+	nsync[is_photon] = nsync[is_photon][np.lexsort((nsync[is_photon], overflow_period_idx))]
+	records = (special << 31) | (channel << 25) | (dtime << 10) | nsync
+	return records.astype(T3_RECORD_DTYPE)
+
+def write_t3_outfile(dirpath, records, fname='t3mode_0_000000_0.out', n_trailing_bytes=0):
+	fpath = os.path.join(dirpath, fname)
+	with open(fpath, 'wb') as f:
+		f.write(records.tobytes())
+		f.write(b'\x00'*n_trailing_bytes)
+	return fpath
+
+def test_read_hydraharp_outfile_t3_matches_loop():
+	with tempfile.TemporaryDirectory() as dirpath:
+		for (i, n_recs) in enumerate([0, 1, 10, 5000]):
+			fpath = write_t3_outfile(dirpath, make_t3_records(n_recs, marker_prob=0.01, seed=i), n_trailing_bytes=i % 4)
+			(sync_vec, dtime_vec) = read_hydraharp_outfile_t3(fpath)
+			(sync_vec_loop, dtime_vec_loop) = read_hydraharp_outfile_t3_loop(fpath)
+			assert(sync_vec.dtype == sync_vec_loop.dtype), "sync_vec dtype does not match loop decoder"
+			assert(dtime_vec.dtype == dtime_vec_loop.dtype), "dtime_vec dtype does not match loop decoder"
+			assert(np.array_equal(sync_vec, sync_vec_loop)), "sync_vec does not match loop decoder"
+			assert(np.array_equal(dtime_vec, dtime_vec_loop)), "dtime_vec does not match loop decoder"
+	print("PASSED test_read_hydraharp_outfile_t3_matches_loop")
+
+def test_decode_t3_records_overflow_carry():
+	records = make_t3_records(3000, overflow_prob=0.2, seed=1)
+	(sync_vec, dtime_vec, channel_vec, overflow_correction) = decode_t3_records(records)
+	## Decoding in blocks and carrying the overflow correction gives the same result
+	(sync_blocks, dtime_blocks) = ([], [])
+	curr_overflow_correction = 0
+	for records_block in np.array_split(records, 7):
+		(sync_block, dtime_block, _, curr_overflow_correction) = decode_t3_records(records_block, curr_overflow_correction)
+		sync_blocks.append(sync_block)
+		dtime_blocks.append(dtime_block)
+	assert(curr_overflow_correction == overflow_correction), "overflow correction not carried correctly"
+	assert(np.array_equal(np.concatenate(sync_blocks), sync_vec)), "sync_vec does not match when decoding in blocks"
+	assert(np.array_equal(np.concatenate(dtime_blocks), dtime_vec)), "dtime_vec does not match when decoding in blocks"
+	print("PASSED test_decode_t3_records_overflow_carry")
+
+def test_iter_hydraharp_outfile_t3_chunks():
+	with tempfile.TemporaryDirectory() as dirpath:
+		fpath = write_t3_outfile(dirpath, make_t3_records(10000, overflow_prob=0.1, seed=2), n_trailing_bytes=3)
+		(sync_vec, dtime_vec) = read_hydraharp_outfile_t3(fpath)
+		for chunk_n_recs in [1, 999, 4096, 20000]:
+			chunks = list(iter_hydraharp_outfile_t3(fpath, chunk_n_recs=chunk_n_recs))
+			assert(np.array_equal(np.concatenate([c[0] for c in chunks]), sync_vec)), "chunked sync_vec does not match"
+			assert(np.array_equal(np.concatenate([c[1] for c in chunks]), dtime_vec)), "chunked dtime_vec does not match"
+		assert(len(list(iter_hydraharp_outfile_t3(write_t3_outfile(dirpath, make_t3_records(0), fname='empty.out')))) == 0), "empty file should yield no chunks"
+	print("PASSED test_iter_hydraharp_outfile_t3_chunks")
+
+def test_read_hydraharp_outfile_t3_with_gate_matches_loop():
+	with tempfile.TemporaryDirectory() as dirpath:
+		fpath = write_t3_outfile(dirpath, make_t3_records(5000, channels=(0,1,2), seed=3))
+		outputs = read_hydraharp_outfile_t3_with_gate(fpath)
+		outputs_loop = read_hydraharp_outfile_t3_with_gate_loop(fpath)
+		for (v, v_loop) in zip(outputs, outputs_loop):
+			assert(v.dtype == v_loop.dtype), "gate decoder dtype does not match loop decoder"
+			assert(np.array_equal(v, v_loop)), "gate decoder does not match loop decoder"
+	print("PASSED test_read_hydraharp_outfile_t3_with_gate_matches_loop")
+
+def test_outfile_t3_to_histogram_matches_timestamps2histogram():
+	(max_tbin, min_tbin_size) = (100000., 8)
+	# Include photons exactly at the last bin edge (dtime code 12500) which np.histogram puts in the last bin
+	records = make_t3_records(20000, overflow_prob=0.02, seed=4)
+	records[::50] = (records[::50] & ~np.uint32(0b00000001111111111111110000000000)) | np.uint32(12500 << 10)
+	with tempfile.TemporaryDirectory() as dirpath:
+		fpath = write_t3_outfile(dirpath, records)
+		(sync_vec, dtime_vec) = read_hydraharp_outfile_t3(fpath)
+		for hist_tbin_factor in [1, 2.0, 4, 2.5]:
+			(counts_ref, _, _) = timestamps2histogram(dtime_vec, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor)
+			(counts, n_laser_cycles, n_empty_laser_cycles) = outfile_t3_to_histogram(fpath, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor, chunk_n_recs=3000)
+			assert(np.array_equal(counts, counts_ref)), "fused histogram does not match timestamps2histogram"
+			assert(n_laser_cycles == sync_vec.max()), "n_laser_cycles does not match"
+			assert(n_empty_laser_cycles == calc_n_empty_laser_cycles(sync_vec)), "n_empty_laser_cycles does not match"
+	print("PASSED test_outfile_t3_to_histogram_matches_timestamps2histogram")
+
+def test_outfile_t3_to_histograms_integer_rebinning():
+	(max_tbin, min_tbin_size) = (100000., 8)
+	records = make_t3_records(20000, overflow_prob=0.02, seed=9)
+	records[::50] = (records[::50] & ~np.uint32(0b00000001111111111111110000000000)) | np.uint32(12500 << 10)
+	with tempfile.TemporaryDirectory() as dirpath:
+		fpath = write_t3_outfile(dirpath, records)
+		(sync_vec, dtime_vec) = read_hydraharp_outfile_t3(fpath)
+		hist_tbin_factors = [1, 2, 4, 8]
+		(counts_list, n_laser_cycles, n_empty_laser_cycles) = outfile_t3_to_histograms(fpath, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factors=hist_tbin_factors)
+		assert((n_laser_cycles, n_empty_laser_cycles) == outfile_t3_to_histogram(fpath, max_tbin=max_tbin, min_tbin_size=min_tbin_size)[1:]), "laser cycle stats do not match"
+		for (hist_tbin_factor, counts) in zip(hist_tbin_factors, counts_list):
+			assert(counts.size == get_n_hist_bins(max_tbin, min_tbin_size, hist_tbin_factor)), "wrong number of bins"
+			# 100000ps is not a multiple of 64ps, so the last 64ps bin is partial and holds the photons at the last bin edge
+			expected_counts = np.bincount(np.minimum(dtime_vec[dtime_vec <= 12500], 12499) // hist_tbin_factor, minlength=counts.size)
+			assert(np.array_equal(counts, expected_counts)), "integer rebinning does not match for hist_tbin_factor = {}".format(hist_tbin_factor)
+	print("PASSED test_outfile_t3_to_histograms_integer_rebinning")
+
+def test_iter_prefetched_t3_records():
+	with tempfile.TemporaryDirectory() as dirpath:
+		records_list = [make_t3_records(n_recs, seed=i) for (i, n_recs) in enumerate([100, 0, 2000, 50, 7])]
+		fpaths = [write_t3_outfile(dirpath, records, fname='t3mode_0_{:06d}_0.out'.format(i)) for (i, records) in enumerate(records_list)]
+		# A missing file is returned as an exception in its position
+		fpaths.insert(2, os.path.join(dirpath, 'missing.out'))
+		records_list.insert(2, None)
+		for prefetch_depth in [1, 3, 10]:
+			results = list(iter_prefetched_t3_records(fpaths, prefetch_depth=prefetch_depth, io_workers=2))
+			assert([fpath for (fpath, _) in results] == fpaths), "prefetched files are not returned in order"
+			for ((_, records), expected_records) in zip(results, records_list):
+				if(expected_records is None): assert(isinstance(records, Exception)), "missing file should return an exception"
+				else: assert(np.array_equal(records, expected_records)), "prefetched records do not match the file"
+		## Files larger than max_file_n_recs are not read
+		results = list(iter_prefetched_t3_records(fpaths, prefetch_depth=2, io_workers=2, max_file_n_recs=100))
+		for ((_, records), expected_records) in zip(results, records_list):
+			if((expected_records is not None) and (expected_records.size > 100)): assert(records is None), "large files should not be prefetched"
+			elif(expected_records is not None): assert(np.array_equal(records, expected_records)), "prefetched records do not match the file"
+	print("PASSED test_iter_prefetched_t3_records")
+
+def test_read_hydraharp_outfile_t3_parallel_matches_serial():
+	with tempfile.TemporaryDirectory() as dirpath:
+		fpath = write_t3_outfile(dirpath, make_t3_records(10001, overflow_prob=0.1, seed=5), n_trailing_bytes=2)
+		(sync_vec, dtime_vec) = read_hydraharp_outfile_t3(fpath)
+		for (workers, use_processes) in [(2, False), (7, False), (3, True)]:
+			(sync_vec_par, dtime_vec_par) = read_hydraharp_outfile_t3(fpath, workers=workers, use_processes=use_processes)
+			assert(np.array_equal(sync_vec_par, sync_vec)), "parallel sync_vec does not match serial decoder"
+			assert(np.array_equal(dtime_vec_par, dtime_vec)), "parallel dtime_vec does not match serial decoder"
+		(sync_vec_par, dtime_vec_par) = read_hydraharp_outfile_t3(write_t3_outfile(dirpath, make_t3_records(0), fname='empty.out'), workers=4)
+		assert((sync_vec_par.size == 0) and (dtime_vec_par.size == 0)), "empty file should decode to empty arrays"
+	print("PASSED test_read_hydraharp_outfile_t3_parallel_matches_serial")
+
+def test_read_hydraharp_outfile_t3_photon_budget():
+	with tempfile.TemporaryDirectory() as dirpath:
+		fpath = write_t3_outfile(dirpath, make_t3_records(200000, overflow_prob=0.01, seed=6))
+		(sync_vec, dtime_vec) = read_hydraharp_outfile_t3(fpath)
+		for max_photons in [0, 1, 1000, 100000, sync_vec.size, sync_vec.size + 10]:
+			(sync_vec_budget, dtime_vec_budget) = read_hydraharp_outfile_t3(fpath, max_photons=max_photons)
+			assert(np.array_equal(sync_vec_budget, sync_vec[0:max_photons])), "max_photons sync_vec does not match"
+			assert(np.array_equal(dtime_vec_budget, dtime_vec[0:max_photons])), "max_photons dtime_vec does not match"
+		max_laser_cycles = int(sync_vec[sync_vec.size // 3])
+		(sync_vec_budget, _) = read_hydraharp_outfile_t3(fpath, max_laser_cycles=max_laser_cycles)
+		assert(np.array_equal(sync_vec_budget, sync_vec[sync_vec <= max_laser_cycles])), "max_laser_cycles sync_vec does not match"
+		## Only the chunks within the photon budget are read
+		n_chunks_read = len(list(iter_hydraharp_outfile_t3(fpath, chunk_n_recs=1000, max_photons=2500)))
+		assert(n_chunks_read <= 3), "read {} chunks for a budget of 2.5 chunks".format(n_chunks_read)
+	print("PASSED test_read_hydraharp_outfile_t3_photon_budget")
+
+def test_calc_t3_record_stats():
+	records = make_t3_records(5000, overflow_prob=0.05, marker_prob=0.01, channels=(0,1), seed=7)
+	with tempfile.TemporaryDirectory() as dirpath:
+		fpath = write_t3_outfile(dirpath, records, n_trailing_bytes=3)
+		(sync_vec, dtime_vec) = read_hydraharp_outfile_t3_loop(fpath)
+		stats = calc_t3_record_stats(fpath, chunk_n_recs=777)
+		(nsync, _, channel, special) = split_t3_records(records)
+		assert(stats['n_records'] == records.size), "wrong n_records"
+		assert(stats['is_truncated'] and (stats['n_trailing_bytes'] == 3)), "truncated file not detected"
+		assert(stats['n_photons'] == sync_vec.size), "wrong n_photons"
+		assert(stats['n_markers'] == np.count_nonzero(special & (channel >= 1) & (channel <= 15))), "wrong n_markers"
+		assert(sum(stats['channel_counts'].values()) == sync_vec.size), "channel counts do not add up to n_photons"
+		assert((stats['sync_min'] == sync_vec.min()) and (stats['sync_max'] == sync_vec.max())), "wrong sync range"
+		assert(stats['is_sync_sorted']), "sync numbers should be sorted"
+		assert(stats['n_empty_laser_cycles'] == calc_n_empty_laser_cycles(sync_vec)), "wrong n_empty_laser_cycles"
+	print("PASSED test_calc_t3_record_stats")
+
+if __name__=='__main__':
+	test_read_hydraharp_outfile_t3_matches_loop()
+	test_decode_t3_records_overflow_carry()
+	test_iter_hydraharp_outfile_t3_chunks()
+	test_read_hydraharp_outfile_t3_with_gate_matches_loop()
+	test_outfile_t3_to_histogram_matches_timestamps2histogram()
+	test_outfile_t3_to_histograms_integer_rebinning()
+	test_iter_prefetched_t3_records()
+	test_read_hydraharp_outfile_t3_parallel_matches_serial()
+	test_read_hydraharp_outfile_t3_photon_budget()
+	test_calc_t3_record_stats()
@@ -0,0 +1,135 @@
+## Standard Library Imports
+import os
+import sys
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+## Library Imports
+import numpy as np
+
+## Local Imports
+from scan_data_utils import *
+
+
+def test_timestamps2histogram_bincount_matches_np_histogram():
+	(max_tbin, min_tbin_size) = (100000., 8)
+	rng = np.random.default_rng(1)
+	dtime_vec = rng.integers(0, 2**15, size=30000)
+	# Photons exactly at the last bin edge are counted in the last bin by np.histogram
+	dtime_vec[::100] = int(max_tbin / min_tbin_size)
+	for dtype in [np.int32, np.int64, np.uint16]:
+		for hist_tbin_factor in [1, 2, 4.0, 2.5]:
+			(counts, bin_edges, bins) = timestamps2histogram(dtime_vec.astype(dtype), max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor)
+			(counts_ref, _) = np.histogram(min_tbin_size*dtime_vec.astype(np.float64), bins=np.arange(0, max_tbin + min_tbin_size*hist_tbin_factor, min_tbin_size*hist_tbin_factor))
+			assert(counts.dtype == counts_ref.dtype), "counts dtype does not match np.histogram"
+			assert(np.array_equal(counts, counts_ref)), "counts do not match np.histogram for {} codes and hist_tbin_factor {}".format(np.dtype(dtype), hist_tbin_factor)
+			assert(bin_edges.size == (counts.size + 1) and bins.size == counts.size), "wrong number of bins"
+	## Codes below the right edge are binned straight into the counts. The bins are the cached read-only ones
+	in_range_dtime_vec = (dtime_vec % int(max_tbin / min_tbin_size)).astype(np.uint16)
+	for hist_tbin_factor in [1, 2, 4]:
+		(counts, bin_edges, bins) = timestamps2histogram(in_range_dtime_vec, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor)
+		(counts_ref, _) = np.histogram(min_tbin_size*in_range_dtime_vec.astype(np.float64), bins=np.arange(0, max_tbin + min_tbin_size*hist_tbin_factor, min_tbin_size*hist_tbin_factor))
+		assert(np.array_equal(counts, counts_ref) and (counts.dtype == counts_ref.dtype)), "directly binned counts do not match np.histogram for hist_tbin_factor {}".format(hist_tbin_factor)
+		assert((not bins.flags.writeable) and (bins is timestamps2histogram(in_range_dtime_vec[0:10], max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor)[2])), "bins should be the cached ones"
+	## Code counts shorter than the histogram are summed into partial bins
+	short_dtime_counts = np.bincount(in_range_dtime_vec[in_range_dtime_vec < 1000])
+	(counts, _, _) = dtime_counts2histogram(short_dtime_counts, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=3)
+	(counts_ref, _, _) = dtime_counts2histogram(np.bincount(in_range_dtime_vec[in_range_dtime_vec < 1000], minlength=N_DTIME_CODES), max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=3)
+	assert(np.array_equal(counts, counts_ref)), "short code counts should give the same histogram"
+	## Inputs that are not dtime codes use np.histogram
+	assert(not is_dtime_code_vec(np.array([-1, 3]))), "negative values are not dtime codes"
+	assert(not is_dtime_code_vec(np.array([1.0, 3.0]))), "floats are not dtime codes"
+	(counts, _, _) = timestamps2histogram(np.array([-1, 3, 12500]), max_tbin=max_tbin, min_tbin_size=min_tbin_size)
+	assert((counts.sum() == 2) and (counts[-1] == 1)), "negative timestamps should be dropped"
+	(counts, _, _) = timestamps2histogram(np.array([], dtype=np.int32), max_tbin=max_tbin, min_tbin_size=min_tbin_size)
+	assert((counts.size == 12500) and (counts.sum() == 0)), "empty timestamps should give an empty histogram"
+	## The bins are cached, but callers get their own copies
+	(bins, bin_edges) = get_hist_bins(max_tbin, 16)
+	bins[:] = 0
+	assert(np.array_equal(get_hist_bins(max_tbin, 16)[0], np.arange(0, max_tbin, 16) + 8)), "modifying the returned bins should not change the cached ones"
+	assert(np.array_equal(bincount_dtime_codes(dtime_vec, n_codes=100), np.bincount(dtime_vec)[0:100])), "bincount_dtime_codes should count the first n_codes codes"
+	assert(np.array_equal(bincount_dtime_codes(dtime_vec, n_codes=100, code_factor=3), np.bincount(dtime_vec // 3)[0:100])), "bincount_dtime_codes should count the first n_codes bins of code_factor codes"
+	print("PASSED test_timestamps2histogram_bincount_matches_np_histogram")
+
+def test_dtime_codes2histograms_matches_per_pixel():
+	(max_tbin, min_tbin_size) = (100000., 8)
+	rng = np.random.default_rng(2)
+	pixel_n_photons = rng.integers(0, 300, size=(4, 5))
+	pixel_n_photons[1, 2:4] = 0
+	pixel_offsets = np.concatenate(([0], np.cumsum(pixel_n_photons)))
+	dtime_vec = rng.integers(0, 2**15, size=pixel_offsets[-1]).astype(np.uint16)
+	dtime_vec[::7] = int(max_tbin / min_tbin_size)
+	# 3 is an integer factor with a partial last bin, 2.5 is not an integer factor
+	for hist_tbin_factor in [1, 2, 3, 2.5]:
+		n_bins = get_n_hist_bins(max_tbin, min_tbin_size, hist_tbin_factor)
+		expected_hists = np.array([dtime_counts2histogram(np.bincount(dtime_vec[pixel_offsets[p]:pixel_offsets[p+1]], minlength=N_DTIME_CODES), max_tbin, min_tbin_size, hist_tbin_factor)[0] for p in range(pixel_n_photons.size)])
+		# Small chunks split pixels across chunks and limit the pixels per chunk
+		for chunk_size in [2**20, 1000, 97]:
+			hists = dtime_codes2histograms(dtime_vec, pixel_offsets, max_tbin, min_tbin_size, hist_tbin_factor, chunk_size=chunk_size)
+			assert(np.array_equal(hists, expected_hists)), "batched histograms do not match for hist_tbin_factor {} and chunk_size {}".format(hist_tbin_factor, chunk_size)
+		## The counts can be added into a block of a histogram image. Offsets do not need to start at 0
+		hist_img = np.ones((4, 5, n_bins), dtype=np.uint32)
+		dtime_codes2histograms(dtime_vec, pixel_offsets[5:11], max_tbin, min_tbin_size, hist_tbin_factor, out=hist_img[1])
+		assert(np.array_equal(hist_img[1], expected_hists[5:10] + 1)), "counts should be added into out"
+		assert(np.all(hist_img[0] == 1) and np.all(hist_img[2:] == 1)), "only the out block should change"
+	print("PASSED test_dtime_codes2histograms_matches_per_pixel")
+
+def test_narrow_hist_img_file():
+	assert(get_min_uint_dtype(0) == np.uint16), "0 should fit in uint16"
+	assert(get_min_uint_dtype(2**16 - 1) == np.uint16), "2**16-1 should fit in uint16"
+	assert(get_min_uint_dtype(2**16) == np.uint32), "2**16 should need uint32"
+	assert(get_min_uint_dtype(2**32) == np.uint64), "2**32 should need uint64"
+	for max_count in [2**64, -1]:
+		try:
+			get_min_uint_dtype(max_count)
+			assert(False), "{} should not fit in any histogram dtype".format(max_count)
+		except ValueError:
+			pass
+	rng = np.random.default_rng(0)
+	with tempfile.TemporaryDirectory() as dirpath:
+		for max_count in [1000, 2**20]:
+			hist_img = rng.integers(0, max_count, size=(13, 5, 64)).astype(np.uint32)
+			hist_img_fpath = os.path.join(dirpath, 'raw-hist-img_r-13-c-5.npy')
+			np.save(hist_img_fpath, hist_img)
+			dtype = narrow_hist_img_file(hist_img_fpath, block_n_rows=4)
+			assert(dtype == get_min_uint_dtype(hist_img.max())), "wrong dtype for max count {}".format(hist_img.max())
+			narrow_hist_img = np.load(hist_img_fpath)
+			assert(narrow_hist_img.dtype == dtype), "dtype should be stored in the .npy header"
+			assert(np.array_equal(narrow_hist_img, hist_img)), "narrowing should not change the counts"
+			assert(to_min_uint_dtype(hist_img.astype(np.float64)).dtype == dtype), "to_min_uint_dtype does not match narrow_hist_img_file"
+	print("PASSED test_narrow_hist_img_file")
+
+def test_sync_stats_matches_np_unique():
+	rng = np.random.default_rng(2)
+	for max_sync in [1, 5, 1000]:
+		sync_vec = np.sort(rng.integers(1, max_sync + 1, size=3000))
+		(u, c) = np.unique(sync_vec, return_counts=True)
+		photons_per_cycle_counts_ref = np.bincount(c)
+		photons_per_cycle_counts_ref[0] = sync_vec.max() - u.size
+		## Stream it in chunks whose boundaries fall inside laser cycles, including empty chunks
+		for n_chunks in [1, 2, 7, 50]:
+			split_idxs = np.sort(rng.integers(0, sync_vec.size, size=n_chunks - 1))
+			sync_stats = init_sync_stats()
+			for sync_vec_chunk in np.split(sync_vec, split_idxs): update_sync_stats(sync_stats, sync_vec_chunk)
+			sync_stats = get_sync_stats(sync_stats)
+			assert(sync_stats['is_sync_sorted']), "sync_vec is sorted"
+			assert(sync_stats['n_photons'] == sync_vec.size), "wrong n_photons"
+			assert(sync_stats['n_laser_cycles'] == sync_vec.max()), "wrong n_laser_cycles"
+			assert(sync_stats['n_nonempty_laser_cycles'] == u.size), "wrong n_nonempty_laser_cycles"
+			assert(sync_stats['n_duplicate_photons'] == (sync_vec.size - u.size)), "wrong n_duplicate_photons"
+			photons_per_cycle_counts = sync_stats['photons_per_cycle_counts']
+			assert(np.array_equal(photons_per_cycle_counts[0:photons_per_cycle_counts_ref.size], photons_per_cycle_counts_ref) and (photons_per_cycle_counts[photons_per_cycle_counts_ref.size:].sum() == 0)), "photons per cycle counts do not match np.unique for {} chunks".format(n_chunks)
+		assert(calc_n_empty_laser_cycles(sync_vec) == (sync_vec.max() - u.size)), "wrong n_empty_laser_cycles"
+	## Unsorted sync_vec is flagged and calc_n_empty_laser_cycles falls back to np.unique
+	sync_vec = np.array([3, 1, 3, 7, 2])
+	assert(not calc_sync_stats(sync_vec)['is_sync_sorted']), "sync_vec is not sorted"
+	assert(calc_n_empty_laser_cycles(sync_vec) == 3), "wrong n_empty_laser_cycles for unsorted sync_vec"
+	sync_stats = calc_sync_stats(np.array([], dtype=np.int64))
+	assert((sync_stats['n_laser_cycles'] == 0) and (sync_stats['n_empty_laser_cycles'] == 0)), "no photons should give no laser cycles"
+	print("PASSED test_sync_stats_matches_np_unique")
+
+if __name__=='__main__':
+	test_timestamps2histogram_bincount_matches_np_histogram()
+	test_dtime_codes2histograms_matches_per_pixel()
+	test_narrow_hist_img_file()
+	test_sync_stats_matches_np_unique()
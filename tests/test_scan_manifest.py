@@ -0,0 +1,55 @@
+## Standard Library Imports
+import os
+import sys
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+## Library Imports
+import numpy as np
+
+## Local Imports
+from scan_manifest import *
+from scan_data_utils import vector2img
+from test_read_hydraharp_outfile_t3 import make_t3_records, write_t3_outfile
+
+
+def make_scan_dir(dirpath, nr, nc):
+	'''
+		Write one .out file per scan position (in shuffled order) and a positions file with an nr x nc grid
+	'''
+	for scan_pos_idx in np.random.default_rng(0).permutation(nr*nc):
+		write_t3_outfile(dirpath, make_t3_records(10, seed=int(scan_pos_idx)), fname='t3mode_{}_{}_{}.out'.format(scan_pos_idx % 2, 1000, scan_pos_idx))
+	(y_pos, x_pos) = np.meshgrid(np.arange(nr), np.arange(nc), indexing='ij')
+	pos_data = np.stack((np.arange(nr*nc), y_pos.ravel(), x_pos.ravel()), axis=-1)
+	np.savetxt(os.path.join(dirpath, POSITIONS_FNAME), pos_data, delimiter=',', fmt='%d')
+
+def test_scan_manifest():
+	(nr, nc) = (3, 4)
+	with tempfile.TemporaryDirectory() as base_dirpath:
+		dirpath = os.path.join(base_dirpath, 'scan')
+		os.makedirs(dirpath)
+		make_scan_dir(dirpath, nr, nc)
+		manifest_fpath = os.path.join(base_dirpath, SCAN_MANIFEST_FNAME)
+		manifest = load_scan_manifest(dirpath, manifest_fpath)
+		assert(manifest['scan_pos_indeces'] == list(range(nr*nc))), "files should be sorted by scan position"
+		assert(manifest['fnames'][5] == 't3mode_1_1000_5.out'), "fnames should be sorted by scan position"
+		assert((manifest['is_long_cable_flags'][5], manifest['delay_params'][5]) == (1, 1000)), "fname params were not parsed"
+		assert((manifest['n_rows_fullres'], manifest['n_cols_fullres'], manifest['n_positions']) == (nr, nc, nr*nc)), "wrong scan dims"
+		assert(np.array_equal(manifest['file_indeces_img'], vector2img(np.arange(nr*nc), nr, nc))), "wrong pixel mapping"
+		assert(manifest['fsizes'][5] == os.path.getsize(get_manifest_fpaths(manifest, dirpath)[5])), "wrong file sizes"
+		assert(is_scan_manifest_valid(load_json(manifest_fpath), dirpath)), "saved manifest should be valid"
+		## Files re-written in place do not change the directory. Their stats are only updated when refreshed
+		fpath = get_manifest_fpaths(manifest, dirpath)[5]
+		os.utime(fpath, ns=(0, 10**9))
+		assert(load_scan_manifest(dirpath, manifest_fpath)['mtimes'][5] != 10**9), "file stats should not be refreshed by default"
+		assert(load_scan_manifest(dirpath, manifest_fpath, refresh_file_stats=True)['mtimes'][5] == 10**9), "file stats should be refreshed"
+		assert(get_manifest_file_stats(load_json(manifest_fpath))[1][5] == 10**9), "refreshed file stats should be saved"
+		## Adding a file to the scan directory makes the manifest stale, and it is rebuilt on load
+		write_t3_outfile(dirpath, make_t3_records(10), fname='t3mode_0_1000_{}.out'.format(nr*nc))
+		os.utime(dirpath, ns=(0, manifest['dir_mtime_ns'] + 10**9))
+		assert(not is_scan_manifest_valid(manifest, dirpath)), "manifest should be stale after the directory changes"
+		assert(len(load_scan_manifest(dirpath, manifest_fpath)['fnames']) == nr*nc + 1), "stale manifest should be rebuilt"
+	print("PASSED test_scan_manifest")
+
+if __name__=='__main__':
+	test_scan_manifest()
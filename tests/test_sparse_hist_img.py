@@ -0,0 +1,37 @@
+## Standard Library Imports
+import os
+import sys
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+## Library Imports
+import numpy as np
+
+## Local Imports
+from sparse_hist_img import *
+
+
+def test_sparse_hist_img_roundtrip():
+	rng = np.random.default_rng(0)
+	hist_img = rng.poisson(0.05, size=(7, 5, 300)).astype(np.uint32)
+	hist_img[3, 2, :] = 0 # empty pixel
+	hist_img[1, 1, 10] = 70000 # count that does not fit in uint16
+	sparse_hist_img = dense2sparse_hist_img(hist_img, block_n_rows=3)
+	assert(sparse_hist_img['counts'].size == np.count_nonzero(hist_img)), "sparse image should only store non-zero bins"
+	with tempfile.TemporaryDirectory() as dirpath:
+		fpath = os.path.join(dirpath, 'raw-hist-img_r-7-c-5.npz')
+		save_sparse_hist_img(fpath, sparse_hist_img)
+		sparse_hist_img = load_sparse_hist_img(fpath)
+		assert(np.array_equal(sparse2dense_hist_img(sparse_hist_img), hist_img)), "sparse to dense does not match"
+		assert(np.array_equal(sparse2dense_hist_img(sparse_hist_img, rows=slice(1,6,2), cols=slice(2,None), start_bin=20, end_bin=250), hist_img[1:6:2, 2:, 20:250])), "dense crop does not match"
+		assert(np.array_equal(load_hist_img(fpath, start_bin=5, end_bin=-5, dtype=np.float64), hist_img[..., 5:-5])), "load_hist_img of sparse image does not match"
+		np.save(fpath.replace('.npz', '.npy'), hist_img)
+		assert(np.array_equal(load_hist_img(fpath.replace('.npz', '.npy'), start_bin=5, end_bin=-5), hist_img[..., 5:-5])), "load_hist_img of dense image does not match"
+	(nphotons_img, maxpeak_img, argmax_img) = calc_sparse_hist_img_summary(sparse_hist_img)
+	assert(np.array_equal(nphotons_img, hist_img.sum(axis=-1))), "nphotons image does not match"
+	assert(np.array_equal(maxpeak_img, hist_img.max(axis=-1))), "maxpeak image does not match"
+	assert(np.array_equal(argmax_img, hist_img.argmax(axis=-1))), "argmax image does not match"
+	print("PASSED test_sparse_hist_img_roundtrip")
+
+if __name__=='__main__':
+	test_sparse_hist_img_roundtrip()
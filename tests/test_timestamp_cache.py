@@ -0,0 +1,67 @@
+## Standard Library Imports
+import os
+import sys
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+## Library Imports
+import numpy as np
+
+## Local Imports
+from timestamp_cache import *
+from read_hydraharp_outfile_t3 import read_hydraharp_outfile_t3, outfile_t3_to_histogram, read_t3_records, split_t3_records, count_t3_overflows
+from test_read_hydraharp_outfile_t3 import make_t3_records, write_t3_outfile
+
+
+def test_timestamp_cache_roundtrip():
+	(max_tbin, min_tbin_size) = (100000., 8)
+	with tempfile.TemporaryDirectory() as dirpath:
+		fpaths = [write_t3_outfile(dirpath, make_t3_records(n_recs, overflow_prob=0.05, seed=n_recs), fname='t3mode_0_000000_{}.out'.format(i)) for (i, n_recs) in enumerate([3000, 0, 1, 7000])]
+		cache_dirpath = os.path.join(dirpath, 'cache')
+		assert(not is_timestamp_cache_valid(cache_dirpath, fpaths)), "cache should not be valid before it is built"
+		build_timestamp_cache(cache_dirpath, fpaths, chunk_n_recs=1000)
+		assert(is_timestamp_cache_valid(cache_dirpath, fpaths)), "cache should be valid after it is built"
+		cache = load_timestamp_cache(cache_dirpath)
+		assert(cache['sync_delta_escapes'].shape[0] > 0), "test data should exercise escaped sync deltas"
+		## The header holds the record stats of each file
+		for (i, fpath) in enumerate(fpaths):
+			records = read_t3_records(fpath)
+			(_, _, channel, special) = split_t3_records(records)
+			expected_record_stats = {'n_photons': np.count_nonzero(~special), 'n_overflow_records': np.count_nonzero(special & (channel == 63)), 'n_overflows': count_t3_overflows(records), 'n_markers': np.count_nonzero(special & (channel >= 1) & (channel <= 15))}
+			for key in RECORD_STATS_KEYS:
+				assert(cache['header']['record_stats'][key][i] == expected_record_stats[key]), "wrong {} in the cache header".format(key)
+		assert(sum(cache['header']['record_stats']['n_overflow_records']) > 0), "test data should exercise overflow records"
+		for (i, fpath) in enumerate(fpaths):
+			(sync_vec, dtime_vec) = read_hydraharp_outfile_t3(fpath)
+			(cached_sync_vec, cached_dtime_vec) = get_cached_timestamps(cache, i)
+			assert(np.array_equal(cached_sync_vec, sync_vec)), "cached sync_vec does not match"
+			assert(np.array_equal(cached_dtime_vec, dtime_vec)), "cached dtime_vec does not match"
+			hist_outputs = outfile_t3_to_histogram(fpath, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=2)
+			cached_hist_outputs = cached_timestamps2histogram(cache, i, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=2)
+			assert(np.array_equal(cached_hist_outputs[0], hist_outputs[0])), "cached histogram does not match"
+			assert(cached_hist_outputs[1:] == hist_outputs[1:]), "cached laser cycle stats do not match"
+		## Batched histograms of a range of files match the per-file ones
+		for hist_tbin_factor in [1, 3, 2.5]:
+			hists = cached_timestamps2histograms(cache, 1, len(fpaths), max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor)
+			for i in range(1, len(fpaths)):
+				(counts, _, _) = cached_timestamps2histogram(cache, i, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor)
+				assert(np.array_equal(hists[i-1], counts)), "batched cached histogram does not match"
+		(n_laser_cycles, n_empty_laser_cycles) = cached_laser_cycle_stats(cache, 0, len(fpaths))
+		for i in range(len(fpaths)):
+			(_, expected_n_laser_cycles, expected_n_empty_laser_cycles) = cached_timestamps2histogram(cache, i, max_tbin=max_tbin, min_tbin_size=min_tbin_size)
+			assert((n_laser_cycles[i], n_empty_laser_cycles[i]) == (expected_n_laser_cycles, expected_n_empty_laser_cycles)), "batched laser cycle stats do not match"
+		## Decoding the files in parallel builds the same cache
+		parallel_cache_dirpath = os.path.join(dirpath, 'parallel-cache')
+		build_timestamp_cache(parallel_cache_dirpath, fpaths, chunk_n_recs=1000, workers=2)
+		assert(is_timestamp_cache_valid(parallel_cache_dirpath, fpaths)), "parallel cache should be valid after it is built"
+		assert(not os.path.exists(os.path.join(parallel_cache_dirpath, 'parts'))), "the part files should be removed"
+		parallel_cache = load_timestamp_cache(parallel_cache_dirpath)
+		for column in ['offsets', 'sync_delta_escapes', 'dtime', 'sync-delta']:
+			assert(np.array_equal(parallel_cache[column], cache[column])), "parallel cache {} does not match".format(column)
+		## Modifying a file makes the cache stale
+		with open(fpaths[0], 'ab') as f: f.write(b'\x00'*4)
+		assert(not is_timestamp_cache_valid(cache_dirpath, fpaths)), "cache should be stale after a file changes"
+	print("PASSED test_timestamp_cache_roundtrip")
+
+if __name__=='__main__':
+	test_timestamp_cache_roundtrip()
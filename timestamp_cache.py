@@ -0,0 +1,226 @@
+'''
+    Compact binary cache of the photons decoded from the raw timestamp files (t3mode_*.out files).
+    The .out files of a scan (or of a single pixel) are decoded once and stored in a columnar layout:
+    * dtime.bin: uint16 dtime code of each photon
+    * sync-delta.bin: uint16 delta-encoded sync number of each photon. The first delta of each file is its absolute sync number.
+        Deltas that do not fit in a uint16 are stored as SYNC_DELTA_ESCAPE, and their true value is kept in sync-delta-escapes.npy
+    * offsets.npy: the photons of file i are in [offsets[i], offsets[i+1])
+    * header.json: written last, so a cache without a header is incomplete. It also holds the size and mtime of each file
+        so that stale caches can be detected, and the record stats of each file (see RECORD_STATS_KEYS)
+    Later reads only need to memory map the columns, so re-histogramming a scan does not decode the .out files again.
+'''
+#### Standard Library Imports
+import os
+import shutil
+import multiprocessing
+
+#### Library imports
+import numpy as np
+
+#### Local imports
+from scan_data_utils import N_DTIME_CODES, dtime_counts2histogram, dtime_codes2histograms
+from read_hydraharp_outfile_t3 import iter_t3_record_chunks, decode_t3_records, split_t3_records, T3_CHUNK_N_RECS, T3WRAPAROUND, T3_OVERFLOW_CHANNEL
+from research_utils.io_ops import load_json, write_json
+
+TIMESTAMP_CACHE_VERSION = 2
+DTIME_DTYPE = np.dtype('<u2')
+SYNC_DELTA_DTYPE = np.dtype('<u2')
+SYNC_DELTA_ESCAPE = np.iinfo(SYNC_DELTA_DTYPE).max
+# Per-file record stats in header['record_stats']: photon records, overflow records, overflows (in units of T3WRAPAROUND syncs) and marker records
+RECORD_STATS_KEYS = ['n_photons', 'n_overflow_records', 'n_overflows', 'n_markers']
+
+def get_file_stats(fpaths):
+	'''
+		Size and mtime (in ns) of each file. Used to detect when a cache is stale
+	'''
+	file_stats = [os.stat(fpath) for fpath in fpaths]
+	return ([int(s.st_size) for s in file_stats], [int(s.st_mtime_ns) for s in file_stats])
+
+def encode_sync_deltas(sync_vec, prev_sync, photon_offset):
+	'''
+		Delta-encode a chunk of a non-decreasing sync_vec.
+		Returns the uint16 deltas, and the (global photon index, value) of the deltas that had to be escaped
+	'''
+	deltas = np.diff(sync_vec, prepend=prev_sync)
+	is_escaped = np.logical_or(deltas < 0, deltas >= SYNC_DELTA_ESCAPE)
+	escaped_idx = np.flatnonzero(is_escaped)
+	escapes = np.stack((escaped_idx + photon_offset, deltas[escaped_idx]), axis=-1)
+	deltas[escaped_idx] = SYNC_DELTA_ESCAPE
+	return (deltas.astype(SYNC_DELTA_DTYPE), escapes)
+
+def decode_file_to_cache_part(part_task):
+	'''
+		Decode one .out file into its own part of the cache columns (part_fpath_prefix + '.dtime.bin' and + '.sync-delta.bin').
+		part_task is (fpath, part_fpath_prefix, chunk_n_recs). Returns (record_stats, escapes), where record_stats is the dict of
+		RECORD_STATS_KEYS counts of the file, and the photon indices of the escaped sync deltas are relative to the start of the file
+	'''
+	(fpath, part_fpath_prefix, chunk_n_recs) = part_task
+	(n_photons, overflow_correction, prev_sync) = (0, 0, 0)
+	(n_overflow_records, n_markers) = (0, 0)
+	escapes_list = []
+	with open(part_fpath_prefix + '.dtime.bin', 'wb') as dtime_file, open(part_fpath_prefix + '.sync-delta.bin', 'wb') as sync_delta_file:
+		for records_chunk in iter_t3_record_chunks(fpath, chunk_n_recs=chunk_n_recs):
+			(sync_vec, dtime_vec, _, overflow_correction) = decode_t3_records(records_chunk, overflow_correction)
+			(_, _, channel, special) = split_t3_records(records_chunk)
+			n_overflow_records += np.count_nonzero(special & (channel == T3_OVERFLOW_CHANNEL))
+			n_markers += np.count_nonzero(special & (channel >= 1) & (channel <= 15))
+			(sync_deltas, escapes) = encode_sync_deltas(sync_vec, prev_sync, n_photons)
+			dtime_vec.astype(DTIME_DTYPE).tofile(dtime_file)
+			sync_deltas.tofile(sync_delta_file)
+			escapes_list.append(escapes)
+			n_photons += sync_vec.size
+			if(sync_vec.size > 0): prev_sync = sync_vec[-1]
+	escapes = np.concatenate(escapes_list, axis=0) if (len(escapes_list) > 0) else np.zeros((0,2), dtype=np.int64)
+	record_stats = {'n_photons': n_photons, 'n_overflow_records': int(n_overflow_records), 'n_overflows': overflow_correction // T3WRAPAROUND, 'n_markers': int(n_markers)}
+	return (record_stats, escapes.astype(np.int64))
+
+def build_timestamp_cache(cache_dirpath, fpaths, chunk_n_recs=T3_CHUNK_N_RECS, workers=1):
+	'''
+		Decode each .out file in fpaths once and store its photons in the cache at cache_dirpath.
+		The photons of fpaths[i] can then be loaded with get_cached_timestamps(cache, i)
+		The files are decoded in parallel on workers processes, each into its own part files, and the parts are appended to
+		the cache columns in file order as they complete. So building the cache costs about the same as an uncached ingest.
+	'''
+	os.makedirs(cache_dirpath, exist_ok=True)
+	header_fpath = os.path.join(cache_dirpath, 'header.json')
+	if(os.path.exists(header_fpath)): os.remove(header_fpath)
+	(fsizes, mtimes) = get_file_stats(fpaths)
+	parts_dirpath = os.path.join(cache_dirpath, 'parts')
+	os.makedirs(parts_dirpath, exist_ok=True)
+	part_tasks = [(fpath, os.path.join(parts_dirpath, str(i)), chunk_n_recs) for (i, fpath) in enumerate(fpaths)]
+	if(workers <= 1): part_outputs = map(decode_file_to_cache_part, part_tasks)
+	else:
+		pool = multiprocessing.Pool(workers)
+		part_outputs = pool.imap(decode_file_to_cache_part, part_tasks)
+	offsets = np.zeros((len(fpaths)+1,), dtype=np.int64)
+	escapes_list = []
+	record_stats = {key: [] for key in RECORD_STATS_KEYS}
+	try:
+		with open(os.path.join(cache_dirpath, 'dtime.bin'), 'wb') as dtime_file, open(os.path.join(cache_dirpath, 'sync-delta.bin'), 'wb') as sync_delta_file:
+			for (i, (file_record_stats, escapes)) in enumerate(part_outputs):
+				for (column_file, column) in [(dtime_file, 'dtime'), (sync_delta_file, 'sync-delta')]:
+					part_fpath = '{}.{}.bin'.format(part_tasks[i][1], column)
+					with open(part_fpath, 'rb') as part_file: shutil.copyfileobj(part_file, column_file)
+					os.remove(part_fpath)
+				escapes[:,0] += offsets[i]
+				escapes_list.append(escapes)
+				offsets[i+1] = offsets[i] + file_record_stats['n_photons']
+				for key in RECORD_STATS_KEYS: record_stats[key].append(file_record_stats[key])
+	finally:
+		if(workers > 1): pool.terminate()
+	shutil.rmtree(parts_dirpath)
+	escapes = np.concatenate(escapes_list, axis=0) if (len(escapes_list) > 0) else np.zeros((0,2), dtype=np.int64)
+	np.save(os.path.join(cache_dirpath, 'offsets.npy'), offsets)
+	np.save(os.path.join(cache_dirpath, 'sync-delta-escapes.npy'), escapes.astype(np.int64))
+	header = {
+		'version': TIMESTAMP_CACHE_VERSION
+		, 'n_files': len(fpaths)
+		, 'n_photons': int(offsets[-1])
+		, 'dtime_dtype': DTIME_DTYPE.str
+		, 'sync_delta_dtype': SYNC_DELTA_DTYPE.str
+		, 'fnames': [os.path.basename(fpath) for fpath in fpaths]
+		, 'fsizes': fsizes
+		, 'mtimes': mtimes
+		, 'record_stats': record_stats
+	}
+	write_json(header_fpath, header)
+	return header
+
+def is_timestamp_cache_valid(cache_dirpath, fpaths):
+	'''
+		A cache is valid if it is complete, has the current version, and was built from the same files with the same size and mtime
+	'''
+	header_fpath = os.path.join(cache_dirpath, 'header.json')
+	if(not os.path.exists(header_fpath)): return False
+	header = load_json(header_fpath)
+	if(header['version'] != TIMESTAMP_CACHE_VERSION): return False
+	if(header['fnames'] != [os.path.basename(fpath) for fpath in fpaths]): return False
+	(fsizes, mtimes) = get_file_stats(fpaths)
+	return (header['fsizes'] == fsizes) and (header['mtimes'] == mtimes)
+
+def load_timestamp_cache(cache_dirpath):
+	'''
+		Memory map the cache columns. Nothing is decoded or read into memory until it is accessed.
+	'''
+	header_fpath = os.path.join(cache_dirpath, 'header.json')
+	assert(os.path.exists(header_fpath)), "{} is not a complete timestamp cache. Run build_timestamp_cache first".format(cache_dirpath)
+	header = load_json(header_fpath)
+	assert(header['version'] == TIMESTAMP_CACHE_VERSION), "timestamp cache version {} is not supported".format(header['version'])
+	cache = {'header': header}
+	cache['offsets'] = np.load(os.path.join(cache_dirpath, 'offsets.npy'))
+	cache['sync_delta_escapes'] = np.load(os.path.join(cache_dirpath, 'sync-delta-escapes.npy'))
+	for (column, dtype_key) in [('dtime', 'dtime_dtype'), ('sync-delta', 'sync_delta_dtype')]:
+		if(header['n_photons'] == 0): cache[column] = np.zeros((0,), dtype=header[dtype_key])
+		else: cache[column] = np.memmap(os.path.join(cache_dirpath, column + '.bin'), dtype=header[dtype_key], mode='r', shape=(header['n_photons'],))
+	return cache
+
+def get_cached_sync_deltas(cache, file_idx, end_file_idx=None):
+	'''
+		int64 sync deltas of file_idx, or the concatenated sync deltas of the files [file_idx, end_file_idx)
+	'''
+	if(end_file_idx is None): end_file_idx = file_idx + 1
+	(start_idx, end_idx) = (cache['offsets'][file_idx], cache['offsets'][end_file_idx])
+	sync_deltas = cache['sync-delta'][start_idx:end_idx].astype(np.int64)
+	escapes = cache['sync_delta_escapes']
+	(escapes_start, escapes_end) = np.searchsorted(escapes[:,0], [start_idx, end_idx])
+	sync_deltas[escapes[escapes_start:escapes_end,0] - start_idx] = escapes[escapes_start:escapes_end,1]
+	return sync_deltas
+
+def get_cached_timestamps(cache, file_idx):
+	'''
+		Returns (sync_vec, dtime_vec) of the file_idx-th file of the cache, i.e., the same as read_hydraharp_outfile_t3 (with int64 sync_vec)
+		dtime_vec is a view into the memory mapped cache
+	'''
+	(start_idx, end_idx) = (cache['offsets'][file_idx], cache['offsets'][file_idx+1])
+	sync_vec = np.cumsum(get_cached_sync_deltas(cache, file_idx))
+	return (sync_vec, cache['dtime'][start_idx:end_idx])
+
+def get_cached_file_nbytes(cache, file_idx):
+	'''
+		Number of bytes of the dtimes and sync deltas of file_idx in the cache (excluding escaped sync deltas)
+	'''
+	n_photons = int(cache['offsets'][file_idx+1] - cache['offsets'][file_idx])
+	return n_photons*(DTIME_DTYPE.itemsize + SYNC_DELTA_DTYPE.itemsize)
+
+def cached_timestamps2histogram(cache, file_idx, max_tbin, min_tbin_size, hist_tbin_factor=1, max_photons=None, max_laser_cycles=None):
+	'''
+		Same outputs as outfile_t3_to_histogram, computed from the cache. The laser cycle statistics are
+		computed directly from the sync deltas: a non-zero delta starts a new laser cycle.
+	'''
+	(start_idx, end_idx) = (cache['offsets'][file_idx], cache['offsets'][file_idx+1])
+	sync_deltas = get_cached_sync_deltas(cache, file_idx)
+	n_photons = sync_deltas.size
+	if(max_photons is not None): n_photons = min(n_photons, max_photons)
+	if(max_laser_cycles is not None): n_photons = min(n_photons, int(np.searchsorted(np.cumsum(sync_deltas), max_laser_cycles, side='right')))
+	(end_idx, sync_deltas) = (start_idx + n_photons, sync_deltas[0:n_photons])
+	dtime_counts = np.bincount(cache['dtime'][start_idx:end_idx], minlength=N_DTIME_CODES)
+	(counts, _, _) = dtime_counts2histogram(dtime_counts, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor)
+	if(end_idx == start_idx): return (counts, 0, 0)
+	n_laser_cycles = int(sync_deltas.sum())
+	n_nonempty_laser_cycles = 1 + np.count_nonzero(sync_deltas[1:])
+	return (counts, n_laser_cycles, n_laser_cycles - n_nonempty_laser_cycles)
+
+def cached_laser_cycle_stats(cache, start_file_idx, end_file_idx):
+	'''
+		(n_laser_cycles, n_empty_laser_cycles) of each file in [start_file_idx, end_file_idx), computed from the sync deltas of
+		all the files at once. Same as the ones of cached_timestamps2histogram without max_photons/max_laser_cycles
+	'''
+	offsets = cache['offsets'][start_file_idx:end_file_idx+1] - cache['offsets'][start_file_idx]
+	sync_deltas = get_cached_sync_deltas(cache, start_file_idx, end_file_idx)
+	# The deltas of a file add up to its last sync number. Every non-zero delta after the first one starts a new laser cycle
+	cum_sync_deltas = np.concatenate(([0], np.cumsum(sync_deltas)))
+	cum_n_nonzero_deltas = np.concatenate(([0], np.cumsum(sync_deltas != 0)))
+	n_laser_cycles = cum_sync_deltas[offsets[1:]] - cum_sync_deltas[offsets[0:-1]]
+	is_nonempty_file = offsets[1:] > offsets[0:-1]
+	n_nonempty_laser_cycles = is_nonempty_file*(1 + cum_n_nonzero_deltas[offsets[1:]] - cum_n_nonzero_deltas[np.minimum(offsets[0:-1] + 1, offsets[1:])])
+	return (n_laser_cycles, n_laser_cycles - n_nonempty_laser_cycles)
+
+def cached_timestamps2histograms(cache, start_file_idx, end_file_idx, max_tbin, min_tbin_size, hist_tbin_factor=1, out=None):
+	'''
+		Histograms of files [start_file_idx, end_file_idx) of the cache in one batched pass (see dtime_codes2histograms).
+		The dtimes of consecutive files are already concatenated in the cache, so its offsets are the pixel offsets.
+		Same counts as cached_timestamps2histogram without max_photons/max_laser_cycles. Returns (n_files, n_bins) histograms, or out.
+		The rows are in file (scan) order, not image order (see vector2img). ingest_cached_pixel_batch writes each one to its pixel
+	'''
+	pixel_offsets = cache['offsets'][start_file_idx:end_file_idx+1]
+	return dtime_codes2histograms(cache['dtime'], pixel_offsets, max_tbin=max_tbin, min_tbin_size=min_tbin_size, hist_tbin_factor=hist_tbin_factor, out=out)